@@ -0,0 +1,68 @@
+"""
+Compares the vectorised mask-and-reindex filter against the original per-simplex
+loop of filter_strain0_data.
+
+Run from the repository root:
+    python -m benchmarks.bench_filter --points 500000 --zero-fraction 0.3
+"""
+import argparse
+import time
+
+import numpy as np
+from scipy.spatial import Delaunay
+
+from modules.processing import mask_and_reindex
+
+
+def loop_filter(mask, simplices):
+    """ The original filter_strain0_data loop, kept as the reference. """
+    index_map = np.zeros_like(mask, dtype=int)
+    index_map[mask] = np.arange(np.count_nonzero(mask))
+
+    simplices_filtered = []
+    for simplex in simplices:
+        if mask[simplex].all():
+            simplices_filtered.append(index_map[simplex])
+
+    return np.array(simplices_filtered)
+
+
+def best_of(func, repeats, *args):
+    times = []
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--points", type=int, default=200_000)
+    parser.add_argument("--zero-fraction", type=float, default=0.3)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    points_2d = rng.random((args.points, 2))
+    simplices = Delaunay(points_2d).simplices
+    mask = rng.random(args.points) >= args.zero_fraction
+
+    t_loop, reference = best_of(loop_filter, 1, mask, simplices)
+    t_vec, (_, simplices_filtered) = best_of(mask_and_reindex, args.repeats,
+                                             mask, simplices)
+
+    assert np.array_equal(reference, simplices_filtered)
+
+    print(f"points: {args.points}, simplices: {len(simplices)}, "
+          f"kept simplices: {len(simplices_filtered)}")
+    print(f"loop:       {t_loop:.4f} s")
+    print(f"vectorised: {t_vec:.4f} s")
+    print(f"speedup:    {t_loop / t_vec:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+"""
+Benchmarks the import, meshing, filtering, combining and plot building stages on a
+synthetic LaVision dataset, fully offline and without opening a browser.
+
+Results are written as JSON so runs can be compared, e.g. before and after a change:
+    python -m benchmarks.run_benchmarks --points 50000 --timesteps 10 -o before.json
+
+Each stage is timed over --repeats runs, then run once more under tracemalloc to
+record the peak memory it allocates. The process peak RSS is reported at the end.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from benchmarks.synthetic import generate_lavision_dataset
+from modules import importing, plotting, processing
+from modules.classes import Config
+from modules.instrumentation import peak_rss_bytes
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def timesteps(datasets):
+    return [timestep for stereo_pair in datasets for timestep in stereo_pair]
+
+
+def stage_import(state):
+    state['datasets'] = importing.load_multiple_stereo_pairs(state['stereo_pair_dirs'],
+                                                            state['config'])
+    return len(timesteps(state['datasets']))
+
+
+def stage_import_cached(state):
+    state['datasets'] = importing.load_multiple_stereo_pairs(state['stereo_pair_dirs'],
+                                                            state['cached_config'])
+    return len(timesteps(state['datasets']))
+
+
+def stage_mesh(state):
+    tri_cache = state['tri_cache']
+    for timestep in timesteps(state['datasets']):
+        processing.create_delaunay_mesh(timestep, cache=tri_cache)
+    return len(timesteps(state['datasets']))
+
+
+def stage_mesh_grid(state):
+    for timestep in timesteps(state['datasets']):
+        processing.create_mesh(timestep, config=state['grid_config'])
+    return len(timesteps(state['datasets']))
+
+
+def stage_filter(state):
+    for timestep in timesteps(state['datasets']):
+        processing.filter_strain0_data(timestep)
+    return len(timesteps(state['datasets']))
+
+
+def stage_combine_unfiltered(state):
+    datasets = state['datasets']
+    for timestep_index in range(len(datasets[0])):
+        processing.combine_unfiltered_stereo_pairs(
+            [stereo_pair[timestep_index] for stereo_pair in datasets])
+    return len(datasets[0])
+
+
+def stage_combine_filtered(state):
+    datasets = state['datasets']
+    for timestep_index in range(len(datasets[0])):
+        processing.combine_filtered_stereo_pairs(
+            [stereo_pair[timestep_index] for stereo_pair in datasets])
+    return len(datasets[0])
+
+
+def stage_build_animated_figure(state):
+    plotting.build_animated_mesh_figure(state['datasets'])
+    return len(state['datasets'][0])
+
+
+def stage_build_overlay_figure(state):
+    plotting.build_multiple_meshes_figure(state['datasets'], timestep_index=0)
+    return 1
+
+
+def stage_build_scatter_figure(state):
+    combined = processing.combine_unfiltered_stereo_pairs(
+        [stereo_pair[0] for stereo_pair in state['datasets']])
+    plotting.build_scatter_figure(combined)
+    return 1
+
+
+# In run order, later stages use the datasets of earlier ones
+STAGES = {
+    'import': stage_import,
+    'import_cached': stage_import_cached,
+    'mesh': stage_mesh,
+    'mesh_grid': stage_mesh_grid,
+    'filter': stage_filter,
+    'combine_unfiltered': stage_combine_unfiltered,
+    'combine_filtered': stage_combine_filtered,
+    'build_animated_figure': stage_build_animated_figure,
+    'build_overlay_figure': stage_build_overlay_figure,
+    'build_scatter_figure': stage_build_scatter_figure,
+}
+
+
+def run_stage(name, func, state, repeats):
+    times = []
+    items = 0
+    for _ in range(repeats):
+        start = time.perf_counter()
+        items = func(state)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func(state)
+    _, peak_traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'stage': name,
+        'items': items,
+        'repeats': repeats,
+        'best_s': min(times),
+        'mean_s': float(np.mean(times)),
+        'best_per_item_s': min(times) / max(items, 1),
+        'peak_traced_bytes': peak_traced,
+    }
+
+
+def run_benchmarks(args, workdir):
+    stereo_pair_dirs = generate_lavision_dataset(workdir,
+                                                 points=args.points,
+                                                 timesteps=args.timesteps,
+                                                 stereo_pairs=args.stereo_pairs,
+                                                 zero_fraction=args.zero_fraction,
+                                                 seed=args.seed)
+
+    config = Config()
+    config.cache_enabled = False
+    config.import_workers = args.workers
+    config.import_float32 = args.float32
+
+    cached_config = Config()
+    cached_config.__dict__.update(config.__dict__)
+    cached_config.cache_enabled = True
+    cached_config.cache_dir = os.path.join(workdir, ".dic_cache")
+    # Populate the cache so the stage measures cache hits
+    importing.load_multiple_stereo_pairs(stereo_pair_dirs, cached_config)
+
+    grid_config = Config()
+    grid_config.mesh_mode = "grid"
+
+    state = {
+        'stereo_pair_dirs': stereo_pair_dirs,
+        'config': config,
+        'cached_config': cached_config,
+        'grid_config': grid_config,
+        'tri_cache': (processing.TriangulationCache()
+                      if args.reuse_triangulation else None),
+    }
+
+    results = []
+    for name, func in STAGES.items():
+        if args.stages and name not in args.stages:
+            # Still run skipped stages once so later stages have their inputs
+            func(state)
+            continue
+        result = run_stage(name, func, state, args.repeats)
+        print(f"{name:<24} best {result['best_s']:9.4f} s   "
+              f"peak {result['peak_traced_bytes'] / 1e6:9.1f} MB", file=sys.stderr)
+        results.append(result)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--points", type=int, default=20_000,
+                        help="points per stereo pair per timestep")
+    parser.add_argument("--timesteps", type=int, default=5)
+    parser.add_argument("--stereo-pairs", type=int, default=3)
+    parser.add_argument("--zero-fraction", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=1, help="import workers")
+    parser.add_argument("--float32", action="store_true", help="import as float32")
+    parser.add_argument("--reuse-triangulation", action="store_true")
+    parser.add_argument("--stages", nargs="*", choices=list(STAGES),
+                        help="stages to time, all by default")
+    parser.add_argument("--workdir", help="where to write the synthetic data, "
+                                          "a temporary directory by default")
+    parser.add_argument("-o", "--output", help="JSON results file, stdout by default")
+    args = parser.parse_args()
+
+    if args.workdir:
+        results = run_benchmarks(args, args.workdir)
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            results = run_benchmarks(args, workdir)
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            'git_commit': git_commit(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'params': {key: value for key, value in vars(args).items()
+                   if key not in ('output', 'workdir')},
+        'results': results,
+        'peak_rss_bytes': peak_rss_bytes(),
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
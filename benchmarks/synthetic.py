@@ -0,0 +1,109 @@
+"""
+Generates synthetic LaVision-format vector field exports for benchmarking.
+
+Each stereo pair is a directory of one CSV per timestep, like the exports in
+test_files/cam1-2/. Points lie on a regular grid over a curved surface, the pairs
+overlap along x like neighbouring camera pairs, and a fixed region of interest plus
+random noise points have zero strain.
+
+Run from the repository root:
+    python -m benchmarks.synthetic out_dir --points 100000 --timesteps 20
+"""
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from modules.importing import LAVISION_COLUMNS
+
+# Extra columns found in LaVision exports which the importer should skip
+EXTRA_COLUMNS = ['Displacement x[mm]', 'Displacement y[mm]', 'Displacement z[mm]',
+                 'Minimum normal strain - RC[S]']
+
+
+def generate_lavision_dataset(root,
+                              points: int = 10_000,
+                              timesteps: int = 5,
+                              stereo_pairs: int = 3,
+                              zero_fraction: float = 0.3,
+                              spacing: float = 0.5,
+                              overlap: float = 0.2,
+                              seed: int = 0) -> list[str]:
+    """
+    Writes a synthetic test campaign.
+
+    :param root: Directory to write the stereo pair directories into.
+    :param points: Points per stereo pair per timestep, rounded to a square grid.
+    :param timesteps: Timesteps (CSV files) per stereo pair.
+    :param stereo_pairs: Number of stereo pair directories, cam1-2, cam2-3, ...
+    :param zero_fraction: Fraction of points with zero strain, half of them in a
+                          border outside the region of interest, half random noise.
+    :param spacing: Grid spacing [mm].
+    :param overlap: Fraction of each pair's width overlapping the next pair.
+    :param seed: Random seed, the same arguments always give the same files.
+    :return: List of the stereo pair directories.
+    """
+    rng = np.random.default_rng(seed)
+    side = max(2, int(round(np.sqrt(points))))
+    width = side * spacing
+
+    stereo_pair_dirs = []
+    for pair in range(stereo_pairs):
+        pair_dir = Path(root) / f"cam{pair + 1}-{pair + 2}"
+        pair_dir.mkdir(parents=True, exist_ok=True)
+        stereo_pair_dirs.append(str(pair_dir))
+
+        grid_x, grid_y = np.meshgrid(np.arange(side) * spacing, np.arange(side) * spacing)
+        x = grid_x.ravel() + pair * width * (1 - overlap)
+        y = grid_y.ravel()
+        z = 5 * np.sin(x / 20) * np.cos(y / 30)
+
+        # Zero strain outside the region of interest, by distance from the centre
+        radius = np.hypot(grid_x.ravel() - width / 2, grid_y.ravel() - width / 2)
+        border = radius > np.quantile(radius, 1 - zero_fraction / 2)
+
+        for timestep in range(timesteps):
+            load = (timestep + 1) / timesteps
+            strain = np.abs(load * 10 * np.exp(-((x - x.mean()) / width) ** 2)
+                            + rng.normal(0, 0.1, x.shape))
+            noise = rng.random(x.shape) < zero_fraction / 2
+            strain[border | noise] = 0
+
+            columns = {
+                LAVISION_COLUMNS[0]: x,
+                LAVISION_COLUMNS[1]: y,
+                LAVISION_COLUMNS[2]: z + load * 0.1 * np.sin(y / 10),
+                LAVISION_COLUMNS[3]: strain,
+            }
+            for name in EXTRA_COLUMNS:
+                columns[name] = rng.normal(0, 0.01, x.shape)
+
+            pd.DataFrame(columns).to_csv(pair_dir / f"B{timestep + 1:05d}.csv",
+                                         index=False)
+
+    return stereo_pair_dirs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("root")
+    parser.add_argument("--points", type=int, default=10_000)
+    parser.add_argument("--timesteps", type=int, default=5)
+    parser.add_argument("--stereo-pairs", type=int, default=3)
+    parser.add_argument("--zero-fraction", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    stereo_pair_dirs = generate_lavision_dataset(args.root,
+                                                 points=args.points,
+                                                 timesteps=args.timesteps,
+                                                 stereo_pairs=args.stereo_pairs,
+                                                 zero_fraction=args.zero_fraction,
+                                                 seed=args.seed)
+    print("\n".join(stereo_pair_dirs))
+
+
+if __name__ == '__main__':
+    main()
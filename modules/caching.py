@@ -0,0 +1,157 @@
+import hashlib
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+
+
+class DatasetCache:
+    """
+    On-disk cache of parsed DIC files stored as .npy arrays.
+
+    Each entry holds the selected columns of one file as an (n_points, n_columns)
+    array and is keyed by the file path, size, modification time, the selected
+    columns and the dtype, so an edited file or different column selection is a
+    miss. Entries are loaded memory-mapped. The modification time of an entry is
+    bumped on every hit and the least recently used entries are removed once the
+    cache grows beyond max_bytes, down to low_water of it so the directory is only
+    listed again after that fraction of max_bytes has been written.
+
+    If the cache directory cannot be written, e.g. next to data on a read-only
+    mount, a warning is printed once and files are parsed uncached from then on.
+    """
+
+    suffix = ".npy"
+    low_water = 0.9
+    _shared = {}  # (cache directory, max_bytes) -> DatasetCache
+    _shared_lock = threading.Lock()
+
+    def __init__(self, cache_dir, max_bytes: int = 2 * 1024 ** 3):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.writable = True
+        self._total = None  # Running size of the entries, listed on the first store
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, cache_dir, max_bytes: int = 2 * 1024 ** 3) -> "DatasetCache":
+        """ The cache of a directory shared by every file in this process """
+        key = (str(cache_dir), max_bytes)
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(cache_dir, max_bytes=max_bytes)
+            return cls._shared[key]
+
+    def key(self, path, columns, dtype) -> str:
+        stat = os.stat(path)
+        token = "|".join([str(Path(path).resolve()),
+                          str(stat.st_size),
+                          str(stat.st_mtime_ns),
+                          ",".join(columns),
+                          np.dtype(dtype).str])
+        return hashlib.sha1(token.encode()).hexdigest()
+
+    def entry_path(self, path, columns, dtype) -> Path:
+        return self.cache_dir / (self.key(path, columns, dtype) + self.suffix)
+
+    def load(self, path, columns, dtype):
+        """
+        Returns the memory-mapped cached array for the file, or None on a miss.
+        """
+        entry = self.entry_path(path, columns, dtype)
+        try:
+            array = np.load(entry, mmap_mode='r')
+        except (FileNotFoundError, ValueError, OSError):
+            # Missing, evicted by another process or partially written
+            return None
+        try:
+            os.utime(entry)  # Mark as recently used
+        except OSError:
+            pass  # Read-only cache, still usable
+        return array
+
+    def store(self, path, columns, dtype, array) -> None:
+        """
+        Writes the array for the file into the cache, then evicts old entries if it
+        has grown beyond max_bytes.
+        """
+        if not self.writable:
+            return None
+        entry = self.entry_path(path, columns, dtype)
+
+        # Write to a temporary file and rename so readers never see partial entries
+        tmp = entry.with_name(f"{entry.stem}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            with open(tmp, "wb") as f:
+                np.save(f, np.ascontiguousarray(array, dtype=dtype))
+            size = tmp.stat().st_size
+            os.replace(tmp, entry)
+        except OSError as e:
+            self.writable = False
+            print(f"Warning: Could not write to the cache {self.cache_dir}, "
+                  f"continuing without caching")
+            print(f"Exception: {e}")
+            try:
+                tmp.unlink(missing_ok=True)
+            except OSError:
+                pass
+            return None
+
+        with self._lock:
+            if self._total is None:
+                self._total = self.size()
+            else:
+                self._total += size
+            full = self._total > self.max_bytes
+        if full:
+            self.evict()
+        return None
+
+    def entries(self) -> list[tuple[float, int, Path]]:
+        """ Returns (last used time, size, path) for every cache entry """
+        entries = []
+        for entry in self.cache_dir.glob("*" + self.suffix):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+        return entries
+
+    def size(self) -> int:
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self) -> None:
+        """
+        Removes least recently used entries until the cache fits in low_water of
+        max_bytes, if it exceeds max_bytes.
+        """
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes
+        if total > self.max_bytes:
+            target = self.low_water * self.max_bytes
+        for _, size, entry in entries:
+            if total <= target:
+                break
+            try:
+                entry.unlink()
+            except OSError:
+                # Already removed, or still mapped on platforms that forbid it
+                continue
+            total -= size
+        with self._lock:
+            self._total = total
+        return None
+
+    def clear(self) -> None:
+        for _, _, entry in self.entries():
+            try:
+                entry.unlink()
+            except OSError:
+                continue
+        with self._lock:
+            self._total = None
+        return None
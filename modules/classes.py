@@ -1,23 +1,421 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from modules.stats import DatasetStatistics
+
+
 class DICDataset:
-    """ Class to hold data from a stereo DIC dataset """
+    """
+    Class to hold data from a stereo DIC dataset
 
-    def __init__(self):
-        self.x = None
-        self.x_filtered = None
-        self.y = None
-        self.y_filtered = None
-        self.z = None
-        self.z_filtered = None
+    Coordinates are held in a single C-contiguous (n_points, 3) coords array, with
+    x, y and z as column views of it, copied once when the points are set so meshing
+    and neighbour searches can use it without copies of their own. Filtering stores
+    only the indices of the kept points in filtered_index, the *_filtered attributes
+    are gathered from the full arrays when accessed. They are read-only, filter with
+    processing.filter_data or apply_filter instead of assigning them.
+    Further fields of an imported file, e.g. displacements, are held in fields and
+    loaded on first access with field(name).
+    """
+
+    __slots__ = ('coords',
+                 'strain',
+                 'fields',
+                 'filtered_index',
+                 'trisurface',  # Depreciate
+                 'simplices',
+                 'simplices_filtered')
+
+    def __init__(self, coords=None, strain=None, dtype=None):
+        self.coords = None
         self.strain = None
-        self.strain_filtered = None
+        self.fields = None  # DatasetFields of an imported file
+        self.filtered_index = None  # Indices of kept points, or a slice
         self.trisurface = None  # Depreciate
         self.simplices = None
         self.simplices_filtered = None
+        if coords is not None:
+            self.set_points(coords, strain, dtype=dtype)
+
+    def set_points(self, coords, strain=None, dtype=None) -> None:
+        """
+        Replaces the points, clearing any mesh and filter of the previous points.
+
+        :param coords: (n_points, 3) array of x, y, z coordinates.
+        :param strain: Optional array of n_points strain values.
+        :param dtype: Optional storage dtype, e.g. np.float32, otherwise kept as given.
+        """
+        self.coords = np.ascontiguousarray(coords, dtype=dtype)
+        self.strain = (None if strain is None
+                       else np.ascontiguousarray(strain, dtype=dtype))
+        self.fields = None
+        self.filtered_index = None
+        self.simplices = None
+        self.simplices_filtered = None
+        return None
+
+    def copy(self) -> "DICDataset":
+        """
+        Shallow copy sharing the arrays, so meshing or filtering the copy, which
+        replaces rather than modifies them, leaves this dataset unchanged.
+        """
+        copied = DICDataset()
+        for name in self.__slots__:
+            setattr(copied, name, getattr(self, name))
+        return copied
+
+    def _get_coord(self, axis: int):
+        return None if self.coords is None else self.coords[:, axis]
+
+    def _set_coord(self, axis: int, values) -> None:
+        values = np.asarray(values)
+        if (self.coords is None
+                or self.coords.shape[0] != values.shape[0]
+                or not self.coords.flags.writeable):
+            # Start a new coords array, keeping the other axes if the length matches
+            coords = np.full((values.shape[0], 3), np.nan, dtype=values.dtype)
+            if self.coords is not None and self.coords.shape[0] == values.shape[0]:
+                coords[:] = self.coords
+            self.coords = coords
+        self.coords[:, axis] = values
+        return None
+
+    def _get_filtered(self, values):
+        if values is None or self.filtered_index is None:
+            return None
+        return values[self.filtered_index]
+
+    @property
+    def x(self):
+        return self._get_coord(0)
+
+    @x.setter
+    def x(self, values):
+        self._set_coord(0, values)
+
+    @property
+    def y(self):
+        return self._get_coord(1)
+
+    @y.setter
+    def y(self, values):
+        self._set_coord(1, values)
+
+    @property
+    def z(self):
+        return self._get_coord(2)
+
+    @z.setter
+    def z(self, values):
+        self._set_coord(2, values)
+
+    @property
+    def coords_filtered(self):
+        return self._get_filtered(self.coords)
+
+    @property
+    def x_filtered(self):
+        return self._get_filtered(self._get_coord(0))
+
+    @property
+    def y_filtered(self):
+        return self._get_filtered(self._get_coord(1))
+
+    @property
+    def z_filtered(self):
+        return self._get_filtered(self._get_coord(2))
+
+    @property
+    def strain_filtered(self):
+        return self._get_filtered(self.strain)
+
+    def field(self, name: str):
+        """
+        Values of a field of the imported file, loaded on first access.
+
+        :param name: Field name, see importing.LAVISION_FIELDS, or a column header.
+        :raises KeyError: If the file has no such field.
+        """
+        if self.fields is not None:
+            name = self.fields.resolve(name)
+        if name in ('x', 'y', 'z'):
+            return self._get_coord('xyz'.index(name))
+        if self.fields is None:
+            raise KeyError(f"no fields were imported with this dataset, not {name!r}")
+        if name == self.fields.strain_name:
+            return self.strain
+        return self.fields[name]
+
+    def field_filtered(self, name: str):
+        return self._get_filtered(self.field(name))
+
+    @property
+    def nbytes(self) -> int:
+        """ Memory held by the dataset's arrays, including shared simplices """
+        arrays = [self.coords, self.strain, self.filtered_index, self.simplices,
+                  self.simplices_filtered]
+        if self.fields is not None:
+            arrays += list(self.fields.loaded.values())
+        return sum(array.nbytes for array in arrays if isinstance(array, np.ndarray))
+
+
+class DatasetFields:
+    """
+    Fields of one imported file, by name or column header. The columns available are
+    known from the file header, and each is loaded on first access by the loader, a
+    callable taking a column header, so only the fields a run uses are read. The
+    coordinates and the field imported as strain are held by the DICDataset itself.
+
+    :param loader: Callable returning the values of a column of the file.
+    :param columns: Dict of field name to column header of the fields in the file.
+    :param strain_name: Name of the field imported as the dataset's strain.
+    """
+
+    def __init__(self, loader, columns: dict, strain_name: str = None):
+        self.loader = loader
+        self.columns = dict(columns)
+        self.strain_name = strain_name
+        self.loaded = {}  # Field name -> values
+
+    def resolve(self, name: str) -> str:
+        """ Field name of a field name or column header, unknown names unchanged """
+        if name in self.columns:
+            return name
+        return next((field for field, column in self.columns.items()
+                     if column == name), name)
+
+    def __contains__(self, name) -> bool:
+        return self.resolve(name) in self.columns
+
+    def __getitem__(self, name: str):
+        name = self.resolve(name)
+        values = self.loaded.get(name)
+        if values is None:
+            if name not in self.columns:
+                raise KeyError(f"no field {name!r}, available: {self.names}")
+            values = self.loader(self.columns[name])
+            self.loaded[name] = values
+        return values
+
+    @property
+    def names(self) -> list[str]:
+        return list(self.columns)
+
+    def __repr__(self):
+        return f"DatasetFields({self.names}, loaded={list(self.loaded)})"
+
+
+class DICCollection(list):
+    """
+    List of the stereo pairs of a test, each a list of timesteps (or a
+    LazyStereoPair), indexed as datasets[stereo_pair][timestep].
+
+    stats holds running statistics of the filtered fields, updated as timesteps are
+    filtered, which plotting uses for axis and color ranges. histories holds the
+    StrainHistory of each stereo pair if built by the importer, None for pairs whose
+    points change over time.
+    """
+
+    def __init__(self, stereo_pairs=()):
+        super().__init__(stereo_pairs)
+        self.stats = DatasetStatistics()
+        self.histories = None
+
+
+class LazyStereoPair:
+    """
+    Sequence of the timesteps of one stereo pair which are loaded on first access.
+
+    Supports the same indexing and iteration as a list of DICDatasets, but only the
+    max_resident most recently used timesteps are kept in memory. Iterating
+    prefetches the next timestep in a background thread while the current one is
+    being processed.
+
+    Transforms are callables applied in place to every timestep after it is loaded,
+    e.g. create_delaunay_mesh, so results of processing survive eviction and
+    reloading.
+    """
+
+    def __init__(self, paths, loader, max_resident: int = 4, prefetch: bool = True):
+        self.paths = list(paths)
+        self.loader = loader  # Callable taking a path and returning a DICDataset
+        self.max_resident = max(1, max_resident)
+        self.prefetch_next = prefetch
+        self.transforms = []
+        self._init_state()
+
+    def _init_state(self):
+        self._resident = OrderedDict()  # timestep index -> DICDataset, LRU order
+        self._pending = {}  # timestep index -> Future of a prefetch
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def __getstate__(self):
+        # Locks, threads and loaded data are not sent to other processes
+        return {'paths': self.paths,
+                'loader': self.loader,
+                'max_resident': self.max_resident,
+                'prefetch_next': self.prefetch_next,
+                'transforms': self.transforms}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_state()
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            subset = LazyStereoPair(self.paths[index], self.loader,
+                                    max_resident=self.max_resident,
+                                    prefetch=self.prefetch_next)
+            subset.transforms = list(self.transforms)
+            return subset
+
+        index = self._normalise_index(index)
+        with self._lock:
+            if index in self._resident:
+                self._resident.move_to_end(index)
+                return self._resident[index]
+            future = self._pending.pop(index, None)
+
+        data = future.result() if future is not None else self._load(index)
+
+        with self._lock:
+            self._resident[index] = data
+            self._resident.move_to_end(index)
+            while len(self._resident) > self.max_resident:
+                self._resident.popitem(last=False)
+        return data
+
+    def __iter__(self):
+        for index in range(len(self)):
+            if self.prefetch_next:
+                self.prefetch(index + 1)
+            yield self[index]
+
+    def _normalise_index(self, index: int) -> int:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("timestep index out of range")
+        return index
+
+    def _load(self, index: int):
+        data = self.loader(self.paths[index])
+        for transform in self.transforms:
+            transform(data)
+        return data
+
+    def prefetch(self, index: int) -> None:
+        """ Starts loading a timestep in the background if it is not resident """
+        if not 0 <= index < len(self):
+            return None
+        with self._lock:
+            if index in self._resident or index in self._pending:
+                return None
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1)
+            self._pending[index] = self._executor.submit(self._load, index)
+        return None
+
+    def add_transform(self, transform) -> None:
+        """
+        Adds a callable applied to each timestep after loading. Resident timesteps
+        are dropped so every timestep returned afterwards has been transformed.
+        """
+        self.transforms.append(transform)
+        self.clear()
+        return None
+
+    def clear(self) -> None:
+        """ Drops all resident and pending timesteps """
+        with self._lock:
+            for future in self._pending.values():
+                future.cancel()
+            self._pending.clear()
+            self._resident.clear()
+        return None
 
 
 class Config:
-    """ Class to hold configuration data for debugging """
+    """
+    Runtime configuration of a run, the import, meshing, plotting and scheduling
+    settings. Built from the command line arguments by cli.build_config, or set
+    directly when the methods are called from Python.
+    """
     def __init__(self):
-        self.debug = True
         self.print_sep = "=" * 30
-        
\ No newline at end of file
+
+        # Instrumentation, per stage timing spans and counters
+        self.profile = False
+        self.profile_path = None  # Chrome trace JSON written at the end of a run
+
+        # Importing
+        self.import_workers = 1  # Number of parallel workers, None for all cores
+        self.import_executor = "process"  # "process" or "thread" pool
+        self.import_float32 = False  # Store imported columns as float32
+        self.strain_field = "strain"  # Field used as strain, see LAVISION_FIELDS
+        self.timesteps = None  # slice of the timesteps imported, None for all
+
+        # Binary cache of imported files
+        self.cache_enabled = True
+        self.cache_dir = None  # None to use a .dic_cache directory next to the data
+        self.cache_max_bytes = 2 * 1024 ** 3  # Least recently used entries evicted
+
+        # Lazy loading, timesteps are imported on first access
+        self.lazy_loading = False
+        self.max_resident_timesteps = 4  # Per stereo pair, least recently used evicted
+        self.prefetch = True  # Load the next timestep in the background
+
+        # Per point strain history (timesteps, points) of each stereo pair
+        self.strain_history = False  # Build memory-mapped histories on import
+
+        # Meshing
+        self.mesh_mode = "auto"  # "grid", "delaunay" or "auto", grid if on a grid
+        self.mesh_skip_strain0 = True  # Grid mode, skip cells with strain == 0 corners
+        self.grid_tolerance = 0.01  # Max point offset from its grid node / spacing
+        self.reuse_triangulation = True  # Share meshes between identical (x, y) grids
+        self.triangulation_tolerance = 1e-6  # [mm] max point offset for a shared grid
+        self.mesh_workers = 1  # Processes meshing and filtering, None for all cores
+
+        # Mesh quality filter of combined meshes, None for no limit
+        self.mesh_max_edge = None  # [mm] longest edge kept
+        self.mesh_max_edge_factor = 3.0  # Longest edge kept over the median longest edge
+        self.mesh_max_aspect = 10.0  # Longest edge / shortest altitude, 1 equilateral
+        self.mesh_max_circumradius = None  # [mm] alpha shape radius
+
+        # Fusion of overlapping stereo pairs when combining them
+        self.fusion_cell_size = None  # [mm] merge cell, e.g. half the vector spacing
+        self.fusion_weights = None  # Confidence of each stereo pair, None for equal
+
+        # Resampling of the stereo pairs onto a common regular grid
+        self.resample_spacing = None  # [mm] grid spacing, None for the point spacing
+        self.resample_weights = None  # Confidence of each stereo pair, None for equal
+
+        # Nearest neighbour filtering of combined stereo pairs
+        self.neighbour_count = 8  # Neighbours checked around each strain == 0 point
+        self.neighbour_workers = -1  # Threads for KD-tree queries, -1 for all cores
+
+        # Plotting level of detail, None for full resolution
+        self.plot_max_vertices = None  # Per mesh per frame, vertex clustering
+        self.plot_max_points = None  # Per scatter plot, voxel grid decimation
+        self.plot_encoding = "full"  # "full" or "delta" frames in animated meshes
+        self.plot_strain_percentiles = (1, 99)  # Color range, None for min to max
+
+        # Output
+        self.output_format = "html"  # "html" plotly plots or "xdmf" HDF5 time series
+        self.show_plots = True  # False for headless batch runs, plots are only written
+        self.plot_per_timestep = False  # One HTML file per timestep plus an index page
+        self.plot_workers = 1  # Processes writing per timestep plots, None for all cores
+
+        # Watch mode, processing timesteps as they are written during a test
+        self.watch_poll_interval = 2.0  # [s] between scans of the directories
+        self.watch_settle_time = 2.0  # [s] unmodified before a file counts as written
+
+        # Pipeline
+        self.pipeline_workers = 2  # Threads running independent stages concurrently
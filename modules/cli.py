@@ -0,0 +1,381 @@
+import argparse
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+
+from modules import instrumentation, methods, plotting, watching
+from modules.classes import Config
+from modules.exporting import output_paths
+from modules.importing import get_csv_file_paths
+
+# Plot file name of each processing method, see methods.METHOD_TARGETS
+METHOD_FILE_NAMES = {
+    1: "3d_plot_one_timestep_mesh_filter_plot",
+    2: "3d_plot_timesteps_mesh_filter_plot",
+    3: "3d_plot_timestep_combine_filter_plot_scatter",
+    4: "3d_plot_timesteps_combine_filter_neighbours",
+    5: "3d_plot_timesteps_resample_fuse_plot",
+    6: "3d_plot_timesteps_combine_mesh_filter_plot",
+}
+
+# Methods plotting a single timestep, always as HTML
+SINGLE_TIMESTEP_METHODS = (1, 3)
+
+# Bytes held per point of a resident timestep besides its columns: about 2 simplices
+# per point of 3 int32 indices, unfiltered and filtered, plus the filter index
+MESH_BYTES_PER_POINT = 2 * 2 * 3 * 4 + 4
+
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_size(text: str) -> int:
+    """ Bytes of a size such as 512M, 4G or 1.5GB, plain numbers are bytes """
+    text = text.strip().upper().removesuffix("B")
+    unit = text[-1:] if text[-1:] in SIZE_UNITS else ""
+    try:
+        return int(float(text[:len(text) - len(unit)]) * SIZE_UNITS[unit])
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {text!r}")
+
+
+def parse_timesteps(text: str) -> slice:
+    """ Slice of timesteps from START:STOP[:STEP], or a single timestep index """
+    try:
+        parts = [int(part) if part else None for part in text.split(":")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid timestep range: {text!r}")
+    if len(parts) == 1:
+        if parts[0] is None:
+            return slice(None)
+        return slice(parts[0], parts[0] + 1 if parts[0] != -1 else None)
+    if len(parts) > 3:
+        raise argparse.ArgumentTypeError(f"invalid timestep range: {text!r}")
+    return slice(*parts)
+
+
+def find_stereo_pair_dirs(campaign_dir) -> list[str]:
+    """
+    Stereo pair directories of a test campaign: its subdirectories holding CSV files,
+    or the campaign directory itself if it holds them directly.
+    """
+    campaign_dir = Path(campaign_dir)
+    if any(campaign_dir.glob("*.csv")):
+        return [str(campaign_dir)]
+    return sorted(str(directory) for directory in campaign_dir.iterdir()
+                  if directory.is_dir() and any(directory.glob("*.csv")))
+
+
+def expand_campaigns(patterns: list[str]) -> list[Path]:
+    """ Campaign directories matching the directories or glob patterns, in order """
+    campaigns = []
+    for pattern in patterns:
+        matches = sorted(Path(match) for match in glob.glob(pattern, recursive=True)
+                         if Path(match).is_dir())
+        if not matches:
+            print(f"Warning: No directories match {pattern}")
+        campaigns += [match for match in matches if match not in campaigns]
+    return campaigns
+
+
+def campaign_names(campaign_dirs: list[Path]) -> list[str]:
+    """
+    Output names of the campaigns, their paths relative to the directory common to
+    all of them joined with _, e.g. tests/a/run and tests/b/run give a_run and b_run.
+    A lone campaign, or the common directory itself, is named after its directory.
+
+    :raises ValueError: If two campaigns still get the same name.
+    """
+    paths = [Path(os.path.abspath(campaign_dir)) for campaign_dir in campaign_dirs]
+    root = Path(os.path.commonpath(paths)) if len(paths) > 1 else None
+    names = []
+    for path in paths:
+        parts = path.relative_to(root).parts if root is not None else ()
+        names.append("_".join(parts) or path.name)
+
+    seen = {}
+    for campaign_dir, name in zip(campaign_dirs, names):
+        if name in seen:
+            raise ValueError(f"campaigns {seen[name]} and {campaign_dir} would both "
+                             f"be written as {name}")
+        seen[name] = campaign_dir
+    return names
+
+
+def output_path(save_path: str, method: int, config: Config) -> Path:
+    """ File a method actually writes for a save path, e.g. the .xmf index """
+    if method in SINGLE_TIMESTEP_METHODS:
+        return Path(save_path)
+    if config.output_format == "xdmf":
+        return output_paths(save_path)[1]
+    if config.plot_per_timestep:
+        return plotting.timestep_figures_dir(save_path) / "index.html"
+    return Path(save_path)
+
+
+def estimate_timestep_bytes(path, config: Config) -> int:
+    """
+    Memory of one imported, meshed and filtered timestep, from the file size and the
+    length of its first lines, without parsing it.
+    """
+    with open(path, "rb") as f:
+        head = [f.readline() for _ in range(65)][1:]
+    line_bytes = max(1.0, np.mean([len(line) for line in head if line] or [1]))
+    n_points = os.path.getsize(path) / line_bytes
+    itemsize = 4 if config.import_float32 else 8
+    return int(n_points * (4 * itemsize + MESH_BYTES_PER_POINT))
+
+
+def apply_memory_budget(config: Config, stereo_pair_dirs: list[str],
+                        budget: int) -> None:
+    """
+    Sets how many timesteps a campaign keeps resident or in flight to fit in the
+    memory budget, in place. Everything is imported up front if it fits, otherwise
+    the stereo pairs are loaded lazily with as many resident timesteps per pair as
+    fit, and the worker pools are capped by the timesteps they would hold at once.
+    """
+    stereo_pair_fpaths = get_csv_file_paths(stereo_pair_dirs, check_counts=False)
+    if config.timesteps is not None:
+        stereo_pair_fpaths = [stereo_pair[config.timesteps]
+                              for stereo_pair in stereo_pair_fpaths]
+    stereo_pair_fpaths = [stereo_pair for stereo_pair in stereo_pair_fpaths if stereo_pair]
+    if not stereo_pair_fpaths:
+        return None
+
+    n_pairs = len(stereo_pair_fpaths)
+    n_timesteps = sum(len(stereo_pair) for stereo_pair in stereo_pair_fpaths)
+    timestep_bytes = max(estimate_timestep_bytes(stereo_pair[0], config)
+                         for stereo_pair in stereo_pair_fpaths)
+    resident = max(1, budget // max(timestep_bytes, 1))
+
+    if resident >= n_timesteps:
+        config.lazy_loading = False
+    else:
+        config.lazy_loading = True
+        per_pair = max(1, resident // n_pairs)
+        # A prefetched timestep is in memory alongside the resident ones
+        config.prefetch = per_pair >= 2
+        config.max_resident_timesteps = per_pair - 1 if config.prefetch else per_pair
+
+    for name in ("import_workers", "mesh_workers", "plot_workers"):
+        workers = getattr(config, name) or os.cpu_count() or 1
+        setattr(config, name, max(1, min(workers, resident)))
+
+    print(f"Memory budget {budget / 1024 ** 2:.1f} MB, about "
+          f"{timestep_bytes / 1024 ** 2:.1f} MB per timestep: "
+          + (f"{config.max_resident_timesteps} resident timesteps per stereo pair"
+             if config.lazy_loading else f"all {n_timesteps} timesteps resident"))
+    return None
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Mesh, filter and plot stereo DIC test campaigns. A campaign is a "
+                    "directory of stereo pair directories holding LaVision CSV files.")
+    parser.add_argument("campaigns", nargs="*", default=["test_files"],
+                        help="campaign directories or glob patterns, "
+                             "default: test_files")
+    parser.add_argument("-m", "--method", type=int, nargs="+", default=[2],
+                        choices=sorted(methods.METHOD_TARGETS),
+                        help="processing methods, see methods.METHOD_TARGETS, run on "
+                             "one pipeline per campaign so they share its imported "
+                             "and meshed datasets, default: 2")
+    parser.add_argument("-t", "--timesteps", type=parse_timesteps, default=None,
+                        metavar="START:STOP[:STEP]",
+                        help="timesteps to import, default: all")
+    parser.add_argument("-i", "--timestep-index", type=int, default=0,
+                        help="timestep of the single timestep methods 1 and 3, "
+                             "within the imported timesteps, default: 0")
+    parser.add_argument("-o", "--output-dir", default="plots",
+                        help="directory the plots are written to, default: plots")
+    parser.add_argument("-f", "--format", choices=("html", "xdmf"), default="html",
+                        help="plotly HTML plots or HDF5/XDMF time series")
+    parser.add_argument("--per-timestep", action="store_true",
+                        help="write one HTML file per timestep plus an index page")
+    parser.add_argument("--headless", "--no-show", dest="show", action="store_false",
+                        help="only write the plots, never open them")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="cores shared by all campaigns, default: all")
+    parser.add_argument("--campaign-workers", type=int, default=None,
+                        help="campaigns processed at once, default: as many as there "
+                             "are campaigns, up to the workers")
+    parser.add_argument("--memory-budget", type=parse_size, default=None,
+                        metavar="SIZE",
+                        help="memory shared by all campaigns, e.g. 8G, sets how many "
+                             "timesteps are resident or in flight")
+    parser.add_argument("--float32", action="store_true",
+                        help="import the columns as float32")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="do not use the binary cache of imported files")
+    parser.add_argument("--watch", action="store_true",
+                        help="process timesteps of one campaign as they are written")
+    parser.add_argument("--idle-timeout", type=float, default=None,
+                        help="seconds without a new timestep before watching stops")
+    parser.add_argument("--profile", action="store_true",
+                        help="print per stage timings of each campaign")
+    parser.add_argument("--trace", default=None,
+                        help="Chrome trace JSON written with --profile, one per "
+                             "campaign named after it")
+    return parser
+
+
+def campaign_trace_path(trace: str, name: str) -> str:
+    """ Trace file of a campaign, the --trace path with the campaign name appended """
+    trace = Path(trace)
+    return str(trace.with_name(f"{trace.stem}_{name}{trace.suffix}"))
+
+
+def build_config(args, workers: int) -> Config:
+    """ Config of one campaign from the command line arguments """
+    config = Config()
+    config.timesteps = args.timesteps
+    config.output_format = args.format
+    config.plot_per_timestep = args.per_timestep
+    config.show_plots = args.show
+    config.import_float32 = args.float32
+    config.cache_enabled = not args.no_cache
+    config.profile = args.profile
+
+    config.import_workers = workers
+    config.mesh_workers = workers
+    config.plot_workers = workers
+    config.neighbour_workers = workers
+    return config
+
+
+def run_campaign(name: str, stereo_pair_dirs: list[str], method_list: list[int],
+                 timestep_index: int, save_paths: list[str], config: Config):
+    """
+    Runs processing methods on a campaign in one run of its own pipeline, so the
+    methods share stages, e.g. the imported datasets, and their independent stages
+    run concurrently. Module level so it can be sent to a process pool.
+
+    :return: (name, output paths, seconds taken)
+    """
+    start = time.perf_counter()
+    instrumentation.PROFILER.reset()
+    instrumentation.enable(config)
+
+    print(config.print_sep)
+    print(f"Campaign {name}: {len(stereo_pair_dirs)} stereo pairs")
+    # One run for all the methods, so their independent stages overlap
+    pipeline = methods.create_pipeline(config)
+    targets = {methods.METHOD_TARGETS[method]: {'plot_save_path': save_path}
+               for method, save_path in zip(method_list, save_paths)}
+    pipeline.run(list(targets),
+                 target_params=targets,
+                 stereo_pair_dirs=stereo_pair_dirs,
+                 timestep_index=timestep_index,
+                 config=config)
+
+    # Per stage timing summary and trace, if profiling
+    instrumentation.report(config)
+    outputs = [str(output_path(save_path, method, config))
+               for method, save_path in zip(method_list, save_paths)]
+    return name, outputs, time.perf_counter() - start
+
+
+def main(argv=None) -> int:
+    """
+    Command line entry point, see build_parser. Campaigns are run in parallel
+    processes, each with an equal share of the workers and memory budget.
+
+    :return: Exit code, 1 if any campaign failed.
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.trace and not args.profile:
+        parser.error("--trace requires --profile")
+    workers = args.workers or os.cpu_count() or 1
+
+    campaigns = []
+    for campaign_dir in expand_campaigns(args.campaigns):
+        stereo_pair_dirs = find_stereo_pair_dirs(campaign_dir)
+        if stereo_pair_dirs:
+            campaigns.append((campaign_dir, stereo_pair_dirs))
+        else:
+            print(f"Warning: No stereo pair directories in {campaign_dir}")
+    if not campaigns:
+        print("Warning: No campaigns to process")
+        return 1
+    try:
+        names = campaign_names([campaign_dir for campaign_dir, _ in campaigns])
+    except ValueError as e:
+        print(f"Exception: {e}")
+        return 1
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    if args.watch:
+        if len(campaigns) > 1:
+            print(f"Warning: Watching only the first of {len(campaigns)} campaigns")
+        campaign_dir, stereo_pair_dirs = campaigns[0]
+        config = build_config(args, workers)
+        if args.trace:
+            config.profile_path = campaign_trace_path(args.trace, names[0])
+        instrumentation.PROFILER.reset()
+        instrumentation.enable(config)
+        try:
+            watching.watch_stereo_pairs(stereo_pair_dirs=stereo_pair_dirs,
+                                        save_path=output_dir / f"{names[0]}_watch",
+                                        config=config,
+                                        idle_timeout=args.idle_timeout)
+        finally:
+            # Per stage timing summary and trace, if profiling
+            instrumentation.report(config)
+        return 0
+
+    campaign_workers = min(len(campaigns), args.campaign_workers or workers)
+    campaign_workers = max(1, campaign_workers)
+    workers_per_campaign = max(1, workers // campaign_workers)
+
+    tasks = []
+    for (campaign_dir, stereo_pair_dirs), name in zip(campaigns, names):
+        config = build_config(args, workers_per_campaign)
+        if campaign_workers > 1:
+            # Plots cannot be opened from worker processes
+            config.show_plots = False
+        if args.memory_budget is not None:
+            apply_memory_budget(config, stereo_pair_dirs,
+                                args.memory_budget // campaign_workers)
+        if args.trace:
+            config.profile_path = campaign_trace_path(args.trace, name)
+
+        save_paths = []
+        for method in args.method:
+            stem = f"{name}_{METHOD_FILE_NAMES[method]}"
+            if args.format == "html" or method in SINGLE_TIMESTEP_METHODS:
+                stem = f"{stem}.html"
+            save_paths.append(str(output_dir / stem))
+        tasks.append((name, stereo_pair_dirs, args.method, args.timestep_index,
+                      save_paths, config))
+
+    failed = 0
+    if campaign_workers == 1:
+        for task in tasks:
+            try:
+                name, outputs, seconds = run_campaign(*task)
+                print(f"Campaign {name} done in {seconds:.1f} s: " + ", ".join(outputs))
+            except Exception as e:
+                print(f"Warning: Campaign {task[0]} failed")
+                print(f"Exception: {e}")
+                failed += 1
+    else:
+        with ProcessPoolExecutor(max_workers=campaign_workers) as executor:
+            futures = {executor.submit(run_campaign, *task): task[0] for task in tasks}
+            for future in as_completed(futures):
+                try:
+                    name, outputs, seconds = future.result()
+                    print(f"Campaign {name} done in {seconds:.1f} s: "
+                          + ", ".join(outputs))
+                except Exception as e:
+                    print(f"Warning: Campaign {futures[future]} failed")
+                    print(f"Exception: {e}")
+                    failed += 1
+
+    print(f"{len(tasks) - failed} of {len(tasks)} campaigns processed")
+    return 1 if failed else 0
@@ -0,0 +1,138 @@
+import numpy as np
+import pandas as pd
+
+from modules.processing import index_dtype
+
+REDUCTIONS = ('mean', 'max', 'min')
+
+
+def voxel_clusters(coords, cell_size: float):
+    """
+    Assigns each point to a cubic voxel of the given size.
+
+    :param coords: (n_points, 3) array of coordinates.
+    :param cell_size: Voxel edge length, in the units of coords.
+    :return: (cluster, n_clusters) where cluster is the voxel number of each point,
+             numbered in order of first appearance.
+    """
+    cells = np.floor((coords - coords.min(axis=0)) / cell_size).astype(np.int64)
+    dims = cells.max(axis=0) + 1
+    keys = cells[:, 0] + dims[0] * (cells[:, 1] + dims[1] * cells[:, 2])
+
+    # Hash based so it scales linearly, unlike sorting with np.unique
+    cluster, uniques = pd.factorize(keys)
+    return cluster.astype(index_dtype(len(uniques)), copy=False), len(uniques)
+
+
+def cell_size_for_budget(coords, budget: int, iterations: int = 6) -> float:
+    """
+    Finds a voxel size giving at most budget occupied voxels.
+
+    DIC data is a surface, so the first guess spreads the budget over the area of
+    the two largest bounding box extents, then the size is grown until it fits.
+    """
+    extents = np.sort(np.ptp(coords, axis=0))[::-1]
+    area = max(extents[0] * extents[1], extents[0] ** 2 / budget, np.finfo(float).tiny)
+    cell_size = np.sqrt(area / budget)
+
+    for _ in range(iterations):
+        _, n_clusters = voxel_clusters(coords, cell_size)
+        if n_clusters <= budget:
+            break
+        cell_size *= np.sqrt(n_clusters / budget) * 1.05
+
+    return cell_size
+
+
+def reduce_by_cluster(values, cluster, n_clusters: int, reduce: str = 'mean'):
+    """ Aggregates per point values into per cluster values """
+    if reduce == 'mean':
+        counts = np.bincount(cluster, minlength=n_clusters)
+        totals = np.bincount(cluster, weights=values, minlength=n_clusters)
+        return (totals / np.maximum(counts, 1)).astype(values.dtype, copy=False)
+    if reduce == 'max':
+        reduced = np.full(n_clusters, -np.inf, dtype=values.dtype)
+        np.maximum.at(reduced, cluster, values)
+        return reduced
+    if reduce == 'min':
+        reduced = np.full(n_clusters, np.inf, dtype=values.dtype)
+        np.minimum.at(reduced, cluster, values)
+        return reduced
+    raise ValueError(f"reduce must be one of {REDUCTIONS}, not {reduce}")
+
+
+def decimate_points(coords, strain, max_points: int, reduce: str = 'mean'):
+    """
+    Voxel grid decimation of a point cloud to at most max_points points.
+
+    Points sharing a voxel are replaced by their centroid, and their strain
+    is aggregated with reduce ('mean', 'max' or 'min'). Use 'max' to make sure
+    strain peaks are still visible.
+
+    :return: (coords, strain) of the decimated cloud, the inputs if already in budget.
+    """
+    if max_points is None or coords.shape[0] <= max_points:
+        return coords, strain
+
+    cluster, n_clusters = voxel_clusters(coords, cell_size_for_budget(coords, max_points))
+    coords_out = np.column_stack([reduce_by_cluster(coords[:, axis], cluster, n_clusters)
+                                  for axis in range(3)])
+    strain_out = reduce_by_cluster(strain, cluster, n_clusters, reduce=reduce)
+
+    return coords_out, strain_out
+
+
+def decimate_mesh(coords,
+                  simplices,
+                  strain,
+                  max_vertices: int = None,
+                  max_triangles: int = None,
+                  reduce: str = 'mean'):
+    """
+    Simplifies a triangle mesh by vertex clustering to fit a vertex or triangle budget.
+
+    Vertices sharing a voxel are merged into their centroid, triangles are remapped
+    to the merged vertices, and triangles which collapse or become duplicates are
+    removed. Strain is aggregated per merged vertex with reduce.
+
+    A regular triangulated grid has about two triangles per vertex, which is used to
+    turn a triangle budget into a vertex budget.
+
+    :return: (coords, simplices, strain) of the simplified mesh, the inputs if already
+             within budget.
+    """
+    budget = max_vertices
+    if max_triangles is not None:
+        triangle_budget = max(1, max_triangles // 2)
+        budget = triangle_budget if budget is None else min(budget, triangle_budget)
+
+    if (budget is None or coords.shape[0] <= budget) and (
+            max_triangles is None or simplices.shape[0] <= max_triangles):
+        return coords, simplices, strain
+
+    # Only cluster vertices used by the mesh
+    used = np.zeros(coords.shape[0], dtype=bool)
+    used[simplices.ravel()] = True
+    used_index = np.flatnonzero(used)
+    coords, strain = coords[used_index], strain[used_index]
+    index_map = np.full(used.shape[0], -1, dtype=index_dtype(used_index.shape[0]))
+    index_map[used_index] = np.arange(used_index.shape[0], dtype=index_map.dtype)
+    simplices = index_map[simplices]
+
+    cluster, n_clusters = voxel_clusters(coords,
+                                         cell_size_for_budget(coords, max(1, budget)))
+    coords_out = np.column_stack([reduce_by_cluster(coords[:, axis], cluster, n_clusters)
+                                  for axis in range(3)])
+    strain_out = reduce_by_cluster(strain, cluster, n_clusters, reduce=reduce)
+
+    simplices = cluster[simplices]
+    valid = ((simplices[:, 0] != simplices[:, 1])
+             & (simplices[:, 1] != simplices[:, 2])
+             & (simplices[:, 0] != simplices[:, 2]))
+    simplices = simplices[valid]
+
+    # Remove duplicate triangles, compared irrespective of vertex order
+    duplicate = pd.DataFrame(np.sort(simplices, axis=1)).duplicated().to_numpy()
+    simplices = simplices[~duplicate]
+
+    return coords_out, simplices, strain_out
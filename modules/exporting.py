@@ -0,0 +1,197 @@
+from pathlib import Path
+from xml.sax.saxutils import quoteattr
+
+import numpy as np
+
+from modules import instrumentation
+
+XDMF_NUMBER_TYPES = {'f': 'Float', 'i': 'Int', 'u': 'UInt'}
+
+# Arrays of every timestep group, a group missing any was left partially written
+TIMESTEP_ARRAYS = ('points', 'cells', 'strain')
+
+# Suffixes replaced by .h5 and .xmf, any other dot is part of the name, e.g. run.1
+OUTPUT_SUFFIXES = ('.h5', '.xmf', '.xdmf', '.html')
+
+
+def output_paths(path) -> tuple[Path, Path]:
+    """ (.h5, .xmf) paths of a time series, appending the suffixes to the name """
+    path = Path(path)
+    name = path.name
+    if path.suffix.lower() in OUTPUT_SUFFIXES:
+        name = path.name[:-len(path.suffix)]
+    return path.with_name(f"{name}.h5"), path.with_name(f"{name}.xmf")
+
+
+class XDMFWriter:
+    """
+    Streams filtered meshes of every stereo pair to an HDF5 file with an XDMF index,
+    a time series ParaView can open directly (File > Open the .xmf file).
+
+    Each call to write_timestep writes one timestep, so only that timestep needs to
+    be in memory. Arrays are stored chunked and compressed under
+    /pair_<n>/t_<timestep>/{points, cells, strain}. The XDMF index is small and is
+    rewritten on close, or with write_index while a long run is still going.
+
+    An existing file is overwritten, unless resume is set, e.g. by watch mode, to
+    keep its timesteps and append to them. Timestep groups left partially written
+    are then removed.
+
+    Requires h5py.
+    """
+
+    def __init__(self, path, compression: str = "gzip", compression_opts: int = 4,
+                 resume: bool = False):
+        try:
+            import h5py
+        except ImportError as e:
+            raise ImportError("h5py is required to export HDF5/XDMF time series, "
+                              "install it with: pip install h5py") from e
+
+        self.h5_path, self.xdmf_path = output_paths(path)
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.h5_file = h5py.File(self.h5_path, "a" if resume else "w")
+        self.timesteps = {}  # timestep index -> (time, list of grid descriptions)
+
+        if resume:
+            self._resume()
+
+    def _resume(self) -> None:
+        """ Indexes the complete timesteps of an existing file, removing the rest """
+        for pair_name in list(self.h5_file):
+            pair = self.h5_file[pair_name]
+            for timestep_name in list(pair):
+                group = pair[timestep_name]
+                if ("time" not in group.attrs
+                        or any(name not in group for name in TIMESTEP_ARRAYS)):
+                    print(f"Warning: Removing partially written {group.name} "
+                          f"from {self.h5_path}")
+                    del pair[timestep_name]
+                    continue
+                self._add_grid(int(timestep_name[2:]), group.attrs["time"], pair_name,
+                               group)
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _write_array(self, group, name: str, array) -> None:
+        array = np.ascontiguousarray(array)
+        if name in group:
+            del group[name]
+        if array.size == 0:
+            group.create_dataset(name, data=array)
+        else:
+            group.create_dataset(name, data=array, chunks=True,
+                                 compression=self.compression,
+                                 compression_opts=self.compression_opts,
+                                 shuffle=True)
+        return None
+
+    def _add_grid(self, timestep_index: int, time, pair_name: str, group) -> None:
+        _, grids = self.timesteps.setdefault(timestep_index, (time, []))
+        grids[:] = [grid for grid in grids if grid[0] != pair_name]
+        grids.append((pair_name,
+                      group.name,
+                      {name: (dataset.shape, dataset.dtype)
+                       for name, dataset in group.items()}))
+        grids.sort()
+        return None
+
+    @instrumentation.profiled("write")
+    def write_timestep(self, timestep_index: int, datasets, time=None) -> None:
+        """
+        Writes the filtered meshes of one timestep.
+
+        :param timestep_index: Index of the timestep, also the default time value.
+        :param datasets: DICDataset of each stereo pair at this timestep, meshed and
+                         filtered.
+        :param time: Optional time value of the timestep for ParaView.
+        """
+        time = timestep_index if time is None else time
+
+        for stereo_pair_idx, data in enumerate(datasets):
+            pair_name = f"pair_{stereo_pair_idx}"
+            group = self.h5_file.require_group(f"{pair_name}/t_{timestep_index:05d}")
+            group.attrs["time"] = time
+            self._write_array(group, "points", data.coords_filtered)
+            self._write_array(group, "cells", data.simplices_filtered)
+            self._write_array(group, "strain", data.strain_filtered)
+            self._add_grid(timestep_index, time, pair_name, group)
+
+        self.h5_file.flush()
+        return None
+
+    def _data_item(self, group_name: str, name: str, shape, dtype) -> str:
+        dimensions = " ".join(str(dim) for dim in shape)
+        number_type = XDMF_NUMBER_TYPES.get(dtype.kind, 'Float')
+        return (f'<DataItem Dimensions="{dimensions}" NumberType="{number_type}" '
+                f'Precision="{dtype.itemsize}" Format="HDF">'
+                f'{self.h5_path.name}:{group_name}/{name}</DataItem>')
+
+    def write_index(self) -> None:
+        """ Writes the XDMF index of every timestep written so far """
+        lines = ['<?xml version="1.0" ?>',
+                 '<Xdmf Version="3.0">',
+                 ' <Domain>',
+                 '  <Grid Name="DIC" GridType="Collection" CollectionType="Temporal">']
+
+        for timestep_index in sorted(self.timesteps):
+            time, grids = self.timesteps[timestep_index]
+            lines.append(f'   <Grid Name="t_{timestep_index:05d}" GridType="Collection" '
+                         f'CollectionType="Spatial">')
+            lines.append(f'    <Time Value="{time}"/>')
+            for pair_name, group_name, arrays in grids:
+                cells_shape, cells_dtype = arrays["cells"]
+                points_shape, points_dtype = arrays["points"]
+                strain_shape, strain_dtype = arrays["strain"]
+                lines += [
+                    f'    <Grid Name={quoteattr(pair_name)} GridType="Uniform">',
+                    f'     <Topology TopologyType="Triangle" '
+                    f'NumberOfElements="{cells_shape[0]}">',
+                    '      ' + self._data_item(group_name, "cells",
+                                               cells_shape, cells_dtype),
+                    '     </Topology>',
+                    '     <Geometry GeometryType="XYZ">',
+                    '      ' + self._data_item(group_name, "points",
+                                               points_shape, points_dtype),
+                    '     </Geometry>',
+                    '     <Attribute Name="strain" AttributeType="Scalar" Center="Node">',
+                    '      ' + self._data_item(group_name, "strain",
+                                               strain_shape, strain_dtype),
+                    '     </Attribute>',
+                    '    </Grid>',
+                ]
+            lines.append('   </Grid>')
+
+        lines += ['  </Grid>', ' </Domain>', '</Xdmf>']
+
+        # Replace atomically so a viewer never reads a partial index
+        tmp_path = self.xdmf_path.with_suffix(".xmf.tmp")
+        tmp_path.write_text("\n".join(lines) + "\n")
+        tmp_path.replace(self.xdmf_path)
+        return None
+
+    def close(self) -> None:
+        if self.h5_file:
+            self.write_index()
+            self.h5_file.close()
+        return None
+
+
+def export_timesteps(datasets, save_path) -> None:
+    """
+    Writes every timestep of meshed and filtered datasets[stereo_pair][timestep] to
+    an HDF5/XDMF time series, one timestep at a time so lazy stereo pairs only load
+    the timestep being written.
+    """
+    with XDMFWriter(save_path) as writer:
+        for timestep_index in range(len(datasets[0])):
+            writer.write_timestep(timestep_index,
+                                  [stereo_pair[timestep_index] for stereo_pair in datasets])
+        print(f"Exported {len(datasets[0])} timesteps to {writer.xdmf_path}")
+    return None
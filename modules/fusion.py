@@ -0,0 +1,159 @@
+import numpy as np
+import pandas as pd
+
+from modules import instrumentation
+from modules.classes import Config, DICDataset
+from modules.decimation import voxel_clusters
+from modules.processing import (combine_filtered_stereo_pairs,
+                                combine_unfiltered_stereo_pairs,
+                                index_dtype)
+
+
+class FusedPoints:
+    """
+    Point cloud of overlapping stereo pairs with the duplicate points of the overlap
+    regions merged, and the provenance of every fused point.
+
+    :ivar dataset: DICDataset of the fused points.
+    :ivar fused_index: Fused point of every input point, for the input points of
+                       all pairs in order. Input points of pair p are
+                       fused_index[pair_offsets[p]:pair_offsets[p + 1]].
+    :ivar pair_offsets: Start of each pair's input points in fused_index.
+    :ivar source_pair: Pair of the highest weighted input point of each fused point.
+    :ivar source_index: Index of that input point in its pair's unfiltered points.
+    :ivar pair_count: Number of pairs merged into each fused point, 1 outside the
+                      overlap regions.
+    """
+
+    def __init__(self, dataset, fused_index, pair_offsets, source_pair, source_index,
+                 pair_count):
+        self.dataset = dataset
+        self.fused_index = fused_index
+        self.pair_offsets = pair_offsets
+        self.source_pair = source_pair
+        self.source_index = source_index
+        self.pair_count = pair_count
+
+    def pair_fused_index(self, stereo_pair_idx: int):
+        """ Fused point of every input point of one pair """
+        return self.fused_index[self.pair_offsets[stereo_pair_idx]:
+                                self.pair_offsets[stereo_pair_idx + 1]]
+
+
+@instrumentation.profiled("combine")
+def fuse_stereo_pairs(meshes, cell_size: float, weights=None,
+                      filtered: bool = True) -> FusedPoints:
+    """
+    Combines stereo pairs into one cloud, merging points of different pairs which
+    fall in the same cubic cell of a spatial hash.
+
+    Only cells holding points of more than one pair are merged, the points of a
+    single pair are kept as they are, so only the duplicates in the overlap regions
+    are removed. Merged points are the weighted mean of their input points, weighted
+    by the confidence of their pair. Strain is averaged over the non-zero strain
+    points only, so a point masked in one pair keeps the strain measured by another.
+    Every step is a hash or a bincount, linear in the number of points.
+
+    :param meshes: DICDataset of each stereo pair at one timestep.
+    :param cell_size: Cell edge length [mm], e.g. half the vector spacing.
+    :param weights: Optional confidence of each pair, equal by default.
+    :param filtered: Fuse the filtered points, otherwise all points.
+    :return: FusedPoints, with the fused DICDataset filtered to all of its points if
+             filtered is set.
+    """
+    if weights is None:
+        weights = np.ones(len(meshes))
+    weights = np.asarray(weights, dtype=np.float64)
+    if weights.shape[0] != len(meshes):
+        raise ValueError(f"Got {weights.shape[0]} weights for {len(meshes)} stereo pairs")
+
+    if filtered:
+        coords_list = [mesh.coords_filtered for mesh in meshes]
+        strain_list = [mesh.strain_filtered for mesh in meshes]
+    else:
+        coords_list = [mesh.coords for mesh in meshes]
+        strain_list = [mesh.strain for mesh in meshes]
+
+    counts = [coords.shape[0] for coords in coords_list]
+    pair_offsets = np.concatenate([[0], np.cumsum(counts)])
+    coords = np.concatenate(coords_list)
+    strain = np.concatenate(strain_list)
+    n_points = coords.shape[0]
+    dtype = index_dtype(n_points)
+    pair = np.repeat(np.arange(len(meshes), dtype=np.int32), counts)
+
+    # Number of pairs in each cell, from the distinct (cell, pair) combinations
+    cell, n_cells = voxel_clusters(coords, cell_size)
+    _, cell_pairs = pd.factorize(cell.astype(np.int64) * len(meshes) + pair)
+    cell_pair_count = np.bincount(cell_pairs // len(meshes), minlength=n_cells)
+    shared = cell_pair_count[cell] > 1
+
+    # Points in shared cells merge by cell, the rest stay distinct
+    keys = np.where(shared, cell, n_cells + np.arange(n_points, dtype=np.int64))
+    fused_index, uniques = pd.factorize(keys)
+    fused_index = fused_index.astype(dtype, copy=False)
+    n_fused = len(uniques)
+
+    point_weight = weights[pair]
+    total_weight = np.bincount(fused_index, weights=point_weight, minlength=n_fused)
+    fused_coords = np.column_stack([
+        np.bincount(fused_index, weights=point_weight * coords[:, axis],
+                    minlength=n_fused) / np.maximum(total_weight, np.finfo(float).tiny)
+        for axis in range(3)])
+
+    strain_weight = point_weight * (strain != 0)
+    strain_total = np.bincount(fused_index, weights=strain_weight, minlength=n_fused)
+    fused_strain = (np.bincount(fused_index, weights=strain_weight * strain,
+                                minlength=n_fused)
+                    / np.where(strain_total > 0, strain_total, 1.0))
+
+    # Source of each fused point, the first point of its highest weighted pair. Later
+    # writes win, so pairs are written in increasing weight and points in reverse.
+    source = np.empty(n_fused, dtype=dtype)
+    for stereo_pair_idx in sorted(range(len(meshes)), key=lambda p: (weights[p], -p)):
+        points = np.arange(pair_offsets[stereo_pair_idx + 1] - 1,
+                           pair_offsets[stereo_pair_idx] - 1, -1, dtype=dtype)
+        source[fused_index[points]] = points
+    source_pair = pair[source]
+    if filtered:
+        # Back to the pairs' unfiltered numbering
+        source_index = np.concatenate([np.arange(mesh.coords.shape[0])[mesh.filtered_index]
+                                       for mesh in meshes])[source]
+    else:
+        source_index = source - pair_offsets[source_pair]
+
+    pair_count = np.ones(n_fused, dtype=np.int32)
+    pair_count[fused_index[shared]] = cell_pair_count[cell[shared]]
+
+    fused_data = DICDataset(fused_coords.astype(coords.dtype, copy=False),
+                            fused_strain.astype(strain.dtype, copy=False))
+    if filtered:
+        # Every fused point is a filtered point
+        fused_data.filtered_index = slice(None)
+
+    instrumentation.count("points merged by fusion", n_points - n_fused)
+
+    return FusedPoints(fused_data, fused_index, pair_offsets, source_pair,
+                       source_index.astype(dtype, copy=False), pair_count)
+
+
+def combine_stereo_pairs(meshes, config: Config = None, filtered: bool = False):
+    """
+    Combines the stereo pairs of one timestep, fused with fuse_stereo_pairs if
+    config.fusion_cell_size is set, otherwise concatenated.
+
+    :param meshes: DICDataset of each stereo pair at one timestep.
+    :param config: Config, fusion_cell_size and fusion_weights are used.
+    :param filtered: Combine the filtered points, otherwise all points.
+    :return: Combined DICDataset.
+    """
+    config = config or Config()
+    if config.fusion_cell_size is None:
+        if filtered:
+            return combine_filtered_stereo_pairs(meshes)
+        return combine_unfiltered_stereo_pairs(meshes)
+
+    return fuse_stereo_pairs(meshes,
+                             cell_size=config.fusion_cell_size,
+                             weights=config.fusion_weights,
+                             filtered=filtered).dataset
@@ -0,0 +1,223 @@
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from modules import instrumentation
+from modules.classes import Config, DICDataset
+from modules.processing import create_mesh, filter_data
+
+# Directories a strain history could not be written to, warned about once
+_UNWRITABLE_DIRS = set()
+
+
+class StrainHistory:
+    """
+    Strain of every point of one stereo pair over time, as a (timesteps, points)
+    array backed by a memory-mapped .npy file, for stereo pairs whose points stay
+    the same over the test.
+
+    Queries are NumPy reductions over the time axis, run over blocks of points so
+    only a block is in memory at once, block_points sets the points per block.
+    Strain == 0 is a masked reading, as in the filters, and is left out of the
+    queries. Derived per point values can be turned into a DICDataset with
+    to_dataset and shown with the plotting functions.
+
+    :param strain: (timesteps, points) array, usually memory-mapped.
+    :param coords: (points, 3) coordinates of the points, from the first timestep.
+    :param times: Optional time of each timestep, the timestep index by default.
+    """
+
+    def __init__(self, strain, coords, times=None):
+        self.strain = strain
+        self.coords = coords
+        self.times = (np.arange(strain.shape[0], dtype=np.float64) if times is None
+                      else np.asarray(times, dtype=np.float64))
+        if self.times.shape[0] != strain.shape[0]:
+            raise ValueError(f"Got {self.times.shape[0]} times for "
+                             f"{strain.shape[0]} timesteps")
+
+    @property
+    def shape(self):
+        return self.strain.shape
+
+    @staticmethod
+    def key(paths) -> str:
+        """ Key of a stereo pair's files, changes if any file is rewritten """
+        tokens = []
+        for path in paths:
+            stat = os.stat(path)
+            tokens.append(f"{Path(path).resolve()}|{stat.st_size}|{stat.st_mtime_ns}")
+        return hashlib.sha1("\n".join(tokens).encode()).hexdigest()
+
+    @classmethod
+    @instrumentation.profiled("strain history")
+    def from_stereo_pair(cls, stereo_pair, path, tolerance: float = 1e-6,
+                         dtype=np.float32) -> "StrainHistory":
+        """
+        Stacks the strain of every timestep of a stereo pair into a memory-mapped
+        file, one timestep at a time. An existing file of the right shape is opened
+        instead, and the history is kept in memory if the file cannot be written.
+
+        :param stereo_pair: List of DICDatasets or LazyStereoPair.
+        :param path: Path of the .npy file.
+        :param tolerance: [mm] max (x, y) offset of a point from the first timestep.
+        :param dtype: Storage dtype, float32 halves the file of float64 strain.
+        :raises ValueError: If the points change between timesteps.
+        """
+        path = Path(path)
+        first = stereo_pair[0]
+        shape = (len(stereo_pair), first.coords.shape[0])
+
+        try:
+            strain = np.load(path, mmap_mode='r')
+        except (FileNotFoundError, ValueError, OSError):
+            strain = None
+        if strain is not None and strain.shape == shape and strain.dtype == np.dtype(dtype):
+            try:
+                os.utime(path)  # Mark as recently used for the cache eviction
+            except OSError:
+                pass  # Read-only cache, still usable
+            instrumentation.count("strain history hits")
+            return cls(strain, first.coords)
+
+        tmp = path.with_name(f"{path.stem}.{os.getpid()}.tmp")
+        try:
+            if path.parent in _UNWRITABLE_DIRS:
+                raise PermissionError(f"{path.parent} is not writable")
+            path.parent.mkdir(parents=True, exist_ok=True)
+            strain = np.lib.format.open_memmap(tmp, mode='w+', dtype=dtype, shape=shape)
+        except OSError as e:
+            # E.g. a read-only mount, build the history in memory instead
+            if path.parent not in _UNWRITABLE_DIRS:
+                _UNWRITABLE_DIRS.add(path.parent)
+                print(f"Warning: Could not write strain histories to {path.parent}, "
+                      f"keeping them in memory")
+                print(f"Exception: {e}")
+            tmp = None
+            strain = np.empty(shape, dtype=dtype)
+        reference = first.coords[:, :2]
+        try:
+            for timestep_index, timestep_data in enumerate(stereo_pair):
+                coords = timestep_data.coords
+                if (coords.shape[0] != shape[1]
+                        or np.abs(coords[:, :2] - reference).max() > tolerance):
+                    raise ValueError(f"points of timestep {timestep_index} differ "
+                                     f"from the first timestep")
+                strain[timestep_index] = timestep_data.strain
+            if tmp is None:
+                return cls(strain, first.coords)
+            strain.flush()
+        except BaseException:
+            del strain
+            if tmp is not None:
+                tmp.unlink()
+            raise
+        del strain
+        os.replace(tmp, path)
+
+        return cls(np.load(path, mmap_mode='r'), first.coords)
+
+    def _blocks(self, block_points: int = None):
+        """ Blocks of points over all timesteps as float64, about 64 MB at once """
+        if block_points is None:
+            block_points = max(1, 2 ** 26 // (8 * self.shape[0]))
+        for start in range(0, self.shape[1], block_points):
+            block = np.asarray(self.strain[:, start:start + block_points],
+                               dtype=np.float64)
+            yield start, block, block != 0
+
+    def valid(self, block_points: int = None):
+        """ Points with at least one non-zero strain reading """
+        result = np.zeros(self.shape[1], dtype=bool)
+        for start, _, valid in self._blocks(block_points):
+            result[start:start + valid.shape[1]] = valid.any(axis=0)
+        return result
+
+    def max(self, block_points: int = None):
+        """ Maximum strain of every point, nan if it has no reading """
+        result = np.full(self.shape[1], np.nan)
+        for start, block, valid in self._blocks(block_points):
+            block[~valid] = -np.inf
+            block_max = block.max(axis=0)
+            block_max[np.isneginf(block_max)] = np.nan
+            result[start:start + block.shape[1]] = block_max
+        return result
+
+    def first_exceedance(self, threshold: float, block_points: int = None):
+        """
+        Index of the first timestep at which each point's strain is at least the
+        threshold, -1 if it never is. Use times[index] for the time.
+        """
+        result = np.full(self.shape[1], -1, dtype=np.int64)
+        for start, block, valid in self._blocks(block_points):
+            exceeds = (block >= threshold) & valid
+            first = exceeds.argmax(axis=0)
+            first[~exceeds.any(axis=0)] = -1
+            result[start:start + block.shape[1]] = first
+        return result
+
+    def rate(self, timestep_index: int = None, block_points: int = None):
+        """
+        Rate of change of strain per unit time, from differences between
+        consecutive timesteps with readings.
+
+        :param timestep_index: Rate at this timestep, from the previous one, or None
+                               for the maximum rate of every point over the test.
+        :return: Rate of every point, nan where it is undefined.
+        """
+        dt = np.diff(self.times)
+        if timestep_index is not None:
+            if not 1 <= timestep_index < self.shape[0]:
+                raise IndexError("rate needs a timestep after the first")
+            now = np.asarray(self.strain[timestep_index], dtype=np.float64)
+            before = np.asarray(self.strain[timestep_index - 1], dtype=np.float64)
+            rate = (now - before) / dt[timestep_index - 1]
+            rate[(now == 0) | (before == 0)] = np.nan
+            return rate
+
+        result = np.full(self.shape[1], np.nan)
+        for start, block, valid in self._blocks(block_points):
+            rates = np.diff(block, axis=0) / dt[:, None]
+            rates[~(valid[1:] & valid[:-1])] = -np.inf
+            block_max = rates.max(axis=0, initial=-np.inf)
+            block_max[np.isneginf(block_max)] = np.nan
+            result[start:start + block.shape[1]] = block_max
+        return result
+
+    def to_dataset(self, values, config: Config = None) -> DICDataset:
+        """
+        A derived per point field as a meshed DICDataset on the reference points,
+        e.g. history.to_dataset(history.max()), filtered to the points with a finite
+        value and a strain reading so it can be plotted like a timestep.
+
+        :param values: Array of one value per point, used as the strain.
+        :param config: Config for the mesh mode.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if values.shape != (self.shape[1],):
+            raise ValueError(f"Expected {self.shape[1]} values, got {values.shape}")
+
+        keep = np.isfinite(values) & self.valid()
+
+        # Mesh on the kept points, values may well be 0, e.g. a timestep index
+        dataset = DICDataset(self.coords, keep.astype(np.float64))
+        create_mesh(dataset, config=config)
+        dataset.strain = values
+        filter_data(dataset, keep)
+        return dataset
+
+
+def history_path(paths, config: Config) -> Path:
+    """
+    Where the strain history of a stereo pair's files is kept: the import cache
+    directory if caching is enabled, otherwise the temporary directory.
+    """
+    if config.cache_enabled:
+        cache_dir = (Path(config.cache_dir) if config.cache_dir is not None
+                     else Path(paths[0]).parent / ".dic_cache")
+    else:
+        cache_dir = Path(tempfile.gettempdir())
+    return cache_dir / f"history_{StrainHistory.key(paths)}.npy"
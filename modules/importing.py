@@ -1,12 +1,24 @@
+import csv
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path  # Importing filenames
+
+import numpy as np
 import pandas as pd
 
-from modules.classes import DICDataset, Config
+from modules import instrumentation
+from modules.caching import DatasetCache
+from modules.classes import (DICDataset, DICCollection, DatasetFields, Config,
+                             LazyStereoPair)
+from modules.history import StrainHistory, history_path
 
 
-def get_csv_file_paths(directories: list[str]) -> list[list[str]]:
+def get_csv_file_paths(directories: list[str], check_counts: bool = True) -> list[list[str]]:
     """ for given directories imports all csv files into a list where each element is
-    the directory"""
+    the directory. check_counts warns if the directories hold different numbers of
+    files, which is expected while a test is still being recorded."""
 
     dataset_paths = [
         sorted(
@@ -18,12 +30,69 @@ def get_csv_file_paths(directories: list[str]) -> list[list[str]]:
 
     # Check len of files is same for each directory
     file_cnt = [len(dataset) for dataset in dataset_paths]
-    if len(set(file_cnt)) != 1:
+    if check_counts and len(set(file_cnt)) != 1:
         print(f"Warning: Found {len(set(file_cnt))} files in {directories}")
 
     return dataset_paths
 
 
+# Field name -> column header of the LaVision fields known by name. Columns of a file
+# which are not in here are still available under their header.
+LAVISION_FIELDS = {
+    'x': 'x[mm]',
+    'y': 'y[mm]',
+    'z': 'z[mm]',
+    'displacement_x': 'Displacement x[mm]',
+    'displacement_y': 'Displacement y[mm]',
+    'displacement_z': 'Displacement z[mm]',
+    'displacement': 'Displacement[mm]',
+    'strain': 'Maximum normal strain - RC[S]',
+    'minimum_strain': 'Minimum normal strain - RC[S]',
+    'shear_strain': 'Maximum shear strain - RC[S]',
+    'von_mises_strain': 'von Mises strain - RC[S]',
+}
+
+LAVISION_COLUMNS = ['x[mm]', 'y[mm]', 'z[mm]', 'Maximum normal strain - RC[S]']
+
+
+def read_header(path) -> list[str]:
+    """ Column headers of a CSV file, read from its first line only """
+    with open(path, newline='') as f:
+        return [column.strip() for column in next(csv.reader(f), [])]
+
+
+def field_columns(header: list[str]) -> dict:
+    """
+    Field name -> column header of every column in a file header, by its
+    LAVISION_FIELDS name if it has one, otherwise by the header itself.
+    """
+    names = {column: name for name, column in LAVISION_FIELDS.items()}
+    return {names.get(column, column): column for column in header}
+
+
+def available_fields(path) -> list[str]:
+    """ Names of the fields of a file, found from the header without parsing it """
+    return list(field_columns(read_header(path)))
+
+
+def load_column(path, column: str, config: Config):
+    """
+    Loads one column of a file, from the binary cache if enabled, otherwise parsed
+    from the CSV on its own and then cached.
+    """
+    dtype = np.float32 if config.import_float32 else np.float64
+    cache = get_cache(path, config)
+    values = cache.load(path, [column], dtype) if cache is not None else None
+    if values is None:
+        values = pd.read_csv(path, usecols=[column], dtype={column: dtype})[column]
+        values = values.to_numpy(dtype=dtype)
+        if cache is not None:
+            cache.store(path, [column], dtype, values)
+    instrumentation.count("fields loaded")
+    return values
+
+
+@instrumentation.profiled("import")
 def import_data(path, import_type: str, config: Config) -> DICDataset:
     """
     Loads a vector field file into a DICDataset object and puts it in a list. The vector
@@ -31,43 +100,180 @@ def import_data(path, import_type: str, config: Config) -> DICDataset:
     coordinates along with the associated strain values. This import currently imports
     a single timestep.
 
+    Only the coordinates and the config.strain_field column are parsed, as float32 if
+    config.import_float32 is set. The other fields in the file header are loaded on
+    first access through the dataset's fields.
     """
     # Initialise
     imported_data = DICDataset()
 
-    csv_df = pd.read_csv(path)
+    if import_type != 'LAVision':
+        print(f"Warning: incorrect import_type: {import_type}")
+        return imported_data
 
-    if config.debug:
-        print(config.print_sep)
-        print(f"Loaded: {path}")
-        print(f"Shape: {csv_df.shape}")
-        print(f"Columns Found: {csv_df.columns}")
+    dtype = np.float32 if config.import_float32 else np.float64
+    try:
+        columns = field_columns(read_header(path))
+    except OSError as e:
+        print(f"Warning: Could not read {path}")
+        print(f"Exception: {e}")
+        return imported_data
+    # The strain field by name, or by column header
+    strain_column = columns.get(config.strain_field, config.strain_field)
+    strain_name = next((name for name, column in columns.items()
+                        if column == strain_column), config.strain_field)
+    expected_cols = LAVISION_COLUMNS[:3] + [strain_column]
 
-    if import_type == 'LAVision':
+    cache = get_cache(path, config)
+    data = cache.load(path, expected_cols, dtype) if cache is not None else None
 
-        # Check columns and place data into lists of separate numpy arrays
-        expected_cols = ['x[mm]', 'y[mm]', 'z[mm]', 'Maximum normal strain - RC[S]']
-        if all(col in csv_df.columns for col in expected_cols):
-            imported_data.x = csv_df["x[mm]"].to_numpy()
-            imported_data.y = csv_df["y[mm]"].to_numpy()
-            imported_data.z = csv_df["z[mm]"].to_numpy()
-            imported_data.strain = csv_df["Maximum normal strain - RC[""S]"].to_numpy()
-        else:
+    if data is None:
+        try:
+            csv_df = pd.read_csv(path,
+                                 usecols=expected_cols,
+                                 dtype={col: dtype for col in expected_cols})
+        except ValueError:
+            # usecols raises if any of the expected columns are missing
             print(f"Warning: Missing columns in {path}. Columns expected: "
                   f"{expected_cols}")
+            return imported_data
+
+        data = csv_df[expected_cols].to_numpy(dtype=dtype)
+        if cache is not None:
+            cache.store(path, expected_cols, dtype, data)
+            instrumentation.count("import cache misses")
     else:
-        print(f"Warning: incorrect import_type: {import_type}")
+        instrumentation.count("import cache hits")
+
+    # Coordinates and strain are copied out of the (memory-mapped) table once, as
+    # contiguous arrays
+    imported_data.set_points(data[:, :3], data[:, 3])
+    imported_data.fields = DatasetFields(partial(load_column, path, config=config),
+                                         columns,
+                                         strain_name=strain_name)
 
     return imported_data
 
+
+def get_cache(path, config: Config):
+    """ Returns the DatasetCache for a data file, or None if caching is disabled """
+    if not config.cache_enabled:
+        return None
+    cache_dir = config.cache_dir
+    if cache_dir is None:
+        cache_dir = Path(path).parent / ".dic_cache"
+    return DatasetCache.shared(cache_dir, max_bytes=config.cache_max_bytes)
+
+
+def _import_lavision(path, config: Config) -> DICDataset:
+    """ Module level wrapper so import_data can be sent to a process pool """
+    return import_data(path=path, import_type='LAVision', config=config)
+
+
+def _timed_import_lavision(path, config: Config):
+    """ _import_lavision for process pools, returns its timing for the profiler """
+    start = time.perf_counter()
+    imported_data = _import_lavision(path, config)
+    return imported_data, start, time.perf_counter() - start, os.getpid()
+
+
 def load_multiple_stereo_pairs(stereo_pair_dirs: list[str], config: Config):
+    """
+    Imports every timestep of every stereo pair directory.
 
+    With config.import_workers > 1 (or None for all cores) the files are parsed in a
+    process or thread pool, set by config.import_executor. The result is always
+    ordered as datasets[stereo_pair][timestep].
+
+    With config.lazy_loading each stereo pair is a LazyStereoPair instead, which
+    imports timesteps on first access and keeps config.max_resident_timesteps loaded.
+
+    With config.strain_history the (timesteps, points) strain history of each stereo
+    pair is also built, see build_strain_histories.
+
+    With config.timesteps set to a slice only those timesteps are imported, and
+    numbered from 0 in the result.
+
+    :return: DICCollection of the stereo pairs, whose stats are filled in as the
+             timesteps are filtered.
+    """
     stereo_pair_fpaths = get_csv_file_paths(stereo_pair_dirs)
+    if config.timesteps is not None:
+        stereo_pair_fpaths = [stereo_pair[config.timesteps]
+                              for stereo_pair in stereo_pair_fpaths]
+
+    if config.lazy_loading:
+        loader = partial(_import_lavision, config=config)
+        datasets = DICCollection(LazyStereoPair(stereo_pair,
+                                                loader,
+                                                max_resident=config.max_resident_timesteps,
+                                                prefetch=config.prefetch)
+                                 for stereo_pair in stereo_pair_fpaths)
+        if config.strain_history:
+            build_strain_histories(datasets, stereo_pair_fpaths, config)
+        return datasets
+
+    # Flatten to one task per file so the pool balances across pairs
+    fpaths = [path for stereo_pair in stereo_pair_fpaths for path in stereo_pair]
+
+    workers = config.import_workers
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers <= 1 or len(fpaths) <= 1:
+        imported = [_import_lavision(path, config) for path in fpaths]
+    else:
+        if config.import_executor == "thread":
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                # map preserves the submission order
+                imported = list(executor.map(_import_lavision,
+                                             fpaths,
+                                             [config] * len(fpaths)))
+        else:
+            chunksize = max(1, len(fpaths) // (4 * workers))
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(_timed_import_lavision,
+                                            fpaths,
+                                            [config] * len(fpaths),
+                                            chunksize=chunksize))
+            imported = []
+            for imported_data, start, duration, pid in results:
+                instrumentation.PROFILER.record("import", start, duration, pid=pid,
+                                                tid=pid)
+                imported.append(imported_data)
+
+    instrumentation.count("timesteps imported", len(imported))
 
     # Put each dataset with all timesteps in a list of stereo pairs where each index is a
     # stereo pair, and each stereo pair is a list of timesteps for that pair.
-    datasets = [[import_data(path=timestep, import_type='LAVision', config=config)
-                 for timestep in stereo_pair]
-                for stereo_pair in stereo_pair_fpaths]
+    datasets = DICCollection()
+    start = 0
+    for stereo_pair in stereo_pair_fpaths:
+        datasets.append(imported[start:start + len(stereo_pair)])
+        start += len(stereo_pair)
 
-    return datasets
\ No newline at end of file
+    if config.strain_history:
+        build_strain_histories(datasets, stereo_pair_fpaths, config)
+
+    return datasets
+
+
+def build_strain_histories(datasets, stereo_pair_fpaths, config: Config) -> None:
+    """
+    Builds the memory-mapped StrainHistory of every stereo pair into
+    datasets.histories, None for pairs whose points change over time.
+    """
+    datasets.histories = []
+    for stereo_pair_idx, (stereo_pair, fpaths) in enumerate(zip(datasets,
+                                                                stereo_pair_fpaths)):
+        try:
+            history = StrainHistory.from_stereo_pair(
+                stereo_pair,
+                history_path(fpaths, config),
+                tolerance=config.triangulation_tolerance)
+        except ValueError as e:
+            print(f"Warning: No strain history for stereo pair {stereo_pair_idx}")
+            print(f"Exception: {e}")
+            history = None
+        datasets.histories.append(history)
+    return None
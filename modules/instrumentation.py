@@ -0,0 +1,208 @@
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+from functools import wraps
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Shared context manager returned while disabled, so a disabled span costs one check
+_NULL_SPAN = nullcontext()
+
+
+def peak_rss_bytes():
+    """ Peak resident set size of this process, None where it is not available """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, kilobytes on Linux
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class _Span:
+    __slots__ = ('profiler', 'name', 'args', 'start')
+
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.record(self.name, self.start, time.perf_counter() - self.start,
+                             args=self.args)
+        return False
+
+
+class Profiler:
+    """
+    Records timing spans and counters for the pipeline stages (import, mesh, filter,
+    combine, plot build, write).
+
+    Disabled by default, span() then returns a shared no-op context manager and
+    count() returns immediately. When enabled every span is kept, so per-item times
+    are available, and the peak RSS is sampled as spans end. At the end of a run
+    summary() gives a table per stage and write_chrome_trace() a file for
+    chrome://tracing or https://ui.perfetto.dev.
+
+    Spans timed in worker processes are added with record(), perf_counter is
+    system-wide on the supported platforms so they line up with the parent's.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []  # (name, start, duration, pid, tid, args)
+        self.counters = defaultdict(int)
+        self.rss_samples = []  # (time, peak rss bytes)
+        self.start_time = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def enable(self) -> None:
+        self.enabled = True
+        self.start_time = time.perf_counter()
+        return None
+
+    def disable(self) -> None:
+        self.enabled = False
+        return None
+
+    def reset(self) -> None:
+        with self._lock:
+            self.events.clear()
+            self.counters.clear()
+            self.rss_samples.clear()
+        self.start_time = time.perf_counter()
+        return None
+
+    def span(self, name: str, **args):
+        """ Context manager timing a block, e.g. with PROFILER.span("mesh", pair=0): """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, args)
+
+    def profiled(self, name: str):
+        """ Decorator timing every call of a function as a span """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with _Span(self, name, {}):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, name: str, value: int = 1) -> None:
+        if not self.enabled:
+            return None
+        with self._lock:
+            self.counters[name] += value
+        return None
+
+    def record(self, name: str, start: float, duration: float, pid=None, tid=None,
+               args=None) -> None:
+        """ Adds a span, e.g. one timed in a worker process """
+        if not self.enabled:
+            return None
+        event = (name, start, duration,
+                 os.getpid() if pid is None else pid,
+                 threading.get_ident() if tid is None else tid,
+                 args or {})
+        rss = peak_rss_bytes()
+        with self._lock:
+            self.events.append(event)
+            if rss is not None:
+                self.rss_samples.append((start + duration, rss))
+        return None
+
+    def stage_totals(self) -> dict:
+        """ Per span name: count, total, mean and max duration in seconds """
+        durations = defaultdict(list)
+        for name, _, duration, _, _, _ in self.events:
+            durations[name].append(duration)
+        return {name: {'count': len(values),
+                       'total_s': sum(values),
+                       'mean_s': sum(values) / len(values),
+                       'max_s': max(values)}
+                for name, values in durations.items()}
+
+    def summary(self) -> str:
+        wall = time.perf_counter() - self.start_time
+        lines = [f"{'stage':<24}{'count':>8}{'total s':>11}{'mean ms':>11}"
+                 f"{'max ms':>11}{'% wall':>8}"]
+        totals = sorted(self.stage_totals().items(), key=lambda item: -item[1]['total_s'])
+        for name, stats in totals:
+            lines.append(f"{name:<24}{stats['count']:>8}{stats['total_s']:>11.3f}"
+                         f"{stats['mean_s'] * 1e3:>11.2f}{stats['max_s'] * 1e3:>11.2f}"
+                         f"{100 * stats['total_s'] / wall:>8.1f}")
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"{name:<24}{value:>8}")
+        rss = peak_rss_bytes()
+        lines.append(f"wall {wall:.3f} s"
+                     + ("" if rss is None else f", peak RSS {rss / 1e6:.1f} MB"))
+        return "\n".join(lines)
+
+    def to_dict(self) -> dict:
+        return {'wall_s': time.perf_counter() - self.start_time,
+                'peak_rss_bytes': peak_rss_bytes(),
+                'stages': self.stage_totals(),
+                'counters': dict(self.counters)}
+
+    def write_json(self, path) -> None:
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+        return None
+
+    def write_chrome_trace(self, path) -> None:
+        """ Writes the spans and peak RSS in the Chrome trace event format """
+        def microseconds(seconds):
+            return (seconds - self.start_time) * 1e6
+
+        trace_events = [{'name': name, 'ph': 'X', 'ts': microseconds(start),
+                         'dur': duration * 1e6, 'pid': pid, 'tid': tid,
+                         'args': {key: str(value) for key, value in args.items()}}
+                        for name, start, duration, pid, tid, args in self.events]
+        trace_events += [{'name': 'peak_rss', 'ph': 'C', 'ts': microseconds(sample_time),
+                          'pid': os.getpid(), 'args': {'MB': rss / 1e6}}
+                         for sample_time, rss in self.rss_samples]
+
+        with open(path, "w") as f:
+            json.dump({'traceEvents': trace_events,
+                       'displayTimeUnit': 'ms',
+                       'otherData': self.to_dict()}, f)
+        return None
+
+
+# Profiler shared by all modules, enabled with enable(config)
+PROFILER = Profiler()
+span = PROFILER.span
+count = PROFILER.count
+profiled = PROFILER.profiled
+
+
+def enable(config) -> None:
+    """ Enables the shared profiler if config.profile is set """
+    if config.profile:
+        PROFILER.enable()
+    return None
+
+
+def report(config) -> None:
+    """ Prints the summary and writes the trace file at the end of a run, if enabled """
+    if not PROFILER.enabled:
+        return None
+    print(config.print_sep)
+    print(PROFILER.summary())
+    if config.profile_path:
+        PROFILER.write_chrome_trace(config.profile_path)
+        print(f"Trace written to {config.profile_path}")
+    return None
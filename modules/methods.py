@@ -1,12 +1,193 @@
-from modules.processing import (create_delaunay_mesh,
+from functools import partial
+
+from modules.processing import (NeighbourCache,
+                                TriangulationCache,
+                                create_mesh,
+                                filter_mesh_quality,
                                 filter_strain0_data,
-                                filter_strain0_points,
-                                combine_filtered_stereo_pairs,
-                                combine_unfiltered_stereo_pairs)
-from modules import plotting
+                                filter_strain0_neighbours,
+                                filter_strain0_points)
+from modules import importing, plotting
+from modules.exporting import XDMFWriter, export_timesteps
+from modules.fusion import combine_stereo_pairs
+from modules.resampling import Resampler, fuse_resampled
+from modules.scheduling import mesh_filter_timesteps
+from modules.classes import Config, DICCollection, LazyStereoPair
+from modules.pipeline import Pipeline, Stage
+
+
+def _triangulation_cache(config: Config):
+    """ Returns a TriangulationCache if enabled in the config, otherwise None """
+    if not config.reuse_triangulation:
+        return None
+    return TriangulationCache(tolerance=config.triangulation_tolerance)
+
+
+# Config fields read by the memoized pipeline stages, the only ones in their memo keys
+IMPORT_FIELDS = ('strain_field', 'import_float32', 'import_workers', 'import_executor',
+                 'lazy_loading', 'max_resident_timesteps', 'prefetch', 'timesteps',
+                 'strain_history', 'triangulation_tolerance', 'cache_enabled',
+                 'cache_dir', 'cache_max_bytes')
+MESH_FIELDS = ('mesh_mode', 'mesh_skip_strain0', 'grid_tolerance', 'reuse_triangulation',
+               'triangulation_tolerance', 'mesh_workers')
+FUSION_FIELDS = ('fusion_cell_size', 'fusion_weights')
+RESAMPLE_FIELDS = ('resample_spacing', 'resample_weights') + MESH_FIELDS
+NEIGHBOUR_FIELDS = FUSION_FIELDS + ('neighbour_count', 'neighbour_workers',
+                                    'triangulation_tolerance')
+QUALITY_FIELDS = MESH_FIELDS + ('mesh_max_edge', 'mesh_max_edge_factor', 'mesh_max_aspect',
+                                'mesh_max_circumradius')
+
+
+def copy_datasets(datasets) -> DICCollection:
+    """
+    Copies of the stereo pairs sharing the point arrays, to mesh and filter without
+    modifying the originals. Lazy stereo pairs are copied with their transforms.
+    """
+    copied = DICCollection(stereo_pair[:] if isinstance(stereo_pair, LazyStereoPair)
+                           else [data.copy() for data in stereo_pair]
+                           for stereo_pair in datasets)
+    copied.histories = getattr(datasets, 'histories', None)
+    return copied
+
+
+def mesh_filter_datasets(datasets, config: Config):
+    """
+    Meshes and filters strain == 0 simplices of every timestep of every
+    stereo pair, in place. Lazy stereo pairs are meshed and filtered as each
+    timestep is loaded instead. The statistics of a DICCollection are updated as
+    the timesteps are filtered.
+
+    :return: The same datasets, so the pipeline can name the meshed state.
+    """
+    tri_cache = _triangulation_cache(config)
+
+    if any(isinstance(stereo_pair, LazyStereoPair) for stereo_pair in datasets):
+        mesh = partial(create_mesh, config=config, cache=tri_cache)
+        for stereo_pair in datasets:
+            # Mesh and filter each timestep as it is loaded, so it survives eviction
+            stereo_pair.add_transform(mesh)
+            stereo_pair.add_transform(filter_strain0_data)
+            if getattr(datasets, 'stats', None) is not None:
+                # Timesteps loaded again after eviction are counted again, which
+                # leaves the min and max exact and barely moves the percentiles
+                stereo_pair.add_transform(datasets.stats.update)
+    else:
+        mesh_filter_timesteps(datasets, config, tri_cache=tri_cache)
+        if tri_cache is not None and tri_cache.misses:
+            # Serial meshing only, worker processes keep their own caches
+            print(f"Triangulation cache: {tri_cache.stats()}")
+
+    return datasets
+
+
+def mesh_filter_timestep(datasets, timestep_index: int, config: Config) -> DICCollection:
+    """
+    Meshes and filters strain == 0 simplices of copies of one timestep of every
+    stereo pair, leaving the datasets unchanged.
+
+    :return: DICCollection of the stereo pairs with only that timestep, at index 0.
+    """
+    tri_cache = _triangulation_cache(config)
+    meshed = DICCollection()
+    for stereo_pair in datasets:
+        data = stereo_pair[timestep_index].copy()
+        create_mesh(data, config=config, cache=tri_cache)
+        filter_strain0_data(data)
+        meshed.stats.update(data)
+        meshed.append([data])
+    return meshed
+
+
+def select_timestep(meshed_datasets, datasets, timestep_index: int,
+                    config: Config) -> DICCollection:
+    """
+    One timestep of already meshed and filtered datasets, in the form of
+    mesh_filter_timestep, so it is not meshed again.
+    """
+    selected = DICCollection()
+    for stereo_pair in meshed_datasets:
+        data = stereo_pair[timestep_index]
+        selected.stats.update(data)
+        selected.append([data])
+    return selected
+
+
+def plot_animated_meshes(datasets, plot_save_path, config: Config) -> None:
+    """
+    Plots or exports the meshed and filtered timesteps of every stereo pair. With
+    config.plot_per_timestep each timestep is written to its own file in a directory
+    named after plot_save_path, with an index page.
+    """
+    if config.output_format == "xdmf":
+        # Stream the meshes to a time series ParaView can open
+        export_timesteps(datasets, plot_save_path)
+    elif config.plot_per_timestep:
+        plotting.write_timestep_figures(datasets,
+                                        plotting.timestep_figures_dir(plot_save_path),
+                                        max_vertices=config.plot_max_vertices,
+                                        strain_percentiles=config.plot_strain_percentiles,
+                                        workers=config.plot_workers)
+    else:
+        # Plot the meshes per timestep in interactive plot
+        plotting.create_animated_mesh(datasets,
+                                      z_scale=1,
+                                      plot_save_path=plot_save_path,
+                                      max_vertices=config.plot_max_vertices,
+                                      encoding=config.plot_encoding,
+                                      strain_percentiles=config.plot_strain_percentiles,
+                                      grid_tolerance=config.grid_tolerance,
+                                      show=config.show_plots)
+    return None
+
+
+def combine_filter_points(datasets, timestep_index: int, config: Config = None):
+    """
+    Combines the stereo pairs of one timestep, fusing their overlaps if set in the
+    config, and filters out strain == 0 points
+    """
+    print("Combining stereo pairs...")
+    combined_data = combine_stereo_pairs(
+        [stereo_pair[timestep_index] for stereo_pair in datasets], config)
+    print("Filtering strain == 0 points...")
+    filter_strain0_points(combined_data)
+    return combined_data
 
 
-def timesteps_combine_filter_neighbours_mesh_filter_plot(datasets):
+def resample_fuse_datasets(datasets, config: Config = None) -> DICCollection:
+    """
+    Resamples every timestep of every stereo pair onto one regular grid covering
+    the first timestep of all the pairs, and fuses the pairs node by node.
+
+    The barycentric weights of the grid nodes are computed once per point layout,
+    so each further timestep of a pair is two sparse matrix-vector products.
+
+    :param datasets: datasets[stereo_pair][timestep], unmeshed.
+    :param config: Config, resample_spacing and resample_weights are used.
+    :return: The fused timesteps as a single stereo pair, meshed and filtered.
+    """
+    config = config or Config()
+    resampler = Resampler.covering([stereo_pair[0] for stereo_pair in datasets],
+                                   spacing=config.resample_spacing,
+                                   config=config)
+    print(f"Resampling onto a {resampler.grid_x.shape[0]} x "
+          f"{resampler.grid_y.shape[0]} grid...")
+
+    resampled = DICCollection()
+    fused_timesteps = []
+    for timestep_index in range(len(datasets[0])):
+        fused = fuse_resampled(resampler.resample_timestep(datasets, timestep_index),
+                               weights=config.resample_weights)
+        resampled.stats.update(fused)
+        fused_timesteps.append(fused)
+    resampled.append(fused_timesteps)
+
+    print(f"Resampling weights cache: {resampler.weights_cache.stats()}")
+    return resampled
+
+
+def timesteps_combine_filter_neighbours_mesh_filter_plot(datasets,
+                                                         plot_save_path=None,
+                                                         config: Config = None):
     """
     Method:
     1. Combine point clouds
@@ -19,66 +200,231 @@ def timesteps_combine_filter_neighbours_mesh_filter_plot(datasets):
     5. Plot
 
     This may remove the issues with mesh_filter_plot_combined().
+
+    Neighbours are found with a KD-tree in the first timestep and reused for the
+    later timesteps sharing its (x, y) layout, see NeighbourCache. Overlapping points
+    of the stereo pairs are merged if config.fusion_cell_size is set. With
+    config.output_format "xdmf" each combined timestep is exported to an HDF5/XDMF
+    time series as it is meshed.
     """
+    config = config or Config()
+
+    print(str(20 * '='))
+    print(f"Starting timesteps combine neighbour filtering for {len(datasets)} datasets")
+
+    if config.output_format == "xdmf":
+        # Stream each combined timestep to disk, the combined cloud as one pair
+        neighbour_cache = _neighbour_cache(config)
+        tri_cache = _triangulation_cache(config)
+        with XDMFWriter(plot_save_path) as writer:
+            for timestep_index in range(len(datasets[0])):
+                combined_data = combine_filter_neighbours(datasets, timestep_index,
+                                                          config, neighbour_cache)
+                create_mesh(combined_data, config=config, cache=tri_cache)
+                filter_strain0_data(combined_data)
+                writer.write_timestep(timestep_index, [combined_data])
+        print(f"Neighbour cache: {neighbour_cache.stats()}")
+        return None
+
+    # Plot the combined mesh as a single stereo pair
+    combined = mesh_filter_datasets(combine_filter_neighbours_datasets(datasets, config),
+                                    config)
+    plot_animated_meshes(combined, plot_save_path, config)
     return None
 
 
-def timestep_mesh_filter_plot_overlay(datasets, timestep_index: int, plot_save_path=None):
+def _neighbour_cache(config: Config) -> NeighbourCache:
+    return NeighbourCache(k=config.neighbour_count,
+                          workers=config.neighbour_workers,
+                          tolerance=config.triangulation_tolerance)
+
+
+def combine_filter_neighbours(datasets, timestep_index: int, config: Config = None,
+                              cache: NeighbourCache = None):
+    """
+    Combines the stereo pairs of one timestep, fusing their overlaps if set in the
+    config, and removes the strain == 0 points next to non-zero strain points, see
+    filter_strain0_neighbours. The combined points are not meshed.
+    """
+    config = config or Config()
+    combined_data = combine_stereo_pairs(
+        [stereo_pair[timestep_index] for stereo_pair in datasets], config)
+    filter_strain0_neighbours(combined_data,
+                              k=config.neighbour_count,
+                              workers=config.neighbour_workers,
+                              cache=cache)
+    return combined_data
+
+
+def combine_filter_neighbours_datasets(datasets, config: Config = None) -> DICCollection:
+    """
+    combine_filter_neighbours for every timestep, the combined timesteps as a single
+    stereo pair.
+    """
+    config = config or Config()
+    neighbour_cache = _neighbour_cache(config)
+    combined = DICCollection()
+    combined.append([combine_filter_neighbours(datasets, timestep_index, config,
+                                               neighbour_cache)
+                     for timestep_index in range(len(datasets[0]))])
+    print(f"Neighbour cache: {neighbour_cache.stats()}")
+    return combined
+
+
+def timestep_mesh_filter_plot_overlay(datasets,
+                                      timestep_index: int,
+                                      plot_save_path=None,
+                                      config: Config = None):
     """
     For a single time step:
     1. Delaunay mesh on each stereo pair
     2. filter simplicies with strain == 0 points
     3. Plot all 3 meshes on same plot
     """
+    config = config or Config()
+    tri_cache = _triangulation_cache(config)
 
     for dataset in datasets:
         data = dataset[timestep_index]
-        create_delaunay_mesh(data)
+        create_mesh(data, config=config, cache=tri_cache)
         filter_strain0_data(data)
 
-    plotting.multiple_meshes_single_timestep(datasets=datasets,
-                                             timestep_index=timestep_index,
-                                             plot_save_path=plot_save_path,
-                                             z_scale=1)
+    plotting.multiple_meshes_single_timestep(
+        datasets=datasets,
+        timestep_index=timestep_index,
+        plot_save_path=plot_save_path,
+        z_scale=1,
+        max_vertices=config.plot_max_vertices,
+        strain_percentiles=config.plot_strain_percentiles,
+        show=config.show_plots)
     return None
 
 
-def timesteps_mesh_filter_plot_overlay(datasets, plot_save_path=None):
+def timesteps_mesh_filter_plot_overlay(datasets, plot_save_path=None, config: Config = None):
     """
     Method:
     1. 3 sets of point clouds
     2. Delaunay tesselate individual sets
     3. Filter delaunay simplicies with strain == 0 points
     4. Plot 3 mesh sets on top of each other
+
+    Timesteps sharing a point grid reuse one triangulation if enabled in the config,
+    and are meshed in parallel with config.mesh_workers. With config.output_format
+    "xdmf" the meshes are exported to an HDF5/XDMF time series instead of plotted.
     """
+    config = config or Config()
+
     print(str(20*'='))
     print(f"Starting timestep mesh filtering overlay for {len(datasets)} datasets")
 
     # Create Delaunay meshes and filter for all timesteps of all stereo pairs:
+    mesh_filter_datasets(datasets, config)
+    plot_animated_meshes(datasets, plot_save_path, config)
+
+
+def combine_mesh_filter(datasets, timestep_index: int, config: Config = None,
+                        cache: TriangulationCache = None):
+    """
+    Combines the non-zero strain points of the stereo pairs at one timestep, fusing
+    their overlaps if set in the config, meshes them and removes the poorly shaped
+    simplices bridging gaps, see filter_mesh_quality.
+    """
+    config = config or Config()
+    combined_data = combine_stereo_pairs(
+        [stereo_pair[timestep_index] for stereo_pair in datasets], config)
+    filter_strain0_points(combined_data)
+    mesh_quality_filter(combined_data, config, cache)
+    return combined_data
+
+
+def mesh_quality_filter(data, config: Config, cache: TriangulationCache = None) -> None:
+    """ Meshes a dataset and removes its poorly shaped simplices, in place """
+    create_mesh(data, config=config, cache=cache)
+    filter_mesh_quality(data,
+                        max_edge=config.mesh_max_edge,
+                        max_edge_factor=config.mesh_max_edge_factor,
+                        max_aspect=config.mesh_max_aspect,
+                        max_circumradius=config.mesh_max_circumradius)
+    return None
+
+
+def combine_filter_strain0_datasets(datasets, config: Config = None) -> DICCollection:
+    """
+    Combines the stereo pairs of every timestep, fusing their overlaps if set in the
+    config, and removes the strain == 0 points. The combined timesteps as a single
+    stereo pair, unmeshed.
+    """
+    config = config or Config()
+    combined = DICCollection()
+    combined_timesteps = []
+    for timestep_index in range(len(datasets[0])):
+        combined_data = combine_stereo_pairs(
+            [stereo_pair[timestep_index] for stereo_pair in datasets], config)
+        filter_strain0_points(combined_data)
+        combined_timesteps.append(combined_data)
+    combined.append(combined_timesteps)
+    return combined
+
+
+def mesh_quality_filter_datasets(datasets, config: Config) -> DICCollection:
+    """
+    mesh_quality_filter for every timestep of every stereo pair, in place, updating
+    the statistics of a DICCollection.
+
+    :return: The same datasets, so the pipeline can name the meshed state.
+    """
+    tri_cache = _triangulation_cache(config)
+    stats = getattr(datasets, 'stats', None)
     for stereo_pair in datasets:
-        for timestep in stereo_pair:
-            create_delaunay_mesh(timestep)
-            print(f"mesh created for stereo_pair, timestep {timestep}")
-            filter_strain0_data(timestep)
-            print(f"filtering strain 0 for stereo_pair, timestep {timestep}")
-    # Plot the meshes per timestep in interactive plot
-    plotting.create_animated_mesh(datasets, z_scale=1, plot_save_path=plot_save_path)
+        for data in stereo_pair:
+            mesh_quality_filter(data, config, tri_cache)
+            if stats is not None:
+                stats.update(data)
+    return datasets
 
 
-def timesteps_combine_mesh_filter_plot(datasets):
+def timesteps_combine_mesh_filter_plot(datasets, plot_save_path=None, config: Config = None):
     """
     Method:
     1. Combine point clouds
-    2. Delaunay tesselation
-    3. Filter simplicies with strain == 0 points
-    4. Plot
-    This seems to have an issue where there are so many strain == 0 points
-    mixed with good points that most simplicies are removed.
+    2. Remove strain == 0 points
+    3. Delaunay tesselation
+    4. Filter simplicies by edge length, aspect ratio and circumradius
+    5. Plot
+
+    Filtering simplices with strain == 0 points after meshing the combined cloud
+    removed most simplices, as the strain == 0 points of one pair are mixed with
+    the good points of the others. Here the strain == 0 points are removed first and
+    the long, thin simplices the mesh then spans across the gaps are removed by
+    their shape instead. With config.output_format "xdmf" each combined timestep is
+    exported to an HDF5/XDMF time series as it is meshed.
     """
+    config = config or Config()
+    tri_cache = _triangulation_cache(config)
+
+    print(str(20 * '='))
+    print(f"Starting timesteps combine mesh filtering for {len(datasets)} datasets")
+
+    if config.output_format == "xdmf":
+        # Stream each combined timestep to disk, the combined cloud as one pair
+        with XDMFWriter(plot_save_path) as writer:
+            for timestep_index in range(len(datasets[0])):
+                writer.write_timestep(timestep_index,
+                                      [combine_mesh_filter(datasets, timestep_index,
+                                                           config, tri_cache)])
+        return None
+
+    # Plot the combined mesh as a single stereo pair
+    combined = mesh_quality_filter_datasets(
+        combine_filter_strain0_datasets(datasets, config), config)
+    plot_animated_meshes(combined, plot_save_path, config)
     return None
 
 
-def timestep_combine_filter_plot_scatter(datasets, timestep_index, plot_save_path=None):
+def timestep_combine_filter_plot_scatter(datasets,
+                                         timestep_index,
+                                         plot_save_path=None,
+                                         config: Config = None):
     """
     Method:
     1. Combine point clouds
@@ -88,17 +434,118 @@ def timestep_combine_filter_plot_scatter(datasets, timestep_index, plot_save_pat
     :param datasets:
     :param timestep_index:
     :param plot_save_path:
+    :param config: Config, plot_max_points limits the points plotted.
     :return:
     """
+    config = config or Config()
     print(str(20 * '='))
     print(f"Starting timestep mesh filtering overlay for {len(datasets)} datasets")
 
-    datasets = [dataset[timestep_index] for dataset in datasets]
-    print("Combining stereo pairs...")
-    combined_data = combine_unfiltered_stereo_pairs(datasets)
-    print("Filtering strain == 0 points...")
-    filter_strain0_points(combined_data)
+    combined_data = combine_filter_points(datasets, timestep_index, config)
     print("Plotting 3D scatter plot...")
-    plotting.plot_scatter_points(combined_data, plot_save_path)
+    plotting.plot_scatter_points(combined_data,
+                                 plot_save_path,
+                                 max_points=config.plot_max_points,
+                                 show=config.show_plots)
 
     return None
+
+
+def create_pipeline(config: Config = None) -> Pipeline:
+    """
+    The processing methods as stages of a pipeline, so intermediate results are kept
+    between runs, e.g. the meshed datasets when switching between plots or timesteps.
+
+    Parameters of a run: stereo_pair_dirs, config, plot_save_path and, for the
+    single timestep plots, timestep_index. Run a method with its target from
+    METHOD_TARGETS, e.g.
+        pipeline.run(METHOD_TARGETS[2], stereo_pair_dirs=dirs, config=config,
+                     plot_save_path=path)
+
+    Plot stages are not memoized, they write their file on every run. The other
+    stages leave their inputs unchanged and are keyed only on the config fields
+    they read, so e.g. changing a plot setting reuses the imported datasets.
+    """
+    config = config or Config()
+
+    def meshed_datasets(datasets, config):
+        return mesh_filter_datasets(copy_datasets(datasets), config)
+
+    def meshed_quality_datasets(datasets, config):
+        return mesh_quality_filter_datasets(copy_datasets(datasets), config)
+
+    def overlay_plot(meshed_timestep, plot_save_path, config):
+        plotting.multiple_meshes_single_timestep(
+            datasets=meshed_timestep,
+            timestep_index=0,
+            plot_save_path=plot_save_path,
+            z_scale=1,
+            max_vertices=config.plot_max_vertices,
+            strain_percentiles=config.plot_strain_percentiles,
+            show=config.show_plots)
+
+    def scatter_plot(combined_points, plot_save_path, config):
+        plotting.plot_scatter_points(combined_points,
+                                     plot_save_path,
+                                     max_points=config.plot_max_points,
+                                     show=config.show_plots)
+
+    return Pipeline([
+        Stage('datasets', importing.load_multiple_stereo_pairs,
+              inputs=('stereo_pair_dirs', 'config'),
+              input_fields={'config': IMPORT_FIELDS}),
+        Stage('meshed_datasets', meshed_datasets,
+              inputs=('datasets', 'config'),
+              input_fields={'config': MESH_FIELDS}),
+        Stage('meshed_timestep', mesh_filter_timestep,
+              inputs=('datasets', 'timestep_index', 'config'),
+              input_fields={'config': MESH_FIELDS},
+              derive_from=('meshed_datasets', select_timestep)),
+        Stage('combined_points', combine_filter_points,
+              inputs=('datasets', 'timestep_index', 'config'),
+              input_fields={'config': FUSION_FIELDS}),
+        Stage('resampled_datasets', resample_fuse_datasets,
+              inputs=('datasets', 'config'),
+              input_fields={'config': RESAMPLE_FIELDS}),
+        Stage('combined_neighbour_datasets', combine_filter_neighbours_datasets,
+              inputs=('datasets', 'config'),
+              input_fields={'config': NEIGHBOUR_FIELDS}),
+        Stage('meshed_combined_neighbour_datasets', meshed_datasets,
+              inputs=('combined_neighbour_datasets', 'config'),
+              input_fields={'config': MESH_FIELDS}),
+        Stage('combined_nonzero_datasets', combine_filter_strain0_datasets,
+              inputs=('datasets', 'config'),
+              input_fields={'config': FUSION_FIELDS}),
+        Stage('meshed_combined_datasets', meshed_quality_datasets,
+              inputs=('combined_nonzero_datasets', 'config'),
+              input_fields={'config': QUALITY_FIELDS}),
+        Stage('overlay_plot', overlay_plot,
+              inputs=('meshed_timestep', 'plot_save_path', 'config'),
+              memoize=False),
+        Stage('animated_plot', plot_animated_meshes,
+              inputs=('meshed_datasets', 'plot_save_path', 'config'),
+              memoize=False),
+        Stage('scatter_plot', scatter_plot,
+              inputs=('combined_points', 'plot_save_path', 'config'),
+              memoize=False),
+        Stage('neighbour_plot', plot_animated_meshes,
+              inputs=('meshed_combined_neighbour_datasets', 'plot_save_path', 'config'),
+              memoize=False),
+        Stage('combined_mesh_plot', plot_animated_meshes,
+              inputs=('meshed_combined_datasets', 'plot_save_path', 'config'),
+              memoize=False),
+        Stage('resampled_plot', plot_animated_meshes,
+              inputs=('resampled_datasets', 'plot_save_path', 'config'),
+              memoize=False),
+    ], workers=config.pipeline_workers)
+
+
+# Pipeline target of each processing method
+METHOD_TARGETS = {
+    1: 'overlay_plot',  # timestep: mesh -> filter -> plot overlay
+    2: 'animated_plot',  # multiple timesteps: mesh -> filter -> plot overlay
+    3: 'scatter_plot',  # timestep: combine -> filter -> plot scatter
+    4: 'neighbour_plot',  # timesteps: combine -> filter neighbours -> mesh -> plot
+    5: 'resampled_plot',  # timesteps: resample to common grid -> fuse -> plot
+    6: 'combined_mesh_plot',  # timesteps: combine -> filter -> mesh -> quality -> plot
+}
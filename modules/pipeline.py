@@ -0,0 +1,259 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from modules import instrumentation
+
+
+class Stage:
+    """
+    A named step of a pipeline.
+
+    :param name: Unique stage name.
+    :param func: Callable taking the inputs as arguments, in order. Returns the value
+                 of the output, or a tuple of values if there are several outputs.
+    :param inputs: Names of the pipeline parameters or other stages' outputs used.
+    :param outputs: Names of the values produced, defaults to the stage name.
+    :param memoize: Keep the outputs for later runs with the same inputs. Stages
+                    with side effects, e.g. writing plots, should always run.
+    :param input_fields: Optional dict of input name to the attributes the stage
+                         reads from it, e.g. {'config': ('mesh_mode',)}. Only those
+                         attributes go into the memo key, so changing another
+                         field of the config does not rerun the stage.
+    :param derive_from: Optional (output name, func) of a cheaper way to the outputs
+                        from another stage's output, e.g. one timestep of the meshed
+                        datasets. Used instead of func when that output is memoized
+                        for the same inputs or produced in the same run, called as
+                        func(output, *inputs).
+    """
+
+    def __init__(self, name: str, func, inputs=(), outputs=None, memoize: bool = True,
+                 input_fields: dict = None, derive_from: tuple = None):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs) if outputs else (name,)
+        self.memoize = memoize
+        self.input_fields = dict(input_fields or {})
+        self.derive_from = derive_from
+
+    def key(self, values: dict, tokens: dict) -> tuple:
+        """ Memo key of the stage for the current input values and tokens """
+        return (self.name, tuple(self.input_token(name, values[name], tokens[name])
+                                 for name in self.inputs))
+
+    def input_token(self, name: str, value, token):
+        """ Memo key token of an input, of only the fields read if declared """
+        fields = self.input_fields.get(name)
+        if fields is None:
+            return token
+        return (name, tuple((field, param_token(getattr(value, field)))
+                            for field in fields))
+
+    def __repr__(self):
+        return f"Stage({self.name!r}, inputs={self.inputs}, outputs={self.outputs})"
+
+
+def param_token(value):
+    """
+    Hashable token of a parameter value for memo keys. Objects with attributes,
+    e.g. Config, are tokenised by their attributes so changing one invalidates the
+    stages using it.
+    """
+    if isinstance(value, (str, bytes, int, float, bool, type(None))):
+        return value
+    if isinstance(value, (list, tuple)):
+        return tuple(param_token(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, param_token(item)) for key, item in value.items()))
+    if isinstance(value, slice):
+        return ('slice', value.start, value.stop, value.step)
+    if hasattr(value, "__dict__"):
+        return (type(value).__name__, param_token(vars(value)))
+    return (type(value).__name__, id(value))
+
+
+class Pipeline:
+    """
+    Runs stages with declared inputs and outputs, in dependency order, memoizing
+    their outputs.
+
+    A stage's memo key is built from the tokens of the parameters it uses, or of
+    just the fields it reads from them, and the memo keys of the stages producing
+    its other inputs, so a stage only reruns when something upstream of it changed,
+    e.g. switching the plot or a plot setting reuses the imported and meshed
+    datasets. Memoized outputs are shared between runs, stages must not modify
+    their inputs in place.
+
+    Stages whose inputs are ready run concurrently in a thread pool of workers
+    threads, e.g. the meshing of method 2 next to the combining of method 6 and
+    then their plots, when both targets are run together with their own
+    target_params. The heavy work inside stages releases the GIL or uses its own
+    process pools, and threads let stages share datasets without copies.
+    """
+
+    def __init__(self, stages=(), workers: int = 2):
+        self.workers = workers
+        self.stages = {}
+        self.producers = {}  # output name -> Stage
+        self._memo = {}  # memo key -> outputs tuple
+        for stage in stages:
+            self.add(stage)
+
+    def add(self, stage: Stage) -> None:
+        if stage.name in self.stages:
+            raise ValueError(f"Duplicate stage name: {stage.name}")
+        for output in stage.outputs:
+            if output in self.producers:
+                raise ValueError(f"Output {output} of {stage.name} is already produced "
+                                 f"by {self.producers[output].name}")
+            self.producers[output] = stage
+        self.stages[stage.name] = stage
+        return None
+
+    def clear(self) -> None:
+        """ Forgets every memoized output """
+        self._memo.clear()
+        return None
+
+    def _required_stages(self, targets, params) -> list:
+        """
+        Stages needed for the targets, each after the stages it depends on. params
+        holds the names of the parameters given, to any stage.
+        """
+        ordered = []
+        visiting = set()
+
+        def visit(name):
+            if name in params:
+                return
+            if name not in self.producers:
+                raise KeyError(f"No parameter or stage output named {name}")
+            stage = self.producers[name]
+            if stage in ordered:
+                return
+            if stage.name in visiting:
+                raise ValueError(f"Cycle through stage {stage.name}")
+            visiting.add(stage.name)
+            for input_name in stage.inputs:
+                visit(input_name)
+            visiting.discard(stage.name)
+            ordered.append(stage)
+
+        for target in targets:
+            visit(target)
+        return ordered
+
+    def run(self, targets, target_params: dict = None, **params) -> dict:
+        """
+        Computes the target outputs from the given parameters.
+
+        :param targets: Output name or list of output names.
+        :param target_params: Optional dict of target to parameters only for the
+                              stage producing it, e.g. a plot_save_path per plot, so
+                              several plots can be run, and overlap, in one call.
+        :param params: Pipeline parameters, e.g. stereo_pair_dirs=..., config=...
+        :return: Dictionary of each target's value.
+        """
+        if isinstance(targets, str):
+            targets = [targets]
+        target_params = target_params or {}
+
+        names = set(params).union(*(set(own) for own in target_params.values()))
+        stages = self._required_stages(targets, names)
+        values = dict(params)
+        tokens = {name: param_token(value) for name, value in params.items()}
+
+        # Values and tokens seen by the stages producing targets with own parameters
+        stage_values = {}
+        stage_tokens = {}
+        for target, own in target_params.items():
+            stage = self.producers[target]
+            stage_values[stage] = own
+            stage_tokens[stage] = {name: param_token(value) for name, value in own.items()}
+
+        def inputs_of(stage):
+            if stage not in stage_values:
+                return values, tokens
+            return ({**values, **stage_values[stage]}, {**tokens, **stage_tokens[stage]})
+
+        pending = list(stages)
+        running = {}  # Future -> (stage, memo key)
+
+        def is_ready(stage):
+            if not all(name in inputs_of(stage)[0] for name in stage.inputs):
+                return False
+            if stage.derive_from is not None:
+                # Wait for a source produced in this run rather than redo its work
+                source = self.producers[stage.derive_from[0]]
+                return source not in stages or stage.derive_from[0] in values
+            return True
+
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            while pending or running:
+                # Start every stage whose inputs are available
+                ready = [stage for stage in pending if is_ready(stage)]
+                if not ready and not running:
+                    raise RuntimeError(f"Stages cannot run: {pending}")
+                for stage in ready:
+                    pending.remove(stage)
+                    stage_inputs, input_tokens = inputs_of(stage)
+                    key = stage.key(stage_inputs, input_tokens)
+                    if stage.memoize and key in self._memo:
+                        instrumentation.count("pipeline memo hits")
+                        self._store(stage, key, self._memo[key], values, tokens)
+                        continue
+                    args = [stage_inputs[name] for name in stage.inputs]
+                    source = self._derive_source(stage, stage_inputs, input_tokens)
+                    if source is not None:
+                        instrumentation.count("pipeline derived stages")
+                        future = executor.submit(self._call, stage, [source] + args,
+                                                 stage.derive_from[1])
+                    else:
+                        future = executor.submit(self._call, stage, args)
+                    running[future] = (stage, key)
+
+                if not running:
+                    # Memo hits may have made more stages ready
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, key = running.pop(future)
+                    outputs = future.result()
+                    if stage.memoize:
+                        self._memo[key] = outputs
+                    self._store(stage, key, outputs, values, tokens)
+
+        return {target: values[target] for target in targets}
+
+    def _derive_source(self, stage: Stage, values: dict, tokens: dict):
+        """
+        The output a stage can be derived from, if produced in this run or memoized
+        for the current inputs, otherwise None.
+        """
+        if stage.derive_from is None:
+            return None
+        name = stage.derive_from[0]
+        if name in values:
+            return values[name]
+        source = self.producers[name]
+        if not source.memoize or not all(input_name in values
+                                         for input_name in source.inputs):
+            return None
+        outputs = self._memo.get(source.key(values, tokens))
+        if outputs is None:
+            return None
+        return outputs[source.outputs.index(name)]
+
+    @staticmethod
+    def _call(stage: Stage, args: list, func=None) -> tuple:
+        with instrumentation.span(f"stage {stage.name}"):
+            result = (func or stage.func)(*args)
+        return result if len(stage.outputs) > 1 else (result,)
+
+    @staticmethod
+    def _store(stage: Stage, key, outputs, values: dict, tokens: dict) -> None:
+        for name, value in zip(stage.outputs, outputs):
+            values[name] = value
+            # Downstream keys chain this stage's key rather than hashing its output
+            tokens[name] = (key, name)
+        return None
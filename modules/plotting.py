@@ -1,36 +1,208 @@
+import html
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+
+import numpy as np
 import plotly.figure_factory as ff
 import plotly.graph_objects as go
 import plotly.express as px
 
+from modules import instrumentation
+from modules.classes import LazyStereoPair
+from modules.decimation import decimate_mesh, decimate_points
+from modules.processing import grid_simplices
+from modules.stats import DatasetStatistics
 
-def plot_scatter_points(dataset, plot_save_path: str) -> None:
-    fig = px.scatter_3d(x=dataset.x.flatten(),
-                        y=dataset.y.flatten(),
-                        z=dataset.z.flatten(),
-                        color=dataset.strain.flatten())
+
+def filtered_mesh_arrays(dataset, max_vertices=None, reduce='mean'):
+    """
+    Returns (coords, simplices, strain) of a dataset's filtered mesh, decimated to
+    max_vertices if given, otherwise at full resolution.
+    """
+    coords = dataset.coords_filtered
+    simplices = dataset.simplices_filtered
+    strain = dataset.strain_filtered
+    if max_vertices is not None:
+        coords, simplices, strain = decimate_mesh(coords, simplices, strain,
+                                                  max_vertices=max_vertices,
+                                                  reduce=reduce)
+    return coords, simplices, strain
+
+
+def collection_stats(datasets):
+    """
+    Statistics of a dataset collection gathered while it was filtered, or None if
+    there are none, e.g. for a plain list of datasets.
+    """
+    stats = getattr(datasets, 'stats', None)
+    return stats if stats else None
+
+
+def masked_mesh_arrays(dataset):
+    """
+    (z, intensity) of a dataset's filtered mesh drawn on its unfiltered points and
+    simplices, with a nan z hiding the removed points, which plotly skips with every
+    simplex using them. Timesteps sharing their points and mesh can then share the
+    x, y, i, j and k arrays.
+
+    :return: float32 (z, intensity), or None if the filtered simplices are not
+             exactly the simplices whose points are all kept, e.g. after
+             filter_mesh_quality.
+    """
+    keep = np.zeros(dataset.coords.shape[0], dtype=bool)
+    keep[dataset.filtered_index] = True
+    if dataset.simplices_filtered.shape[0] != keep[dataset.simplices].all(axis=1).sum():
+        return None
+    z = dataset.z.astype(np.float32)
+    z[~keep] = np.nan
+    return z, dataset.strain.astype(np.float32)
+
+
+def _simplex_keys(simplices):
+    """ One comparable key per simplex, the same for any order of its points """
+    simplices = np.ascontiguousarray(np.sort(simplices, axis=1), dtype=np.int64)
+    return simplices.view(np.dtype((np.void, 3 * 8))).ravel()
+
+
+class SharedMeshLayout:
+    """
+    The unfiltered x, y points and simplices of a stereo pair's first timestep,
+    sent once in the initial trace of a delta encoded animation.
+
+    Grid meshes skipping the cells with strain == 0 corners change with the strain,
+    so grid meshes share the simplices of the whole grid instead, and the nan z of
+    the filtered out points hides every cell with a strain == 0 corner. The few
+    cells split along the other diagonal around them are sent per frame, see
+    extra_mesh.
+    """
+
+    def __init__(self, dataset, grid_tolerance: float = 0.01):
+        self.x = dataset.x.astype(np.float32)
+        self.y = dataset.y.astype(np.float32)
+        self._xy = dataset.coords[:, :2]
+        self.tolerance = grid_tolerance
+        self.grid = grid_simplices(self._xy, tolerance=grid_tolerance)
+        if self.grid is not None and not self._is_grid_mesh(dataset):
+            # e.g. a Delaunay mesh of points on a grid
+            self.grid = None
+        self.source_simplices = dataset.simplices if self.grid is None else self.grid
+        simplices = np.asarray(self.source_simplices, dtype=np.int32)
+        self.i, self.j, self.k = simplices[:, 0], simplices[:, 1], simplices[:, 2]
+        self._keys = None if self.grid is None else _simplex_keys(self.grid)
+
+    def _is_grid_mesh(self, dataset) -> bool:
+        """ Whether a timestep is meshed on the grid, skipping strain == 0 cells or not """
+        if np.array_equal(dataset.simplices, self.grid):
+            return True
+        skipped = grid_simplices(self._xy, valid=dataset.strain != 0,
+                                 tolerance=self.tolerance)
+        return skipped is not None and np.array_equal(dataset.simplices, skipped)
+
+    def matches(self, dataset) -> bool:
+        """ Whether a timestep has the same points and can be drawn on the simplices """
+        if dataset.coords.shape[0] != self._xy.shape[0]:
+            return False
+        if not np.array_equal(dataset.coords[:, :2], self._xy):
+            return False
+        # Triangulation caches hand out the same simplices array
+        if dataset.simplices is self.source_simplices:
+            return True
+        if self.grid is not None:
+            return self._is_grid_mesh(dataset)
+        return np.array_equal(dataset.simplices, self.source_simplices)
+
+    def arrays(self) -> dict:
+        return dict(x=self.x, y=self.y, i=self.i, j=self.j, k=self.k)
+
+    def extra_mesh(self, dataset) -> dict:
+        """
+        Trace arguments of the filtered simplices of a matching timestep which the
+        shared grid simplices do not hold, i.e. the cells with one strain == 0
+        corner a grid mesh skipping them splits along the other diagonal.
+        """
+        simplices = dataset.simplices_filtered
+        if self.grid is not None and simplices.shape[0]:
+            shared = np.isin(_simplex_keys(dataset.filtered_index[simplices]), self._keys)
+            simplices = simplices[~shared]
+        else:
+            simplices = simplices[:0]
+        points, simplices = np.unique(simplices.ravel(), return_inverse=True)
+        simplices = simplices.reshape(-1, 3).astype(np.int32)
+        coords = dataset.coords_filtered[points].astype(np.float32)
+        return dict(x=coords[:, 0], y=coords[:, 1], z=coords[:, 2],
+                    i=simplices[:, 0], j=simplices[:, 1], k=simplices[:, 2],
+                    intensity=dataset.strain_filtered[points].astype(np.float32))
+
+
+@instrumentation.profiled("plot build")
+def build_scatter_figure(dataset, max_points=None) -> go.Figure:
+    """ Builds the 3D scatter plot of a dataset's points without showing it """
+    # Voxel grid decimation to max_points, full resolution if None
+    coords, strain = decimate_points(dataset.coords, dataset.strain, max_points)
+
+    fig = px.scatter_3d(x=coords[:, 0],
+                        y=coords[:, 1],
+                        z=coords[:, 2],
+                        color=strain)
 
     fig.update_traces(marker=dict(size=2))  # Set size to a smaller value, e.g., 3
     fig.update_layout(coloraxis_colorbar=dict(title="Strain"))
 
-    fig.show(renderer='browser')
+    return fig
+
+
+def show_and_write(fig, plot_save_path=None, show: bool = True, renderer=None) -> None:
+    """
+    Shows a figure unless running headless (show=False), then writes it as HTML if
+    plot_save_path is given.
+    """
+    if show:
+        fig.show(renderer=renderer)
 
     if plot_save_path:
-        fig.write_html(plot_save_path, full_html=False, include_plotlyjs='cdn')
+        with instrumentation.span("write"):
+            fig.write_html(plot_save_path, full_html=False, include_plotlyjs='cdn')
+
+    return None
 
+
+def plot_scatter_points(dataset, plot_save_path: str, max_points=None,
+                        show: bool = True) -> None:
+    fig = build_scatter_figure(dataset, max_points=max_points)
+    show_and_write(fig, plot_save_path, show=show, renderer='browser')
     return None
 
-def plot_delaunay_mesh(x, y, z, simplices, z_scale=1):
+
+def plot_delaunay_mesh(x, y, z, simplices, z_scale=1, max_vertices=None,
+                       show: bool = True):
     # Just for testing, using go for strain map.
+    if max_vertices is not None:
+        coords, simplices, _ = decimate_mesh(np.column_stack([x, y, z]), simplices,
+                                             np.zeros(len(x)), max_vertices=max_vertices)
+        x, y, z = coords.T
     fig = ff.create_trisurf(x=x, y=y, z=z,
                             simplices=simplices,
                             title="DIC Surface Map",
                             aspectratio=dict(x=1, y=1, z=z_scale))
-    fig.show()
+    show_and_write(fig, show=show)
 
     return None
 
 
-def plot_delaunay_mesh_strain(x, y, z, simplices, strain, plot_save_path, z_scale=1):
+def plot_delaunay_mesh_strain(x, y, z, simplices, strain, plot_save_path, z_scale=1,
+                              max_vertices=None, show: bool = True):
+    if max_vertices is not None:
+        coords, simplices, strain = decimate_mesh(np.column_stack([x, y, z]),
+                                                  simplices, strain,
+                                                  max_vertices=max_vertices)
+        x, y, z = coords.T
+
+    # Color range robust to outliers
+    cmin, cmax = np.nanpercentile(strain, (1, 99))
+
     # Create trisurface plot
     mesh = go.Mesh3d(
         x=x,
@@ -40,8 +212,8 @@ def plot_delaunay_mesh_strain(x, y, z, simplices, strain, plot_save_path, z_scal
         j=simplices[:, 1],
         k=simplices[:, 2],
         intensity=strain,
-        cmin=0,
-        cmax=2,
+        cmin=cmin,
+        cmax=cmax,
         colorscale='Viridis',
         colorbar=dict(title='Strain'),
         flatshading=True
@@ -70,26 +242,56 @@ def plot_delaunay_mesh_strain(x, y, z, simplices, strain, plot_save_path, z_scal
 
     # Create the figure and plot
     fig = go.Figure(data=[mesh], layout=layout)
-    fig.show()
-    fig.write_html(plot_save_path, full_html=False, include_plotlyjs='cdn')
+    show_and_write(fig, plot_save_path, show=show)
 
     return None
 
 
-def multiple_meshes_single_timestep(datasets,
-                                    timestep_index,
-                                    plot_save_path=None,
-                                    z_scale=1):
+@instrumentation.profiled("plot build")
+def build_multiple_meshes_figure(datasets,
+                                 timestep_index,
+                                 max_vertices=None,
+                                 strain_percentiles=(1, 99)) -> go.Figure:
+    """
+    Builds the overlay of every stereo pair's mesh at one timestep.
+
+    The color range spans the strain_percentiles of the strain over all timesteps
+    if the collection has statistics, otherwise over this timestep.
+    """
+    stats = collection_stats(datasets)
+    if stats is None:
+        stats = DatasetStatistics.from_datasets([[stereo_pair[timestep_index]]
+                                                 for stereo_pair in datasets])
 
+    meshes = [filtered_mesh_arrays(stereo_pair[timestep_index],
+                                   max_vertices=max_vertices)
+              for stereo_pair in datasets]
+    return build_meshes_figure(meshes, stats.range('strain', strain_percentiles))
+
+
+def build_meshes_figure(meshes, strain_range, axis_ranges=None,
+                        title="DIC Surface Map Combined") -> go.Figure:
+    """
+    Builds the overlay of meshes given as arrays.
+
+    :param meshes: (coords, simplices, strain) of each mesh.
+    :param strain_range: (min, max) of the color scale, None for automatic.
+    :param axis_ranges: Optional fixed ((x_min, x_max), (y_min, y_max),
+                        (z_min, z_max)), e.g. to match figures of other timesteps,
+                        None for automatic ranges of all or some of the axes.
+    :param title: Figure title.
+    """
+    strain_min, strain_max = strain_range or (None, None)
+    x_range, y_range, z_range = axis_ranges if axis_ranges is not None else (None,) * 3
     # Set up layout with scaling
     layout = go.Layout(
         scene=dict(
             aspectmode='data',
-            xaxis=dict(title='X [mm]'),
-            yaxis=dict(title='Y [mm]'),
-            zaxis=dict(title='Z [mm]'),
+            xaxis=dict(title='X [mm]', range=x_range),
+            yaxis=dict(title='Y [mm]', range=y_range),
+            zaxis=dict(title='Z [mm]', range=z_range),
         ),
-        title="DIC Surface Map Combined",
+        title=title,
         autosize=False,
         width=500,
         height=500,
@@ -105,39 +307,78 @@ def multiple_meshes_single_timestep(datasets,
     # Create the figure and plot
     fig = go.Figure(data=None, layout=layout)
 
-    for dataset in datasets:
+    for coords, simplices, strain in meshes:
         fig.add_trace(go.Mesh3d(
-            x=dataset[timestep_index].x_filtered,
-            y=dataset[timestep_index].y_filtered,
-            z=dataset[timestep_index].z_filtered,
-            i=dataset[timestep_index].simplices_filtered[:, 0],
-            j=dataset[timestep_index].simplices_filtered[:, 1],
-            k=dataset[timestep_index].simplices_filtered[:, 2],
-            intensity=dataset[timestep_index].strain_filtered,
-            cmin=0,
-            cmax=2,
+            x=coords[:, 0],
+            y=coords[:, 1],
+            z=coords[:, 2],
+            i=simplices[:, 0],
+            j=simplices[:, 1],
+            k=simplices[:, 2],
+            intensity=strain,
+            cmin=strain_min,
+            cmax=strain_max,
             colorscale='Viridis',
             showscale=False
         ))
 
-    fig.show()
+    return fig
+
+
+def multiple_meshes_single_timestep(datasets,
+                                    timestep_index,
+                                    plot_save_path=None,
+                                    z_scale=1,
+                                    max_vertices=None,
+                                    strain_percentiles=(1, 99),
+                                    show: bool = True):
 
-    if plot_save_path != None:
-        fig.write_html(plot_save_path, full_html=False, include_plotlyjs='cdn')
+    fig = build_multiple_meshes_figure(datasets, timestep_index,
+                                       max_vertices=max_vertices,
+                                       strain_percentiles=strain_percentiles)
+    show_and_write(fig, plot_save_path, show=show)
 
     return None
 
-def create_animated_mesh(datasets, z_scale=1, plot_save_path=None):
+@instrumentation.profiled("plot build")
+def build_animated_mesh_figure(datasets,
+                               z_scale=1,
+                               max_vertices=None,
+                               encoding='full',
+                               strain_percentiles=(1, 99),
+                               grid_tolerance: float = 0.01) -> go.Figure:
     """
-    Creates an animated 3D Mesh plot where each frame represents a timestep across all
+    Builds an animated 3D Mesh plot where each frame represents a timestep across all
     stereo pairs.
-    Fixes the axis ranges and the color scale range.
+    Fixes the axis ranges and the color scale range. The ranges come from the
+    statistics a DICCollection gathers as it is filtered, so the data is not read
+    again, lazy stereo pairs fill them in as the frames load their timesteps. Other
+    datasets get one statistics pass.
 
     :param datasets: List of datasets, where each dataset corresponds to a stereo pair
                      and contains multiple timesteps.
     :param z_scale: Scaling factor for the z-axis.
-    :return: None
+    :param max_vertices: Vertex budget per stereo pair mesh per frame, meshes are
+                         simplified by vertex clustering. None for full resolution.
+    :param encoding: 'full' puts every filtered mesh array in every frame. 'delta'
+                     stores the unfiltered x, y points and simplices of stereo pairs
+                     whose points and mesh do not change once in the initial traces,
+                     frames then only carry z, with nan hiding the filtered out
+                     points, and intensity as float32 arrays. Grid meshes share
+                     the simplices of the whole grid, so cells with a strain == 0
+                     corner are hidden as with mesh_skip_strain0 off. Stereo pairs
+                     whose points or mesh change, decimated meshes and meshes
+                     filtered other than by points are sent in full.
+    :param strain_percentiles: (low, high) percentiles of the filtered strain used
+                               as the color range, robust to outliers, or None
+                               for the full min to max range.
+    :param grid_tolerance: Grid detection tolerance of the delta encoding, see
+                           grid_indices.
+    :return: go.Figure
     """
+    if encoding not in ('full', 'delta'):
+        raise ValueError(f"encoding must be 'full' or 'delta', not {encoding}")
+
     # Initialize lists for frames and sliders
     frames = []
     sliders_dict = {
@@ -158,57 +399,79 @@ def create_animated_mesh(datasets, z_scale=1, plot_save_path=None):
         'steps': []
     }
 
-    # Determine global min/max ranges for x, y, z, and strain (for colorbar)
-    x_min, x_max = float('inf'), float('-inf')
-    y_min, y_max = float('inf'), float('-inf')
-    z_min, z_max = float('inf'), float('-inf')
-    strain_min, strain_max = float('inf'), float('-inf')
-
-    # Calculate the overall ranges across all datasets and timesteps
-    for stereo_pair in datasets:
-        for timestep_data in stereo_pair:
-            x_min = min(x_min, timestep_data.x_filtered.min())
-            x_max = max(x_max, timestep_data.x_filtered.max())
-            y_min = min(y_min, timestep_data.y_filtered.min())
-            y_max = max(y_max, timestep_data.y_filtered.max())
-            z_min = min(z_min, timestep_data.z_filtered.min())
-            z_max = max(z_max, timestep_data.z_filtered.max())
-            # strain_min = min(strain_min, timestep_data.strain_filtered.min())
-            # strain_max = max(strain_max, timestep_data.strain_filtered.max())
-            strain_min = -2
-            strain_max = 30
+    # The color range is set once the frames are built, see below
+    mesh_style = dict(
+        colorscale='Viridis',
+        flatshading=True,
+        opacity=1.0,  # Adjust for visibility of multiple stereo pairs
+    )
 
     # Create frames for each timestep
     num_timesteps = len(datasets[0])
+    initial_data = []
+    frame_data = []  # Trace arguments of each stereo pair at each timestep
+
+    # Layout shared by the delta encoded frames of each stereo pair, None once a
+    # timestep of the pair cannot use it. Checked as the frames are built, so lazy
+    # stereo pairs load each timestep once.
+    shared_layouts = [None] * len(datasets)
+    # Extra trace arguments of the stereo pairs sharing a grid layout at each
+    # timestep, drawn by a second trace of the pair
+    frame_extras = []
 
     for timestep_idx in range(num_timesteps):
         # Data for current timestep across all stereo pairs
         timestep_meshes = []
+        timestep_extras = {}
 
         for stereo_pair_idx, stereo_pair in enumerate(datasets):
             timestep_data = stereo_pair[timestep_idx]
-
+            name = f'Stereo Pair {stereo_pair_idx + 1}'
+
+            masked = None
+            if encoding == 'delta' and max_vertices is None:
+                if timestep_idx == 0:
+                    shared_layouts[stereo_pair_idx] = SharedMeshLayout(
+                        timestep_data, grid_tolerance=grid_tolerance)
+                shared = shared_layouts[stereo_pair_idx]
+                if shared is not None and shared.matches(timestep_data):
+                    masked = masked_mesh_arrays(timestep_data)
+                if shared is not None and masked is None:
+                    # Fall back to full frames for this pair, earlier frames of it
+                    # carry the shared layout so they stay correct on their own
+                    shared_layouts[stereo_pair_idx] = None
+                    for previous in frame_data:
+                        previous[stereo_pair_idx].update(shared.arrays())
+
+            if masked is not None:
+                # Frames are merged into the current traces, so only send what changes
+                z, intensity = masked
+                timestep_meshes.append(dict(z=z, intensity=intensity))
+                if shared.grid is not None:
+                    timestep_extras[stereo_pair_idx] = shared.extra_mesh(timestep_data)
+                if timestep_idx == 0:
+                    initial_data.append(go.Mesh3d(z=z, intensity=intensity, name=name,
+                                                  **shared.arrays(), **mesh_style))
+                continue
+
+            coords, simplices, strain = filtered_mesh_arrays(timestep_data,
+                                                             max_vertices=max_vertices)
             # Create a Mesh3d for each stereo pair at the current timestep
-            mesh = go.Mesh3d(
-                x=timestep_data.x_filtered,
-                y=timestep_data.y_filtered,
-                z=timestep_data.z_filtered,
-                i=timestep_data.simplices_filtered[:, 0],
-                j=timestep_data.simplices_filtered[:, 1],
-                k=timestep_data.simplices_filtered[:, 2],
-                intensity=timestep_data.strain_filtered,
-                colorscale='Viridis',
-                cmin=strain_min,  # Fix the colorbar range
-                cmax=strain_max,  # Fix the colorbar range
-                flatshading=True,
-                opacity=1.0,  # Adjust for visibility of multiple stereo pairs
-                name=f'Stereo Pair {stereo_pair_idx + 1}'
+            mesh = dict(
+                x=coords[:, 0],
+                y=coords[:, 1],
+                z=coords[:, 2],
+                i=simplices[:, 0],
+                j=simplices[:, 1],
+                k=simplices[:, 2],
+                intensity=strain,
             )
             timestep_meshes.append(mesh)
+            if timestep_idx == 0:
+                initial_data.append(go.Mesh3d(name=name, **mesh, **mesh_style))
 
-        # Create the frame
-        frame = go.Frame(data=timestep_meshes, name=f"frame_{timestep_idx}")
-        frames.append(frame)
+        frame_data.append(timestep_meshes)
+        frame_extras.append(timestep_extras)
 
         # Add a slider step for each frame
         slider_step = {
@@ -225,16 +488,42 @@ def create_animated_mesh(datasets, z_scale=1, plot_save_path=None):
         }
         sliders_dict['steps'].append(slider_step)
 
-    # Create the initial plot with the first timesteps data
-    initial_data = frames[0].data
+    # Global ranges for x, y, z, and strain (for colorbar)
+    stats = collection_stats(datasets)
+    if stats is None:
+        stats = DatasetStatistics.from_datasets(datasets)
+    # None if every point was filtered out, plotly then picks the ranges
+    x_range, y_range, z_range = stats.range('x'), stats.range('y'), stats.range('z')
+    strain_min, strain_max = stats.range('strain', strain_percentiles) or (None, None)
+
+    # Extra traces follow the traces of the stereo pairs, and are emptied once their
+    # pair falls back to full frames
+    extra_pairs = list(frame_extras[0]) if frame_extras else []
+    no_extras = dict(x=[], y=[], z=[], i=[], j=[], k=[], intensity=[])
+    for stereo_pair_idx in extra_pairs:
+        initial_data.append(go.Mesh3d(name=f'Stereo Pair {stereo_pair_idx + 1}',
+                                      **frame_extras[0][stereo_pair_idx], **mesh_style))
+    for timestep_meshes, timestep_extras in zip(frame_data, frame_extras):
+        timestep_meshes.extend(timestep_extras.get(stereo_pair_idx, no_extras)
+                               for stereo_pair_idx in extra_pairs)
+
+    # Fix the colorbar range, frames update only the arrays they carry
+    for mesh in initial_data:
+        mesh.update(cmin=strain_min, cmax=strain_max)
+    for timestep_idx, timestep_meshes in enumerate(frame_data):
+        if encoding == 'full':
+            for mesh in timestep_meshes:
+                mesh.update(cmin=strain_min, cmax=strain_max)
+        frames.append(go.Frame(data=[go.Mesh3d(**mesh) for mesh in timestep_meshes],
+                               name=f"frame_{timestep_idx}"))
 
     # Create the layout with fixed axis ranges
     layout = go.Layout(
         scene=dict(
             aspectratio=dict(x=1, y=1, z=z_scale),
-            xaxis=dict(title='X [mm]', range=[x_min, x_max]),  # Fix the x-axis range
-            yaxis=dict(title='Y [mm]', range=[y_min, y_max]),  # Fix the y-axis range
-            zaxis=dict(title='Z [mm]', range=[z_min, z_max]),  # Fix the z-axis range
+            xaxis=dict(title='X [mm]', range=x_range),  # Fix the x-axis range
+            yaxis=dict(title='Y [mm]', range=y_range),  # Fix the y-axis range
+            zaxis=dict(title='Z [mm]', range=z_range),  # Fix the z-axis range
         ),
         title="DIC Strain over Time",
         sliders=[sliders_dict],
@@ -269,11 +558,208 @@ def create_animated_mesh(datasets, z_scale=1, plot_save_path=None):
     # Create the figure
     fig = go.Figure(data=initial_data, layout=layout, frames=frames)
 
-    # Show the plot
-    fig.show()
+    return fig
+
+
+def create_animated_mesh(datasets,
+                         z_scale=1,
+                         plot_save_path=None,
+                         max_vertices=None,
+                         encoding='full',
+                         strain_percentiles=(1, 99),
+                         grid_tolerance: float = 0.01,
+                         show: bool = True):
+    """
+    Creates an animated 3D Mesh plot where each frame represents a timestep across all
+    stereo pairs, shows it unless show is False and saves it if plot_save_path is
+    given. See build_animated_mesh_figure for the other parameters.
+
+    :return: None
+    """
+    fig = build_animated_mesh_figure(datasets,
+                                     z_scale=z_scale,
+                                     max_vertices=max_vertices,
+                                     encoding=encoding,
+                                     strain_percentiles=strain_percentiles,
+                                     grid_tolerance=grid_tolerance)
+
+    # Show and save the plot
+    show_and_write(fig, plot_save_path, show=show)
+
+    return None
+
 
-    # Save plot
-    if plot_save_path != None:
-        fig.write_html(plot_save_path, full_html=False, include_plotlyjs='cdn')
+INDEX_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{ font-family: sans-serif; margin: 0; display: flex; height: 100vh; }}
+nav {{ width: 12em; overflow-y: auto; padding: 0.5em; border-right: 1px solid #ccc; }}
+nav a {{ display: block; padding: 0.1em 0; }}
+iframe {{ flex: 1; border: none; }}
+</style>
+</head>
+<body>
+<nav>
+<b>{title}</b>
+{links}
+</nav>
+<iframe name="view" src="{first}"></iframe>
+</body>
+</html>
+"""
+
+
+def timestep_figures_dir(plot_save_path) -> Path:
+    """
+    Directory of the per timestep figures of a plot, its path without an .html
+    suffix. Other dots are part of the name, e.g. run.1.html gives run.1/.
+    """
+    path = Path(plot_save_path)
+    if path.suffix.lower() == ".html":
+        return path.with_name(path.name[:-len(path.suffix)])
+    return path
+
+
+# Applies the ranges in RANGES_FILE, next to the figure, once it has loaded. Ranges of
+# lazy collections are only known once every figure has been written.
+RANGES_FILE = "ranges.js"
+RANGES_SCRIPT = """
+var script = document.createElement('script');
+script.src = '%s';
+script.onload = function () {
+    var ranges = window.DIC_RANGES, plot = document.getElementById('{plot_id}');
+    var layout = {};
+    ['x', 'y', 'z'].forEach(function (axis) {
+        if (ranges[axis]) { layout['scene.' + axis + 'axis.range'] = ranges[axis]; }
+    });
+    Plotly.relayout(plot, layout);
+    if (ranges.strain) {
+        Plotly.restyle(plot, {cmin: ranges.strain[0], cmax: ranges.strain[1]});
+    }
+};
+document.head.appendChild(script);
+""" % RANGES_FILE
 
+
+def _write_timestep_figure(meshes, strain_range, axis_ranges, title, path,
+                           max_vertices=None):
+    """
+    Builds and writes the figure of one timestep, in a worker process. Without
+    ranges the figure takes them from RANGES_FILE when opened. Returns the timing
+    for the profiler.
+    """
+    start = time.perf_counter()
+    if max_vertices is not None:
+        meshes = [decimate_mesh(coords, simplices, strain, max_vertices=max_vertices)
+                  for coords, simplices, strain in meshes]
+    fig = build_meshes_figure(meshes, strain_range, axis_ranges=axis_ranges, title=title)
+    # The plotly.js bundle is shared by every file in the directory
+    fig.write_html(path, full_html=True, include_plotlyjs='directory',
+                   post_script=RANGES_SCRIPT if axis_ranges is None else None)
+    return start, time.perf_counter() - start, os.getpid()
+
+
+def write_timestep_figures(datasets,
+                           save_dir,
+                           max_vertices=None,
+                           strain_percentiles=(1, 99),
+                           workers: int = 1) -> Path:
+    """
+    Writes one standalone HTML file per timestep, overlaying the meshes of every
+    stereo pair, and an index.html page to browse them, without showing anything.
+
+    Figures are built and serialized in a pool of worker processes, fed one
+    timestep at a time so lazy stereo pairs only load the timesteps in flight, each
+    once. Every file has the same axis and color ranges. They are written into the
+    files if the collection's statistics are complete up front, otherwise they are
+    gathered as the timesteps are fed to the workers and written to ranges.js,
+    which every file applies when opened. The files work offline and share one copy
+    of plotly.js in save_dir.
+
+    :param datasets: datasets[stereo_pair][timestep] of meshed and filtered datasets.
+    :param save_dir: Directory for the files, created if missing.
+    :param max_vertices: Vertex budget per stereo pair mesh, None for full resolution.
+    :param strain_percentiles: (low, high) percentiles of the color range, None for
+                               min to max.
+    :param workers: Worker processes, None for all cores, 1 to run serially.
+    :return: Path of the index page.
+    """
+    save_dir = Path(save_dir)
+    save_dir.mkdir(parents=True, exist_ok=True)
+    bundle = save_dir / "plotly.min.js"
+    if not bundle.exists():
+        # Written once up front, rather than raced for by the workers
+        from plotly.offline import get_plotlyjs
+        bundle.write_text(get_plotlyjs(), encoding="utf-8")
+
+    # Lazy stereo pairs only gather statistics as their timesteps load, so their
+    # ranges are gathered while the figures are written and applied afterwards
+    lazy = any(isinstance(stereo_pair, LazyStereoPair) for stereo_pair in datasets)
+    stats = None if lazy else collection_stats(datasets)
+    gather = stats is None
+    if gather:
+        stats = DatasetStatistics()
+        strain_range = axis_ranges = None
+    else:
+        strain_range = stats.range('strain', strain_percentiles)
+        axis_ranges = (stats.range('x'), stats.range('y'), stats.range('z'))
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    num_timesteps = len(datasets[0])
+    file_names = [f"t_{timestep_idx:05d}.html" for timestep_idx in range(num_timesteps)]
+
+    def task(timestep_idx):
+        meshes = []
+        for stereo_pair in datasets:
+            timestep_data = stereo_pair[timestep_idx]
+            if gather:
+                stats.update(timestep_data)
+            meshes.append((timestep_data.coords_filtered,
+                           timestep_data.simplices_filtered,
+                           timestep_data.strain_filtered))
+        return (meshes, strain_range, axis_ranges, f"Timestep {timestep_idx}",
+                str(save_dir / file_names[timestep_idx]), max_vertices)
+
+    if workers <= 1:
+        for timestep_idx in range(num_timesteps):
+            with instrumentation.span("plot build"):
+                _write_timestep_figure(*task(timestep_idx))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            running = set()
+            for timestep_idx in range(num_timesteps):
+                # Keep a few timesteps in flight so memory stays bounded
+                if len(running) >= 2 * workers:
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    _record_figure_timings(done)
+                running.add(executor.submit(_write_timestep_figure, *task(timestep_idx)))
+            _record_figure_timings(wait(running).done)
+
+    if gather:
+        ranges = {field: stats.range(field) for field in ('x', 'y', 'z')}
+        ranges['strain'] = stats.range('strain', strain_percentiles)
+        (save_dir / RANGES_FILE).write_text(
+            f"window.DIC_RANGES = {json.dumps(ranges)};\n", encoding="utf-8")
+
+    links = "\n".join(f'<a href="{name}" target="view">Timestep {timestep_idx}</a>'
+                       for timestep_idx, name in enumerate(file_names))
+    index_path = save_dir / "index.html"
+    index_path.write_text(INDEX_PAGE.format(title=html.escape(save_dir.name),
+                                            links=links,
+                                            first=file_names[0] if file_names else ""),
+                          encoding="utf-8")
+    print(f"Wrote {num_timesteps} timestep plots, index at {index_path}")
+
+    return index_path
+
+
+def _record_figure_timings(futures) -> None:
+    for future in futures:
+        start, duration, pid = future.result()
+        instrumentation.PROFILER.record("plot build", start, duration, pid=pid, tid=pid)
     return None
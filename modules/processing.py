@@ -1,11 +1,133 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
 import numpy as np
-from scipy.spatial import Delaunay
+from scipy.spatial import Delaunay, cKDTree
 
-from modules import classes
+from modules import classes, instrumentation
 from modules.classes import DICDataset
 
 
-def create_delaunay_mesh(DICDataset) -> None:
+class LayoutCache:
+    """
+    Caches a structure built from a point layout, e.g. a triangulation, so it is
+    only built once for timesteps sharing the same reference grid.
+
+    Layouts are looked up by a hash of the points quantised to the tolerance and a
+    hit is confirmed by checking every point is within the tolerance of the cached
+    layout. Anything else is a miss and the structure is built fresh.
+    """
+
+    def __init__(self, builder, tolerance: float = 1e-6, max_entries: int = 8):
+        self.builder = builder  # Callable taking an (n, d) array of points, and args
+        self.tolerance = tolerance
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # layout key -> (points, built structure)
+        self._lock = threading.Lock()
+
+    def layout_key(self, points) -> str:
+        quantised = np.round(points / self.tolerance).astype(np.int64)
+        digest = hashlib.blake2b(quantised.tobytes(), digest_size=16)
+        digest.update(str(points.shape).encode())
+        return digest.hexdigest()
+
+    def get(self, points, *args):
+        """
+        Returns the cached structure for the layout, building it on a miss from the
+        points and any further args passed on to the builder.
+        """
+        points = np.ascontiguousarray(points)
+        key = self.layout_key(points)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._matches(entry[0], points):
+                self.hits += 1
+                self._entries.move_to_end(key)
+                instrumentation.count(f"{type(self).__name__} hits")
+                return entry[1]
+            self.misses += 1
+        instrumentation.count(f"{type(self).__name__} misses")
+
+        value = self.builder(points, *args)
+
+        with self._lock:
+            self._entries[key] = (points.copy(), value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def _matches(self, cached, points) -> bool:
+        return (cached.shape == points.shape
+                and np.allclose(cached, points, rtol=0, atol=self.tolerance))
+
+    def __getstate__(self):
+        # Lock cannot be pickled, cached entries are not worth sending to workers
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['_entries'] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def stats(self) -> str:
+        return f"{self.hits} hits, {self.misses} misses"
+
+
+def delaunay_simplices(points_2d):
+    """ Delaunay simplices of 2d points, read-only as they may be shared """
+    simplices = Delaunay(points_2d).simplices
+    simplices.setflags(write=False)
+    return simplices
+
+
+class TriangulationCache(LayoutCache):
+    """ LayoutCache of Delaunay simplices keyed on the (x, y) point layout """
+
+    def __init__(self, tolerance: float = 1e-6, max_entries: int = 8):
+        super().__init__(delaunay_simplices, tolerance=tolerance,
+                         max_entries=max_entries)
+
+
+def build_kdtree(points) -> cKDTree:
+    """ cKDTree built with the sliding midpoint rule, much faster to build for DIC
+    point clouds than the default balanced tree with similar query times """
+    return cKDTree(points, balanced_tree=False, compact_nodes=False)
+
+
+class NeighbourCache(LayoutCache):
+    """
+    LayoutCache of the k nearest neighbours of every point, keyed on the (x, y) point
+    layout. The neighbours are found in 3D in the first timestep with a layout, its
+    reference configuration, and reused for the later timesteps whose z changes as
+    the specimen deforms. Use get(coords[:, :2], coords).
+    """
+
+    def __init__(self, k: int = 8, workers: int = -1, tolerance: float = 1e-6,
+                 max_entries: int = 8):
+        super().__init__(self._build_neighbours, tolerance=tolerance,
+                         max_entries=max_entries)
+        self.k = k
+        self.workers = workers
+
+    def _build_neighbours(self, points_2d, coords):
+        k = min(self.k, coords.shape[0] - 1)
+        if k < 1:
+            return np.empty((coords.shape[0], 0), dtype=np.int32)
+        # The nearest neighbour of each point is itself
+        _, neighbours = build_kdtree(coords).query(coords, k=k + 1, workers=self.workers)
+        neighbours = neighbours[:, 1:].astype(np.int32)
+        neighbours.setflags(write=False)
+        return neighbours
+
+
+@instrumentation.profiled("mesh")
+def create_delaunay_mesh(DICDataset, cache: TriangulationCache = None) -> None:
     """
     Construct a Delaunay triangular mesh from a DICDataset with x,y
     coordinates as an attribute in the DICDataset object.
@@ -13,14 +135,251 @@ def create_delaunay_mesh(DICDataset) -> None:
     Only uses x, y points for delaunay tesselation.
 
     :param DICDataset :DICDataset object
+    :param cache: Optional TriangulationCache, timesteps with the same (x, y)
+                  layout then share one triangulation.
     :return: None
     """
     # Create array of 2d points (xy)
-    points_2d = np.vstack([DICDataset.x, DICDataset.y]).T
+    points_2d = DICDataset.coords[:, :2]
 
     # Use Delaunay meshing to connect 2d points
-    tri = Delaunay(points_2d)
-    DICDataset.simplices = tri.simplices
+    if cache is None:
+        DICDataset.simplices = Delaunay(points_2d).simplices
+    else:
+        DICDataset.simplices = cache.get(points_2d)
+
+    return None
+
+
+def _grid_spacing(values):
+    """
+    Spacing of values listed in grid order, the median of the nonzero steps between
+    consecutive points. Steps along a row are the spacing, and wraps to the next
+    row are few, so the median holds whether the export is row or column major.
+    """
+    steps = np.abs(np.diff(values))
+    span = values.max() - values.min() if values.size else 0.0
+    steps = steps[steps > span * 1e-9]
+    if steps.size == 0:
+        return None
+    return float(np.median(steps))
+
+
+def grid_indices(points_2d, tolerance: float = 0.01, max_fill: float = 4.0):
+    """
+    Detects whether 2d points lie on a regular, axis aligned grid, like the vector
+    grid of a LaVision export, in linear time.
+
+    :param points_2d: (n_points, 2) array of x, y points in the export order.
+    :param tolerance: Maximum offset of a point from its grid node, as a fraction of
+                      the grid spacing.
+    :param max_fill: Maximum ratio of grid nodes to points, so sparse scattered
+                     points are not mistaken for a very fine grid.
+    :return: (column, row, n_columns, n_rows) with the grid column and row of each
+             point, -1 for points with non-finite coordinates, or None if the
+             points are not on a grid.
+    """
+    points_2d = np.asarray(points_2d)
+    finite = np.isfinite(points_2d).all(axis=1)
+    x = points_2d[finite, 0]
+    y = points_2d[finite, 1]
+    if x.size < 3:
+        return None
+
+    dx = _grid_spacing(x)
+    dy = _grid_spacing(y)
+    if dx is None or dy is None:
+        return None
+
+    x0 = x.min()
+    y0 = y.min()
+    column_f = np.rint((x - x0) / dx)
+    row_f = np.rint((y - y0) / dy)
+    if (np.abs(x - x0 - column_f * dx).max() > tolerance * dx
+            or np.abs(y - y0 - row_f * dy).max() > tolerance * dy):
+        return None
+
+    n_columns = int(column_f.max()) + 1
+    n_rows = int(row_f.max()) + 1
+    if n_columns * n_rows > max_fill * x.size:
+        return None
+
+    dtype = index_dtype(n_columns * n_rows)
+    column = np.full(points_2d.shape[0], -1, dtype=dtype)
+    row = np.full(points_2d.shape[0], -1, dtype=dtype)
+    column[finite] = column_f
+    row[finite] = row_f
+
+    # Each node may hold one point only
+    if np.bincount(row[finite] * n_columns + column[finite]).max() > 1:
+        return None
+
+    return column, row, n_columns, n_rows
+
+
+def grid_simplices(points_2d, valid=None, tolerance: float = 0.01):
+    """
+    Triangulates points on a regular grid directly, two triangles per grid cell.
+
+    Cells with all four corners valid are split into two triangles, cells with
+    three valid corners get one triangle, and any other cell is skipped, so holes
+    in the region of interest stay open instead of being bridged by slivers.
+
+    :param points_2d: (n_points, 2) array of x, y points in the export order.
+    :param valid: Optional boolean array of length n_points, e.g. strain != 0,
+                  invalid points are left out of the mesh.
+    :param tolerance: Grid detection tolerance, see grid_indices.
+    :return: (n_simplices, 3) read-only simplices, or None if the points are not on
+             a grid.
+    """
+    indices = grid_indices(points_2d, tolerance=tolerance)
+    if indices is None:
+        return None
+    column, row, n_columns, n_rows = indices
+
+    n_points = column.shape[0]
+    dtype = index_dtype(n_points)
+    on_grid = column >= 0
+    if valid is not None:
+        on_grid &= np.asarray(valid, dtype=bool)
+
+    # Point index at every grid node, -1 where there is no valid point
+    nodes = np.full((n_rows, n_columns), -1, dtype=dtype)
+    nodes[row[on_grid], column[on_grid]] = np.flatnonzero(on_grid)
+
+    # Corners of every cell, counter-clockwise from the lower left
+    corners = np.stack([nodes[:-1, :-1].ravel(),
+                        nodes[:-1, 1:].ravel(),
+                        nodes[1:, 1:].ravel(),
+                        nodes[1:, :-1].ravel()], axis=1)
+    corner_valid = corners >= 0
+    corner_count = corner_valid.sum(axis=1)
+
+    full = corners[corner_count == 4]
+    partial = corner_count == 3
+    simplices = np.concatenate([
+        full[:, [0, 1, 2]],
+        full[:, [0, 2, 3]],
+        # Boolean indexing keeps the three valid corners in order
+        corners[partial][corner_valid[partial]].reshape(-1, 3),
+    ])
+    simplices.setflags(write=False)
+    return simplices
+
+
+def structured_simplices(points_2d, strain=None, config=None):
+    """
+    Grid simplices for the mesh mode of the config, see create_mesh.
+
+    :return: Grid simplices, or None if Delaunay meshing should be used.
+    :raises ValueError: If config.mesh_mode is "grid" and the points are not on a grid.
+    """
+    config = config or classes.Config()
+    if config.mesh_mode == "delaunay":
+        return None
+
+    valid = None
+    if config.mesh_skip_strain0 and strain is not None:
+        valid = strain != 0
+    simplices = grid_simplices(points_2d, valid=valid, tolerance=config.grid_tolerance)
+
+    if simplices is None and config.mesh_mode == "grid":
+        raise ValueError("points are not on a regular grid")
+    return simplices
+
+
+@instrumentation.profiled("mesh")
+def create_mesh(DICDataset, config=None, cache: TriangulationCache = None) -> None:
+    """
+    Constructs a triangular mesh of a DICDataset, set by config.mesh_mode:
+    - "grid": Triangulate the regular vector grid of the export directly, in
+      linear time. Cells with zero strain corners are skipped while building if
+      config.mesh_skip_strain0 is set.
+    - "delaunay": Delaunay tesselation of the x, y points, see create_delaunay_mesh.
+    - "auto": Grid if the points are on a grid, otherwise Delaunay.
+
+    :param DICDataset: DICDataset object
+    :param config: Config, mesh_mode, mesh_skip_strain0 and grid_tolerance are used.
+    :param cache: Optional TriangulationCache for Delaunay meshing.
+    :return: None
+    """
+    points_2d = DICDataset.coords[:, :2]
+    simplices = structured_simplices(points_2d, DICDataset.strain, config)
+
+    if simplices is None:
+        simplices = delaunay_simplices(points_2d) if cache is None else cache.get(points_2d)
+    DICDataset.simplices = simplices
+
+    return None
+
+
+def index_dtype(n: int) -> np.dtype:
+    """
+    Smallest signed integer dtype able to index n points. Delaunay returns int32
+    simplices, so int32 is used unless the point count exceeds its range.
+    """
+    if n <= np.iinfo(np.int32).max:
+        return np.dtype(np.int32)
+    return np.dtype(np.int64)
+
+
+def mask_and_reindex(mask, simplices=None):
+    """
+    Filter points and simplices by a boolean point mask using whole-array operations.
+
+    Simplices are kept only when all of their vertices are kept, and their vertex
+    indices are remapped into the filtered point numbering.
+
+    :param mask: Boolean array of length n_points, True for points to keep.
+    :param simplices: (n_simplices, 3) integer array indexing the unfiltered points,
+                      or None to only compute the point index.
+    :return: (point_index, simplices_filtered) where point_index holds the original
+             indices of the kept points and simplices_filtered is None if no
+             simplices were given.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    dtype = index_dtype(mask.shape[0])
+    point_index = np.flatnonzero(mask).astype(dtype, copy=False)
+
+    if simplices is None:
+        return point_index, None
+
+    simplices = np.asarray(simplices)
+    # Create mapping from old indices to new, -1 for removed points
+    index_map = np.full(mask.shape[0], -1, dtype=dtype)
+    index_map[point_index] = np.arange(point_index.shape[0], dtype=dtype)
+
+    # Only keep simplices where all points are kept
+    keep = mask[simplices].all(axis=1)
+    simplices_filtered = index_map[simplices[keep]]
+
+    return point_index, simplices_filtered
+
+
+@instrumentation.profiled("filter")
+def filter_data(DICDataset, mask) -> None:
+    """
+    Filters the points of a DICDataset by a boolean mask into the *_filtered
+    attributes, keeping only the simplices whose points are all kept.
+
+    :param DICDataset: DICDataset object, meshed if simplices are to be filtered.
+    :param mask: Boolean array of length n_points, True for points to keep.
+    :return: None
+    """
+    point_index, simplices_filtered = mask_and_reindex(mask, DICDataset.simplices)
+    apply_filter(DICDataset, point_index, simplices_filtered)
+
+    return None
+
+
+def apply_filter(DICDataset, point_index, simplices_filtered) -> None:
+    """
+    Sets the filter of a DICDataset from the original indices of the kept points
+    and the reindexed simplices, as returned by mask_and_reindex. The *_filtered
+    point attributes are gathered from point_index when accessed.
+    """
+    DICDataset.filtered_index = point_index
+    DICDataset.simplices_filtered = simplices_filtered
 
     return None
 
@@ -35,59 +394,243 @@ def filter_strain0_data(DICDataset) -> None:
     due to noise the measurements are unlikely to == 0.
     """
     try:
-        mask = DICDataset.strain != 0
-        DICDataset.x_filtered = DICDataset.x[mask]
-        DICDataset.y_filtered = DICDataset.y[mask]
-        DICDataset.z_filtered = DICDataset.z[mask]
-        DICDataset.strain_filtered = DICDataset.strain[mask]
-
-        # Create mapping from old indices to new
-        index_map = np.zeros_like(mask, dtype=int)
-        index_map[mask] = np.arange(len(DICDataset.x_filtered))
-
-        # Filter simplices to remove any that contain removed points
-        DICDataset.simplices_filtered = []
-        for simplex in DICDataset.simplices:
-            if mask[simplex].all():  # Only keep simplices where all points are kept
-                DICDataset.simplices_filtered.append(index_map[simplex])
-
-        DICDataset.simplices_filtered = np.array(DICDataset.simplices_filtered)
+        if DICDataset.simplices is None:
+            raise ValueError("dataset has no simplices, mesh it first")
+        filter_data(DICDataset, DICDataset.strain != 0)
     except Exception as e:
         print(f"Warning: Could not filter {DICDataset}")
         print(f"Exception: {e}")
     return None
 
+
+def simplex_quality_mask(points,
+                         simplices,
+                         max_edge: float = None,
+                         max_edge_factor: float = None,
+                         max_aspect: float = None,
+                         max_circumradius: float = None,
+                         batch_size: int = 65536):
+    """
+    Mask of the simplices passing every set limit on their shape, computed for all
+    simplices at once in batches. Limits left as None are not checked.
+
+    Squared edge lengths and the squared area (by Lagrange's identity, so 2D and 3D
+    points both work) are the only per simplex quantities, the limits are compared
+    against them without square roots where possible.
+
+    :param points: (n_points, 2 or 3) coordinates.
+    :param simplices: (n_simplices, 3) triangles indexing points.
+    :param max_edge: [mm] Longest edge kept.
+    :param max_edge_factor: Longest edge kept as a multiple of the median longest
+                            edge of the simplices, for meshes of unknown spacing.
+    :param max_aspect: Longest edge over shortest altitude, scaled so an equilateral
+                       triangle is 1. Degenerate simplices are always removed.
+    :param max_circumradius: [mm] Largest circumradius kept, as in an alpha shape.
+    :param batch_size: Simplices per batch, small enough for the temporary arrays to
+                       stay in cache.
+    :return: Boolean array, True for simplices to keep.
+    """
+    points = np.asarray(points)
+    simplices = np.asarray(simplices)
+    n_simplices = simplices.shape[0]
+    # 1D gathers from contiguous columns are much faster than gathering rows
+    columns = [np.ascontiguousarray(points[:, axis]) for axis in range(points.shape[1])]
+    longest2 = np.empty(n_simplices)
+    product2 = np.empty(n_simplices)  # Product of the squared edge lengths
+    area4 = np.empty(n_simplices)  # |u x v| ** 2, i.e. 4 * area ** 2
+
+    for start in range(0, n_simplices, batch_size):
+        batch = simplices[start:start + batch_size]
+        corners = [np.ascontiguousarray(batch[:, vertex]) for vertex in range(3)]
+        uu = np.zeros(batch.shape[0])
+        vv = np.zeros(batch.shape[0])
+        uv = np.zeros(batch.shape[0])
+        for column in columns:
+            a = column[corners[0]]
+            u = column[corners[1]]
+            u -= a
+            v = column[corners[2]]
+            v -= a
+            uu += u * u
+            vv += v * v
+            u *= v
+            uv += u
+        ww = uu + vv
+        ww -= 2 * uv  # |v - u| ** 2
+
+        stop = start + batch.shape[0]
+        np.maximum(np.maximum(uu, vv), ww, out=longest2[start:stop])
+        np.multiply(uu * vv, ww, out=product2[start:stop])
+        uv *= uv
+        np.multiply(uu, vv, out=area4[start:stop])
+        area4[start:stop] -= uv
+    np.maximum(area4, 0, out=area4)
+
+    keep = area4 > 0
+    if max_edge is not None:
+        keep &= longest2 <= max_edge ** 2
+    if max_edge_factor is not None and n_simplices:
+        keep &= longest2 <= max_edge_factor ** 2 * np.median(longest2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if max_aspect is not None:
+            # longest / (2 * area / longest) * sqrt(3) / 2
+            keep &= np.sqrt(3) * longest2 <= 2 * max_aspect * np.sqrt(area4)
+        if max_circumradius is not None:
+            # R = abc / (4 * area)
+            keep &= product2 <= 4 * max_circumradius ** 2 * area4
+
+    return keep
+
+
+@instrumentation.profiled("filter")
+def filter_mesh_quality(DICDataset,
+                        max_edge: float = None,
+                        max_edge_factor: float = None,
+                        max_aspect: float = None,
+                        max_circumradius: float = None) -> None:
+    """
+    Removes poorly shaped simplices, e.g. long thin triangles bridging gaps between
+    stereo pairs or across the edges of the region of interest, see
+    simplex_quality_mask. Applied on top of any filter already set, otherwise on
+    the whole mesh. Points are kept.
+    """
+    try:
+        if DICDataset.simplices is None:
+            raise ValueError("dataset has no simplices, mesh it first")
+        if DICDataset.filtered_index is None:
+            point_index = slice(None)
+            points = DICDataset.coords
+            simplices = DICDataset.simplices
+        else:
+            point_index = DICDataset.filtered_index
+            points = DICDataset.coords_filtered
+            simplices = DICDataset.simplices_filtered
+
+        keep = simplex_quality_mask(points,
+                                    simplices,
+                                    max_edge=max_edge,
+                                    max_edge_factor=max_edge_factor,
+                                    max_aspect=max_aspect,
+                                    max_circumradius=max_circumradius)
+        instrumentation.count("simplices removed by quality", int((~keep).sum()))
+        apply_filter(DICDataset, point_index, simplices[keep])
+    except Exception as e:
+        print(f"Warning: Could not filter {DICDataset}")
+        print(f"Exception: {e}")
+    return None
+
+
+@instrumentation.profiled("combine")
 def combine_filtered_stereo_pairs(meshes):
     combined_data = DICDataset()
 
-    combined_data.x_filtered = np.concatenate([mesh.x_filtered for mesh in meshes])
-    combined_data.y_filtered = np.concatenate([mesh.y_filtered for mesh in meshes])
-    combined_data.z_filtered = np.concatenate([mesh.z_filtered for mesh in meshes])
-    combined_data.strain_filtered = np.concatenate([mesh.strain_filtered for mesh in meshes])
+    combined_data.set_points(np.concatenate([mesh.coords_filtered for mesh in meshes]),
+                             np.concatenate([mesh.strain_filtered for mesh in meshes]))
+    # Every combined point is a filtered point
+    combined_data.filtered_index = slice(None)
 
     return combined_data
 
 
+@instrumentation.profiled("combine")
 def combine_unfiltered_stereo_pairs(meshes):
     combined_data = DICDataset()
 
-    combined_data.x = np.concatenate([mesh.x for mesh in meshes])
-    combined_data.y = np.concatenate([mesh.y for mesh in meshes])
-    combined_data.z = np.concatenate([mesh.z for mesh in meshes])
-    combined_data.strain = np.concatenate([mesh.strain for mesh in meshes])
+    combined_data.set_points(np.concatenate([mesh.coords for mesh in meshes]),
+                             np.concatenate([mesh.strain for mesh in meshes]))
 
     return combined_data
 
 
+@instrumentation.profiled("filter")
+def filter_points(DICDataset, mask) -> None:
+    """
+    Removes the points of an unmeshed DICDataset where mask is False, in place.
+    """
+    point_index, _ = mask_and_reindex(mask)
+    DICDataset.set_points(DICDataset.coords[point_index], DICDataset.strain[point_index])
+
+    return None
+
+
 def filter_strain0_points(DICDataset) -> None:
     try:
-        mask = DICDataset.strain != 0
-        DICDataset.x = DICDataset.x[mask]
-        DICDataset.y = DICDataset.y[mask]
-        DICDataset.z = DICDataset.z[mask]
-        DICDataset.strain = DICDataset.strain[mask]
+        filter_points(DICDataset, DICDataset.strain != 0)
+    except Exception as e:
+        print(f"Warning: Could not filter {DICDataset}")
+        print(f"Exception: {e}")
+
+    return None
+
+
+@instrumentation.profiled("neighbour search")
+def strain0_neighbour_mask(DICDataset,
+                           k: int = 8,
+                           workers: int = -1,
+                           neighbours=None,
+                           batch_size: int = 1_000_000):
+    """
+    Mask of the points to keep under the zero strain neighbour rule:
+    - Points with non-zero strain are kept.
+    - strain == 0 points whose k nearest neighbours are all strain == 0 are kept,
+      they are background which filter_strain0_data removes with its simplices.
+    - strain == 0 points with any non-zero strain neighbour are removed, so they do
+      not punch holes in the mesh of the good points around them.
+
+    Only the strain == 0 points are queried, in batches over multiple workers,
+    unless the neighbours of every point are given.
+
+    :param DICDataset: DICDataset object with coords and strain.
+    :param k: Number of nearest neighbours checked.
+    :param workers: Threads used by cKDTree.query, -1 for all cores.
+    :param neighbours: Optional (n_points, k) indices of the nearest neighbours of
+                       each point, e.g. from a NeighbourCache.
+    :param batch_size: Points queried per call, bounds the neighbour array size.
+    :return: Boolean array, True for points to keep.
+    """
+    coords = DICDataset.coords
+    zero = DICDataset.strain == 0
+    keep = ~zero
+
+    # The nearest neighbour of each point is itself
+    k = min(k, coords.shape[0] - 1)
+    if k < 1:
+        return np.ones_like(zero)
+
+    zero_index = np.flatnonzero(zero)
+    if neighbours is not None:
+        keep[zero_index] = zero[neighbours[zero_index]].all(axis=1)
+        return keep
+
+    tree = build_kdtree(coords)
+    for start in range(0, zero_index.shape[0], batch_size):
+        batch = zero_index[start:start + batch_size]
+        _, neighbours = tree.query(coords[batch], k=k + 1, workers=workers)
+        keep[batch] = zero[neighbours[:, 1:]].all(axis=1)
+
+    return keep
+
+
+def filter_strain0_neighbours(DICDataset,
+                              k: int = 8,
+                              workers: int = -1,
+                              cache: NeighbourCache = None) -> None:
+    """
+    Removes strain == 0 points next to non-zero strain points from an unmeshed
+    DICDataset, in place, see strain0_neighbour_mask.
+
+    :param cache: Optional NeighbourCache so timesteps sharing an (x, y) layout reuse
+                  the neighbours of its reference configuration, k and workers are
+                  then those of the cache.
+    """
+    try:
+        neighbours = (None if cache is None
+                      else cache.get(DICDataset.coords[:, :2], DICDataset.coords))
+        filter_points(DICDataset,
+                      strain0_neighbour_mask(DICDataset, k=k, workers=workers,
+                                             neighbours=neighbours))
     except Exception as e:
         print(f"Warning: Could not filter {DICDataset}")
         print(f"Exception: {e}")
 
-    return None
\ No newline at end of file
+    return None
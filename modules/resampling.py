@@ -0,0 +1,196 @@
+import numpy as np
+from scipy import sparse
+
+from modules import instrumentation
+from modules.classes import Config, DICDataset
+from modules.processing import (LayoutCache,
+                                delaunay_simplices,
+                                filter_data,
+                                grid_simplices,
+                                structured_simplices)
+
+
+def barycentric_weights(points_2d, simplices, grid_x, grid_y, eps: float = 1e-9):
+    """
+    Interpolation weights from mesh points to the nodes of a regular grid.
+
+    Each triangle is only tested against the grid nodes inside its bounding box,
+    found by index arithmetic on the regular grid, so the cost grows with the number
+    of triangles plus grid nodes rather than their product. A node on an edge shared
+    by two triangles takes the first of them.
+
+    :param points_2d: (n_points, 2) x, y of the mesh points.
+    :param simplices: (n_simplices, 3) triangles indexing points_2d.
+    :param grid_x: Increasing, evenly spaced x values of the grid columns.
+    :param grid_y: Increasing, evenly spaced y values of the grid rows.
+    :param eps: Barycentric tolerance for nodes on triangle edges.
+    :return: (n_nodes, n_points) CSR matrix with the barycentric weights of the
+             triangle containing each node, nodes numbered row by row. Rows of nodes
+             outside the mesh are empty.
+    """
+    points_2d = np.asarray(points_2d, dtype=np.float64)
+    simplices = np.asarray(simplices)
+    n_columns, n_rows = grid_x.shape[0], grid_y.shape[0]
+    dx = (grid_x[-1] - grid_x[0]) / max(n_columns - 1, 1) or 1.0
+    dy = (grid_y[-1] - grid_y[0]) / max(n_rows - 1, 1) or 1.0
+
+    corners = points_2d[simplices]  # (n_simplices, 3, 2)
+    low = corners.min(axis=1)
+    high = corners.max(axis=1)
+    column_start = np.maximum(np.ceil((low[:, 0] - grid_x[0]) / dx - eps), 0).astype(np.int64)
+    column_stop = np.minimum(np.floor((high[:, 0] - grid_x[0]) / dx + eps),
+                             n_columns - 1).astype(np.int64) + 1
+    row_start = np.maximum(np.ceil((low[:, 1] - grid_y[0]) / dy - eps), 0).astype(np.int64)
+    row_stop = np.minimum(np.floor((high[:, 1] - grid_y[0]) / dy + eps),
+                          n_rows - 1).astype(np.int64) + 1
+    width = np.maximum(column_stop - column_start, 0)
+    counts = width * np.maximum(row_stop - row_start, 0)
+
+    # One candidate per (triangle, node in its bounding box)
+    triangle = np.repeat(np.arange(simplices.shape[0]), counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    column = column_start[triangle] + local % width[triangle]
+    row = row_start[triangle] + local // width[triangle]
+
+    # Barycentric coordinates of the candidate nodes
+    a, b, c = corners[triangle, 0], corners[triangle, 1], corners[triangle, 2]
+    node_x = grid_x[column] - a[:, 0]
+    node_y = grid_y[row] - a[:, 1]
+    ab = b - a
+    ac = c - a
+    det = ab[:, 0] * ac[:, 1] - ab[:, 1] * ac[:, 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight_b = (node_x * ac[:, 1] - node_y * ac[:, 0]) / det
+        weight_c = (ab[:, 0] * node_y - ab[:, 1] * node_x) / det
+    weight_a = 1 - weight_b - weight_c
+    inside = ((weight_a >= -eps) & (weight_b >= -eps) & (weight_c >= -eps)
+              & (det != 0))
+
+    # First containing triangle of each node, later writes win so write in reverse
+    node = (row * n_columns + column)[inside]
+    candidate = np.flatnonzero(inside)
+    owner = np.full(n_columns * n_rows, -1, dtype=np.int64)
+    owner[node[::-1]] = candidate[::-1]
+    covered = np.flatnonzero(owner >= 0)
+    chosen = owner[covered]
+
+    rows = np.repeat(covered, 3)
+    cols = simplices[triangle[chosen]].ravel()
+    data = np.column_stack([weight_a[chosen], weight_b[chosen], weight_c[chosen]]).ravel()
+    return sparse.csr_matrix((data, (rows, cols)),
+                             shape=(n_columns * n_rows, points_2d.shape[0]))
+
+
+class Resampler:
+    """
+    Resamples the timesteps of stereo pairs onto one regular (x, y) grid, so pairs
+    can be compared or fused node by node.
+
+    The mesh, containing triangle and barycentric weights of every grid node are
+    computed once per point layout and kept in a LayoutCache, so timesteps of a
+    pair sharing its points reuse them. Resampling z and strain is then one sparse
+    matrix-vector product each. Nodes whose triangle has a strain == 0 (masked)
+    corner are left out, as in the strain == 0 filter.
+
+    :param grid_x: Increasing, evenly spaced x values of the grid columns.
+    :param grid_y: Increasing, evenly spaced y values of the grid rows.
+    :param config: Config, the mesh mode and triangulation_tolerance are used.
+    """
+
+    def __init__(self, grid_x, grid_y, config: Config = None):
+        config = config or Config()
+        self.grid_x = np.asarray(grid_x, dtype=np.float64)
+        self.grid_y = np.asarray(grid_y, dtype=np.float64)
+        self.config = config
+        self.weights_cache = LayoutCache(self._build_weights,
+                                         tolerance=config.triangulation_tolerance)
+
+        # The grid points and their triangles, shared by every resampled dataset
+        grid_xx, grid_yy = np.meshgrid(self.grid_x, self.grid_y)
+        self.grid_points = np.column_stack([grid_xx.ravel(), grid_yy.ravel()])
+        self.grid_simplices = grid_simplices(self.grid_points)
+
+    @classmethod
+    def covering(cls, datasets, spacing: float = None,
+                 config: Config = None) -> "Resampler":
+        """
+        Resampler whose grid covers the points of all the datasets.
+
+        :param datasets: DICDatasets, e.g. every stereo pair at one timestep.
+        :param spacing: [mm] grid spacing, None for the mean point spacing of the
+                        densest dataset.
+        :param config: Config passed on to the Resampler.
+        """
+        low = np.min([dataset.coords[:, :2].min(axis=0) for dataset in datasets], axis=0)
+        high = np.max([dataset.coords[:, :2].max(axis=0) for dataset in datasets], axis=0)
+        if spacing is None:
+            spacing = min(np.sqrt(np.prod(np.ptp(dataset.coords[:, :2], axis=0))
+                                  / dataset.coords.shape[0])
+                          for dataset in datasets)
+        grid_x = low[0] + spacing * np.arange(int(np.floor((high[0] - low[0]) / spacing)) + 1)
+        grid_y = low[1] + spacing * np.arange(int(np.floor((high[1] - low[1]) / spacing)) + 1)
+        return cls(grid_x, grid_y, config=config)
+
+    def _build_weights(self, points_2d):
+        # Mesh every point, zero strain is masked per timestep instead
+        simplices = structured_simplices(points_2d, None, self.config)
+        if simplices is None:
+            simplices = delaunay_simplices(points_2d)
+        return barycentric_weights(points_2d, simplices, self.grid_x, self.grid_y)
+
+    @instrumentation.profiled("resample")
+    def resample(self, dataset) -> DICDataset:
+        """
+        Resamples one timestep of a stereo pair onto the grid.
+
+        :param dataset: DICDataset with x, y, z and strain.
+        :return: Meshed DICDataset of the grid nodes, filtered to the nodes inside
+                 the dataset's mesh and away from masked points.
+        """
+        weights = self.weights_cache.get(dataset.coords[:, :2])
+
+        masked = (dataset.strain == 0).astype(np.float64)
+        covered = np.diff(weights.indptr) > 0
+        keep = covered & (weights @ masked == 0)
+
+        z = weights @ dataset.coords[:, 2]
+        strain = weights @ dataset.strain
+        resampled = DICDataset(np.column_stack([self.grid_points, z]), strain)
+        resampled.strain[~keep] = 0
+        resampled.simplices = self.grid_simplices
+        filter_data(resampled, keep)
+        return resampled
+
+    def resample_timestep(self, datasets, timestep_index: int) -> list[DICDataset]:
+        """ Every stereo pair of datasets[stereo_pair][timestep] at one timestep """
+        return [self.resample(stereo_pair[timestep_index]) for stereo_pair in datasets]
+
+
+def fuse_resampled(resampled, weights=None) -> DICDataset:
+    """
+    Fuses stereo pairs resampled onto the same grid into one dataset, the weighted
+    mean of the pairs covering each node.
+
+    :param resampled: DICDatasets of the stereo pairs from the same Resampler.
+    :param weights: Optional confidence of each pair, equal by default.
+    """
+    if weights is None:
+        weights = np.ones(len(resampled))
+
+    total = np.zeros(resampled[0].coords.shape[0])
+    z = np.zeros_like(total)
+    strain = np.zeros_like(total)
+    for dataset, weight in zip(resampled, weights):
+        keep = np.zeros(total.shape[0], dtype=bool)
+        keep[dataset.filtered_index] = True
+        total += weight * keep
+        z += weight * np.where(keep, dataset.coords[:, 2], 0)
+        strain += weight * np.where(keep, dataset.strain, 0)
+
+    covered = total > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        coords = np.column_stack([resampled[0].coords[:, :2], z / total])
+        fused = DICDataset(coords, np.where(covered, strain / total, 0))
+    fused.simplices = resampled[0].simplices
+    filter_data(fused, covered)
+    return fused
@@ -0,0 +1,241 @@
+import atexit
+import os
+import tempfile
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from modules import instrumentation
+from modules.classes import Config
+from modules.processing import (TriangulationCache,
+                                delaunay_simplices,
+                                mask_and_reindex,
+                                apply_filter,
+                                structured_simplices)
+
+# Per worker process state, set by _init_worker
+_CONFIG = None
+_TRI_CACHE = None
+_SENT_LAYOUTS = set()
+
+# Shared files still mapped by the parent on platforms which cannot unlink them
+_UNREMOVED = []
+
+
+def _shared_dir() -> str:
+    """ Directory for result files, RAM backed where the platform has /dev/shm """
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def _share(array) -> str:
+    """ Writes an array to a shared file in the worker and returns its path """
+    path = os.path.join(_shared_dir(), f"dic_{os.getpid()}_{uuid.uuid4().hex}.npy")
+    np.save(path, array)
+    return path
+
+
+def _attach(path):
+    """
+    Maps a shared result file into the parent without copying it, then removes the
+    file name. The mapping stays valid until the array is garbage collected.
+    """
+    array = np.load(path, mmap_mode='r')
+    try:
+        os.unlink(path)
+    except OSError:
+        _UNREMOVED.append(path)
+    return array
+
+
+def _discard(*paths) -> None:
+    """ Removes shared result files which will not be attached """
+    for path in paths:
+        if path is None:
+            continue
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+    return None
+
+
+@atexit.register
+def _remove_unremoved():
+    _discard(*_UNREMOVED)
+
+
+def _init_worker(config: Config) -> None:
+    global _CONFIG, _TRI_CACHE
+    _CONFIG = config
+    if config.reuse_triangulation:
+        _TRI_CACHE = TriangulationCache(tolerance=config.triangulation_tolerance)
+
+
+def _mesh_filter(points_2d, strain, config: Config, tri_cache=None):
+    """
+    Meshes one timestep, see processing.create_mesh, and filters its strain == 0
+    points. Run by both the serial and the parallel path of mesh_filter_timesteps.
+
+    :return: (layout key of the cached triangulation or None, simplices, original
+             indices of the kept points, filtered simplices, timings) where timings
+             holds the (name, start, duration) of the "mesh" and "filter" spans.
+    """
+    start = time.perf_counter()
+    simplices = structured_simplices(points_2d, strain, config)
+    layout_key = None
+    if simplices is not None:
+        # Grid meshes depend on the strain, so are not shared between timesteps
+        pass
+    elif tri_cache is None:
+        simplices = delaunay_simplices(points_2d)
+    else:
+        layout_key = tri_cache.layout_key(points_2d)
+        simplices = tri_cache.get(points_2d)
+    filter_start = time.perf_counter()
+    point_index, simplices_filtered = mask_and_reindex(strain != 0, simplices)
+    timings = (("mesh", start, filter_start - start),
+               ("filter", filter_start, time.perf_counter() - filter_start))
+    return layout_key, simplices, point_index, simplices_filtered, timings
+
+
+def _mesh_filter_task(points_2d, strain):
+    """
+    Meshes and filters one timestep in a worker process.
+
+    Returns the layout key of the triangulation, the path of the shared simplices
+    (None if this worker has already sent the triangulation for the layout), the
+    original indices of the kept points, the path of the shared filtered
+    simplices and the mesh and filter spans and pid for the profiler.
+    """
+    layout_key, simplices, point_index, simplices_filtered, timings = _mesh_filter(
+        points_2d, strain, _CONFIG, _TRI_CACHE)
+
+    # Triangulations shared between timesteps are only sent once per worker
+    simplices_path = None
+    if layout_key is None or layout_key not in _SENT_LAYOUTS:
+        simplices_path = _share(simplices)
+    try:
+        filtered_path = _share(simplices_filtered)
+    except BaseException:
+        _discard(simplices_path)
+        raise
+    if simplices_path is not None and layout_key is not None:
+        _SENT_LAYOUTS.add(layout_key)
+
+    return layout_key, simplices_path, point_index, filtered_path, (timings, os.getpid())
+
+
+def _discard_result(future) -> None:
+    """ Removes the shared files of a finished task whose result was not attached """
+    if future.cancelled() or future.exception() is not None:
+        return None
+    _, simplices_path, _, filtered_path, _ = future.result()
+    _discard(simplices_path, filtered_path)
+    return None
+
+
+def _progress(done: int, total: int, step: int) -> None:
+    if done == total or done % step == 0:
+        print(f"Meshed and filtered {done}/{total} timesteps")
+    return None
+
+
+def mesh_filter_timesteps(datasets, config: Config, tri_cache=None) -> None:
+    """
+    Meshes, see processing.create_mesh, and filters strain == 0 points for every
+    timestep of every stereo pair, in place.
+
+    With config.mesh_workers > 1 (or None for all cores) the (pair, timestep) tasks
+    are spread over a process pool. Workers return the simplices through shared
+    memory mapped files, so the results are not copied through the pool's pipes.
+    Results are attached in (pair, timestep) order whatever order they finish in.
+    Progress is reported in aggregate, around every 10% of the timesteps.
+    The statistics of a DICCollection are updated as each timestep is filtered.
+
+    :param datasets: datasets[stereo_pair][timestep] of loaded DICDatasets.
+    :param config: Config, mesh_workers, the mesh mode, reuse_triangulation and
+                   triangulation_tolerance are used.
+    :param tri_cache: Optional TriangulationCache used when running serially.
+    :return: None
+    """
+    tasks = [timestep for stereo_pair in datasets for timestep in stereo_pair]
+    stats = getattr(datasets, 'stats', None)
+    total = len(tasks)
+    step = max(1, -(-total // 10))  # Report roughly every 10%
+
+    workers = config.mesh_workers
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers <= 1 or total <= 1:
+        for done, timestep in enumerate(tasks, start=1):
+            _, simplices, point_index, simplices_filtered, timings = _mesh_filter(
+                timestep.coords[:, :2], timestep.strain, config, tri_cache)
+            for name, start, duration in timings:
+                instrumentation.PROFILER.record(name, start, duration)
+            timestep.simplices = simplices
+            apply_filter(timestep, point_index, simplices_filtered)
+            if stats is not None:
+                stats.update(timestep)
+            _progress(done, total, step)
+        return None
+
+    # Triangulations received from the workers, by layout key
+    layouts = {}
+    results = [None] * total
+    unattached = set()  # Futures whose shared result files are not attached yet
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_worker,
+                                 initargs=(config,)) as executor:
+            futures = {executor.submit(_mesh_filter_task,
+                                       timestep.coords[:, :2],
+                                       timestep.strain): index
+                       for index, timestep in enumerate(tasks)}
+            unattached.update(futures)
+
+            try:
+                for done, future in enumerate(as_completed(futures), start=1):
+                    (layout_key, simplices_path, point_index, filtered_path,
+                     (timings, pid)) = future.result()
+                    for name, start, duration in timings:
+                        instrumentation.PROFILER.record(name, start, duration,
+                                                        pid=pid, tid=pid)
+                    simplices = (None if simplices_path is None
+                                 else _attach(simplices_path))
+                    if layout_key is not None:
+                        if simplices is None:
+                            simplices = layouts.get(layout_key)
+                        else:
+                            # Each worker sends its own copy of a layout, keep one
+                            simplices = layouts.setdefault(layout_key, simplices)
+                    results[futures[future]] = (layout_key, simplices, point_index,
+                                                _attach(filtered_path))
+                    unattached.discard(future)
+                    _progress(done, total, step)
+            except BaseException:
+                # Do not start the remaining tasks after a failure
+                for future in unattached:
+                    future.cancel()
+                raise
+    finally:
+        # Results never attached, e.g. after another task raised, leave no files
+        for future in unattached:
+            _discard_result(future)
+
+    for timestep, (layout_key, simplices, point_index, simplices_filtered) in zip(
+            tasks, results):
+        if simplices is None:
+            # Sent with a result which finished after this one
+            simplices = layouts[layout_key]
+        timestep.simplices = simplices
+        apply_filter(timestep, point_index, simplices_filtered)
+        if stats is not None:
+            stats.update(timestep)
+
+    return None
@@ -0,0 +1,202 @@
+import threading
+
+import numpy as np
+
+
+class QuantileSketch:
+    """
+    Mergeable approximate quantile sketch of a stream of values, in the style of KLL.
+
+    Values are kept in levels of at most k items, an item on level h standing for
+    2**h values. A full level is sorted and every other item, from a random offset,
+    is promoted to the next level, so the sketch stays O(k log(n / k)) in size for
+    n values. Ranks are then off by about n / k at most, e.g. below 0.1% of the
+    values for the default k.
+    """
+
+    def __init__(self, k: int = 2048, seed: int = 0):
+        self.k = k
+        self.count = 0
+        self.levels = [np.empty(0)]
+        self._rng = np.random.default_rng(seed)
+
+    def update(self, values) -> None:
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[np.isfinite(values)]
+        if values.size == 0:
+            return None
+        self.count += values.size
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compact()
+        return None
+
+    def merge(self, other: "QuantileSketch") -> None:
+        """ Adds the values of another sketch """
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for height, items in enumerate(other.levels):
+            self.levels[height] = np.concatenate([self.levels[height], items])
+        self.count += other.count
+        self._compact()
+        return None
+
+    def _compact(self) -> None:
+        height = 0
+        while height < len(self.levels):
+            items = self.levels[height]
+            if items.size > self.k:
+                items = np.sort(items)
+                # Keep one item back if odd so the promoted half is exact
+                keep = items[:items.size % 2]
+                promoted = items[keep.size:][self._rng.integers(2)::2]
+                if height + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                self.levels[height] = keep
+                self.levels[height + 1] = np.concatenate([self.levels[height + 1],
+                                                          promoted])
+            height += 1
+        return None
+
+    def quantile(self, q):
+        """ Approximate q quantile(s), q in [0, 1], nan if no values were added """
+        if self.count == 0:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else np.nan
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(level.size, 2.0 ** height)
+                                  for height, level in enumerate(self.levels)])
+        order = np.argsort(items, kind='stable')
+        items = items[order]
+        cumulative = np.cumsum(weights[order])
+        ranks = np.asarray(q) * cumulative[-1]
+        index = np.minimum(np.searchsorted(cumulative, ranks, side='left'),
+                           items.size - 1)
+        return items[index]
+
+
+class RunningStats:
+    """
+    Count, min, max, mean and variance of a stream of values, updated one batch
+    (e.g. one timestep) at a time, plus a QuantileSketch for percentiles. Non-finite
+    values are ignored.
+    """
+
+    def __init__(self, k: int = 2048):
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.mean = 0.0
+        self._m2 = 0.0  # Sum of squared differences from the mean
+        self.sketch = QuantileSketch(k=k)
+
+    def update(self, values) -> None:
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[np.isfinite(values)]
+        if values.size == 0:
+            return None
+        self._combine(values.size, values.min(), values.max(), values.mean(),
+                      ((values - values.mean()) ** 2).sum())
+        self.sketch.update(values)
+        return None
+
+    def merge(self, other: "RunningStats") -> None:
+        if other.count:
+            self._combine(other.count, other.min, other.max, other.mean, other._m2)
+            self.sketch.merge(other.sketch)
+        return None
+
+    def _combine(self, count, minimum, maximum, mean, m2) -> None:
+        # Chan et al. parallel update of the mean and sum of squares
+        total = self.count + count
+        delta = mean - self.mean
+        self._m2 += m2 + delta ** 2 * self.count * count / total
+        self.mean += delta * count / total
+        self.count = total
+        self.min = min(self.min, float(minimum))
+        self.max = max(self.max, float(maximum))
+        return None
+
+    @property
+    def std(self) -> float:
+        return float(np.sqrt(self._m2 / self.count)) if self.count else np.nan
+
+    def percentile(self, p):
+        """ Approximate p percentile(s), p in [0, 100] """
+        return self.sketch.quantile(np.asarray(p) / 100)
+
+    def __repr__(self):
+        return (f"RunningStats(count={self.count}, min={self.min:.4g}, "
+                f"max={self.max:.4g}, mean={self.mean:.4g}, std={self.std:.4g})")
+
+
+class DatasetStatistics:
+    """
+    RunningStats of the filtered x, y, z and strain values of every timestep of a
+    dataset collection, updated as each timestep is filtered, so plot ranges need no
+    extra pass over the data.
+    """
+
+    fields = ('x', 'y', 'z', 'strain')
+
+    def __init__(self, k: int = 2048):
+        self.k = k
+        self.timesteps = 0
+        self.fields_stats = {field: RunningStats(k=k) for field in self.fields}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __getitem__(self, field: str) -> RunningStats:
+        return self.fields_stats[field]
+
+    def __bool__(self):
+        return self.timesteps > 0
+
+    def update(self, dataset) -> None:
+        """ Adds the filtered points of one timestep, all points if unfiltered """
+        coords = dataset.coords_filtered
+        strain = dataset.strain_filtered
+        if coords is None:
+            coords, strain = dataset.coords, dataset.strain
+
+        # Reduce outside the lock, then merge
+        batch = {field: RunningStats(k=self.k) for field in self.fields}
+        for axis, field in enumerate(('x', 'y', 'z')):
+            batch[field].update(coords[:, axis])
+        if strain is not None:
+            batch['strain'].update(strain)
+
+        with self._lock:
+            for field, stats in batch.items():
+                self.fields_stats[field].merge(stats)
+            self.timesteps += 1
+        return None
+
+    def range(self, field: str, percentiles=None):
+        """
+        (low, high) limits of a field, its min and max, or robust limits at the given
+        (low, high) percentiles which ignore outliers. None if no values were added,
+        e.g. every point was filtered out, so plots fall back to automatic ranges.
+        """
+        stats = self.fields_stats[field]
+        if stats.count == 0:
+            return None
+        if percentiles is None:
+            return stats.min, stats.max
+        low, high = stats.percentile(percentiles)
+        return float(low), float(high)
+
+    @classmethod
+    def from_datasets(cls, datasets, k: int = 2048) -> "DatasetStatistics":
+        """ Statistics of datasets[stereo_pair][timestep] gathered in one pass """
+        statistics = cls(k=k)
+        for stereo_pair in datasets:
+            for timestep_data in stereo_pair:
+                statistics.update(timestep_data)
+        return statistics
@@ -0,0 +1,196 @@
+import json
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+
+from modules import instrumentation
+from modules.classes import Config, DICDataset
+from modules.exporting import XDMFWriter, output_paths
+from modules.importing import _import_lavision, get_csv_file_paths
+from modules.processing import (TriangulationCache,
+                                create_mesh,
+                                filter_strain0_data)
+
+
+def file_signature(path) -> list:
+    """ Path, size and modification time of a file, which change when it is rewritten """
+    stat = os.stat(path)
+    return [str(Path(path).resolve()), stat.st_size, stat.st_mtime_ns]
+
+
+class TimestepStore:
+    """
+    Results of a watched test which have already been computed, so a restarted watch
+    resumes rather than recomputes.
+
+    Each completed timestep is saved as one .npz of the filtered meshes of every
+    stereo pair, and a JSON manifest records the signatures of the source files it
+    was computed from. A timestep whose files have since been rewritten is no longer
+    done.
+    """
+
+    manifest_name = "manifest.json"
+
+    def __init__(self, state_dir):
+        self.state_dir = Path(state_dir)
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        self.manifest_path = self.state_dir / self.manifest_name
+        try:
+            manifest = json.loads(self.manifest_path.read_text())
+        except (FileNotFoundError, ValueError):
+            manifest = {}
+        self.manifest = {int(timestep_index): signatures
+                         for timestep_index, signatures in manifest.items()}
+
+    @property
+    def timesteps(self) -> list[int]:
+        return sorted(self.manifest)
+
+    def entry_path(self, timestep_index: int) -> Path:
+        return self.state_dir / f"t_{timestep_index:05d}.npz"
+
+    def is_done(self, timestep_index: int, paths) -> bool:
+        signatures = self.manifest.get(timestep_index)
+        if signatures is None or not self.entry_path(timestep_index).exists():
+            return False
+        try:
+            return signatures == [file_signature(path) for path in paths]
+        except OSError:
+            return False
+
+    def save(self, timestep_index: int, paths, datasets) -> None:
+        """
+        Saves the filtered meshes of one timestep, computed from the files in paths.
+        """
+        arrays = {}
+        for stereo_pair_idx, data in enumerate(datasets):
+            arrays[f"coords_{stereo_pair_idx}"] = data.coords_filtered
+            arrays[f"strain_{stereo_pair_idx}"] = data.strain_filtered
+            arrays[f"simplices_{stereo_pair_idx}"] = data.simplices_filtered
+
+        # Write to a temporary file and rename so a crash never leaves partial state
+        entry = self.entry_path(timestep_index)
+        tmp = entry.with_suffix(".tmp.npz")
+        np.savez(tmp, **arrays)
+        tmp.replace(entry)
+
+        self.manifest[timestep_index] = [file_signature(path) for path in paths]
+        tmp = self.manifest_path.with_suffix(".json.tmp")
+        tmp.write_text(json.dumps(self.manifest))
+        tmp.replace(self.manifest_path)
+        return None
+
+    def load(self, timestep_index: int) -> list[DICDataset]:
+        """
+        Loads the filtered meshes of one timestep as a DICDataset per stereo pair,
+        holding only the kept points like a combined dataset.
+        """
+        datasets = []
+        with np.load(self.entry_path(timestep_index)) as arrays:
+            for stereo_pair_idx in range(len(arrays.files) // 3):
+                data = DICDataset(arrays[f"coords_{stereo_pair_idx}"],
+                                  arrays[f"strain_{stereo_pair_idx}"])
+                data.simplices = arrays[f"simplices_{stereo_pair_idx}"]
+                data.filtered_index = slice(None)
+                data.simplices_filtered = data.simplices
+                datasets.append(data)
+        return datasets
+
+
+def written_timesteps(stereo_pair_dirs: list[str], settle_time: float = 2.0) -> list:
+    """
+    Returns the file paths of each timestep which has been fully written for every
+    stereo pair, as [timestep][stereo_pair].
+
+    A file counts as written once it has not been modified for settle_time seconds,
+    and a timestep once its file and the files before it in every stereo pair are.
+    """
+    now = time.time()
+    written = []
+    for stereo_pair in get_csv_file_paths(stereo_pair_dirs, check_counts=False):
+        settled = 0
+        for path in stereo_pair:
+            try:
+                if now - os.path.getmtime(path) < settle_time:
+                    break
+            except OSError:
+                # Removed or renamed while scanning
+                break
+            settled += 1
+        written.append(stereo_pair[:settled])
+
+    timestep_count = min(len(stereo_pair) for stereo_pair in written)
+    return [[stereo_pair[timestep_index] for stereo_pair in written]
+            for timestep_index in range(timestep_count)]
+
+
+def watch_stereo_pairs(stereo_pair_dirs: list[str],
+                       save_path,
+                       config: Config = None,
+                       state_dir=None,
+                       idle_timeout: float = None) -> None:
+    """
+    Processes timesteps as the DIC software writes them during a test.
+
+    The stereo pair directories are polled every config.watch_poll_interval seconds.
+    Each timestep written for all stereo pairs is imported, meshed and filtered on
+    its own and appended to an HDF5/XDMF time series at save_path, whose index is
+    rewritten after every timestep so ParaView can reload the growing series.
+    Completed timesteps are kept in a TimestepStore, by default in a .state
+    directory next to save_path, and are skipped after a restart.
+
+    :param stereo_pair_dirs: Directories LaVision writes the CSV files into.
+    :param save_path: Path of the time series, the .h5 and .xmf suffixes are added.
+    :param config: Config, watch_* settings and the import and meshing settings.
+    :param state_dir: Directory of the TimestepStore.
+    :param idle_timeout: Stop after this many seconds without a new timestep, None
+                         to watch until interrupted (Ctrl+C).
+    """
+    config = config or Config()
+    store = TimestepStore(state_dir or output_paths(save_path)[0].with_suffix(".state"))
+    tri_cache = (TriangulationCache(tolerance=config.triangulation_tolerance)
+                 if config.reuse_triangulation else None)
+
+    print(config.print_sep)
+    print(f"Watching {len(stereo_pair_dirs)} stereo pair directories, "
+          f"{len(store.timesteps)} timesteps already processed")
+
+    with XDMFWriter(save_path, resume=True) as writer:
+        # Restore stored timesteps missing from the output, e.g. if it was deleted
+        for timestep_index in store.timesteps:
+            if timestep_index not in writer.timesteps:
+                writer.write_timestep(timestep_index, store.load(timestep_index))
+        writer.write_index()
+
+        last_new = time.monotonic()
+        try:
+            while True:
+                for timestep_index, paths in enumerate(
+                        written_timesteps(stereo_pair_dirs, config.watch_settle_time)):
+                    if store.is_done(timestep_index, paths):
+                        continue
+
+                    with instrumentation.span("watch timestep", timestep=timestep_index):
+                        datasets = [_import_lavision(path, config) for path in paths]
+                        for data in datasets:
+                            create_mesh(data, config=config, cache=tri_cache)
+                            filter_strain0_data(data)
+                        writer.write_timestep(timestep_index, datasets)
+                        writer.write_index()
+                        store.save(timestep_index, paths, datasets)
+
+                    instrumentation.count("timesteps watched")
+                    print(f"Processed timestep {timestep_index}")
+                    last_new = time.monotonic()
+
+                if idle_timeout is not None and time.monotonic() - last_new > idle_timeout:
+                    print(f"No new timesteps for {idle_timeout} s, stopping")
+                    break
+                time.sleep(config.watch_poll_interval)
+        except KeyboardInterrupt:
+            print("Watch stopped")
+
+    print(f"Time series written to {writer.xdmf_path}")
+    return None